@@ -4,124 +4,499 @@ Indexes all continuity documents and provides relevant context automatically.
 """
 
 import os
+import re
+import sys
 import json
+import mmap
+import time
+import hashlib
+import threading
+from array import array
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional, Iterator
 import numpy as np
 from sentence_transformers import SentenceTransformer
 import faiss
 
+from workspace_scanner import WorkspaceScan, ScannedFile, scan_workspace
+
+
+# Sentence embedding model shared by the index and the summarizer
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'  # 80MB model
+
+# Small local cross-encoder (~90MB) used by the optional rerank stage
+DEFAULT_RERANK_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+
+_embedding_model = None
+_embedding_model_lock = threading.Lock()
+
+
+def load_embedding_model() -> SentenceTransformer:
+    """Load the embedding model once per process and share it."""
+    global _embedding_model
+    with _embedding_model_lock:
+        if _embedding_model is None:
+            _embedding_model = SentenceTransformer(EMBEDDING_MODEL)
+        return _embedding_model
+
+
+class _NullTimer:
+    """No-op stage timer used when profiling is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _StageTimer:
+    """Adds the wall time of a `with` block to a profiler stage."""
+
+    __slots__ = ('profiler', 'stage', 'start')
+
+    def __init__(self, profiler: "RAGProfiler", stage: str):
+        self.profiler = profiler
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add_time(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class RAGProfiler:
+    """Per-stage timers and counters for ContinuityRAG.
+    
+    When disabled, `timer()` returns a shared no-op context manager and
+    `count()` returns immediately, so instrumentation stays in place at
+    negligible cost.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        """Clear all collected counters and timings."""
+        self.counters: Dict[str, int] = {}
+        self.timings: Dict[str, List[float]] = {}  # stage -> [seconds, calls]
+
+    def count(self, name: str, amount: int = 1):
+        """Increment a counter."""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_time(self, stage: str, seconds: float):
+        """Record one timed call of a stage."""
+        entry = self.timings.get(stage)
+        if entry is None:
+            self.timings[stage] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def timer(self, stage: str):
+        """Context manager timing a stage (no-op when disabled)."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, stage)
+
+    def as_dict(self) -> Dict:
+        """Return counters and timings as a plain dict."""
+        return {
+            'counters': dict(self.counters),
+            'timings': {
+                stage: {'seconds': total, 'calls': calls}
+                for stage, (total, calls) in self.timings.items()
+            },
+        }
+
+    def to_json(self) -> str:
+        """Return the stats as a single JSON log line."""
+        return json.dumps({'event': 'continuity_rag_stats', 'ts': time.time(), **self.as_dict()})
+
+    def to_prometheus(self, prefix: str = "continuity_rag") -> str:
+        """Return the stats in Prometheus text exposition format."""
+        lines = []
+        for name in sorted(self.counters):
+            metric = f"{prefix}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {self.counters[name]}")
+        if self.timings:
+            lines.append(f"# TYPE {prefix}_stage_seconds_total counter")
+            for stage in sorted(self.timings):
+                lines.append(f'{prefix}_stage_seconds_total{{stage="{stage}"}} {self.timings[stage][0]:.6f}')
+            lines.append(f"# TYPE {prefix}_stage_calls_total counter")
+            for stage in sorted(self.timings):
+                lines.append(f'{prefix}_stage_calls_total{{stage="{stage}"}} {self.timings[stage][1]}')
+        return "\n".join(lines) + "\n"
+
+
+def _content_hash(source) -> str:
+    """Digest of a file's content, given its bytes or its path."""
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(source, bytes):
+        digest.update(source)
+    else:
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+# Document types, stored per chunk as a uint8 code
+DOC_TYPES = ('portfolio', 'project', 'session', 'theory', 'general')
+_DOC_TYPE_CODES = {name: code for code, name in enumerate(DOC_TYPES)}
+
+
+class ChunkTable:
+    """
+    Column-oriented chunk metadata.
+    
+    File paths are interned once in `files`; every chunk then costs a few
+    bytes across numpy columns (file index, chunk id, type code, byte
+    offsets) instead of a dict with repeated keys and a duplicated path
+    string. Chunk text is not stored at all: `start`/`end` are byte offsets
+    into the source file, and `file_hashes` records the content each file
+    had when it was indexed.
+    Chunks are appended into compact `array` buffers while indexing and
+    frozen into numpy arrays by `finalize()`.
+    """
+
+    _COLUMNS = (
+        ('file_mtime', 'd', np.float64),   # per file
+        ('file_size', 'q', np.int64),      # per file
+        ('file_index', 'i', np.int32),     # per chunk from here on
+        ('chunk_id', 'i', np.int32),
+        ('type_code', 'B', np.uint8),
+        ('start', 'q', np.int64),
+        ('end', 'q', np.int64),
+    )
+
+    def __init__(self):
+        self.files: List[str] = []
+        self.file_hashes: List[str] = []
+        self._file_ids: Dict[str, int] = {}
+        self._buffers = {name: array(code) for name, code, _ in self._COLUMNS}
+        for name, _, dtype in self._COLUMNS:
+            setattr(self, name, np.zeros(0, dtype=dtype))
+
+    def add_file(self, rel_path: str, mtime: float, size: int, digest: str) -> int:
+        """Intern a file path and return its file index."""
+        file_id = self._file_ids.get(rel_path)
+        if file_id is None:
+            file_id = len(self.files)
+            self._file_ids[rel_path] = file_id
+            self.files.append(rel_path)
+            self.file_hashes.append(digest)
+            self._buffers['file_mtime'].append(mtime)
+            self._buffers['file_size'].append(size)
+        return file_id
+
+    def add_chunk(self, file_id: int, chunk_id: int, doc_type: str, start: int, end: int):
+        """Append one chunk record (visible after `finalize()`)."""
+        buffers = self._buffers
+        buffers['file_index'].append(file_id)
+        buffers['chunk_id'].append(chunk_id)
+        buffers['type_code'].append(_DOC_TYPE_CODES[doc_type])
+        buffers['start'].append(start)
+        buffers['end'].append(end)
+
+    def finalize(self):
+        """Move appended records from the buffers into the numpy columns."""
+        for name, code, dtype in self._COLUMNS:
+            pending = self._buffers[name]
+            if pending:
+                column = np.frombuffer(pending, dtype=dtype)
+                setattr(self, name, np.concatenate([getattr(self, name), column]))
+                self._buffers[name] = array(code)
+
+    def __len__(self) -> int:
+        return len(self.file_index)
+
+    def file(self, idx: int) -> str:
+        return self.files[self.file_index[idx]]
+
+    def doc_type(self, idx: int) -> str:
+        return DOC_TYPES[self.type_code[idx]]
+
+    def metadata(self, idx: int) -> Dict:
+        """Metadata dict for one chunk, in the pre-table format."""
+        return {
+            'file': self.file(idx),
+            'chunk_id': int(self.chunk_id[idx]),
+            'type': self.doc_type(idx),
+        }
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the table (columns plus path strings)."""
+        columns = sum(getattr(self, name).nbytes for name, _, _ in self._COLUMNS)
+        return columns + sum(sys.getsizeof(f) for f in self.files)
+
+    def save(self, path: Path):
+        """Write the numeric columns to an .npz file."""
+        np.savez(path, **{name: getattr(self, name) for name, _, _ in self._COLUMNS})
+
+    @classmethod
+    def load(cls, files: List[str], file_hashes: List[str], path: Path) -> "ChunkTable":
+        """Load a table saved with `save()`."""
+        table = cls()
+        table.files = list(files)
+        table.file_hashes = list(file_hashes)
+        table._file_ids = {f: i for i, f in enumerate(table.files)}
+        with np.load(path) as data:
+            for name, _, _ in cls._COLUMNS:
+                setattr(table, name, data[name])
+        return table
+
+
+class ChunkRecord:
+    """
+    Lightweight view of one retrieved chunk.
+    
+    Metadata is read from the owning ChunkTable and the text is fetched on
+    first access. Supports the old dict-style access (`result['content']`,
+    `result['metadata']['file']`, `'rerank_score' in result`).
+    """
+
+    __slots__ = ('_rag', 'index', 'relevance', 'rerank_score', '_content')
+
+    def __init__(self, rag: "ContinuityRAG", index: int, relevance: float,
+                 rerank_score: Optional[float] = None):
+        self._rag = rag
+        self.index = index
+        self.relevance = relevance
+        self.rerank_score = rerank_score
+        self._content = None
+
+    @property
+    def content(self) -> str:
+        if self._content is None:
+            self._content = self._rag._chunk_content(self.index)
+        return self._content
+
+    @property
+    def file(self) -> str:
+        return self._rag.chunks.file(self.index)
+
+    @property
+    def chunk_id(self) -> int:
+        return int(self._rag.chunks.chunk_id[self.index])
+
+    @property
+    def type(self) -> str:
+        return self._rag.chunks.doc_type(self.index)
+
+    @property
+    def metadata(self) -> Dict:
+        return self._rag.chunks.metadata(self.index)
+
+    def __getitem__(self, key: str):
+        if key == 'rerank_score' and self.rerank_score is None:
+            raise KeyError(key)
+        if key not in ('content', 'metadata', 'relevance', 'rerank_score'):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key: str) -> bool:
+        if key == 'rerank_score':
+            return self.rerank_score is not None
+        return key in ('content', 'metadata', 'relevance')
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self) -> str:
+        return f"ChunkRecord(file={self.file!r}, chunk_id={self.chunk_id}, relevance={self.relevance:.3f})"
+
 
 class ContinuityRAG:
     """RAG system for automatic continuity context retrieval."""
     
-    def __init__(self, docs_root: str, index_file: str = "continuity.index"):
+    def __init__(
+        self,
+        docs_root: str,
+        index_file: str = "continuity.index",
+        profile: bool = False,
+        rerank_model: Optional[str] = None,
+        rerank_candidates: int = 20,
+        rerank_budget_ms: Optional[float] = 50.0,
+    ):
+        """
+        Args:
+            docs_root: Root directory containing continuity documents
+            index_file: Index filename, relative to docs_root
+            profile: Collect per-stage timers and counters (see get_stats)
+            rerank_model: Cross-encoder name/path; enables reranking when set
+            rerank_candidates: Number of FAISS candidates passed to the reranker
+            rerank_budget_ms: Latency budget for reranking; None disables the limit
+        """
         self.docs_root = Path(docs_root)
         self.index_file = self.docs_root / index_file
         self.metadata_file = self.docs_root / f"{index_file}.meta.json"
+        self.chunks_file = self.docs_root / f"{index_file}.chunks.npz"
+        
+        # Timers and counters (no-op unless profile=True)
+        self.stats = RAGProfiler(enabled=profile)
         
         # Load embedding model (lightweight, runs locally)
         print("Loading embedding model...")
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')  # 80MB model
+        with self.stats.timer('model_load'):
+            self.model = load_embedding_model()
         self.dimension = 384  # Model output dimension
+        self.encode_batch_size = 32
+        
+        # Optional cross-encoder rerank stage (loaded on first use)
+        self.rerank_model = rerank_model
+        self.rerank_candidates = rerank_candidates
+        self.rerank_budget_ms = rerank_budget_ms
+        self._cross_encoder = None
+        self._rerank_ms_per_pair = None  # Moving average of observed cost
         
         self.index = None
-        self.documents = []
-        self.metadata = []
+        self.chunks = ChunkTable()
+        self._verified_files: Dict[int, Tuple[float, int]] = {}  # file id -> (mtime, size)
+        self._drifted_files = set()
         
-    def index_documents(self, force_rebuild: bool = False):
-        """Index all continuity documents."""
+    def index_documents(self, force_rebuild: bool = False, scan: Optional[WorkspaceScan] = None):
+        """
+        Index all continuity documents.
+        
+        Args:
+            force_rebuild: Rebuild even if an index exists on disk
+            scan: Workspace scan to index from; walks docs_root if omitted
+        """
         
         if not force_rebuild and self.index_file.exists():
             print("Loading existing index...")
-            self._load_index()
-            return
+            if self._load_index():
+                self.stats.count('index_cache_hits')
+                return
+            print("Index format is outdated, rebuilding...")
             
+        self.stats.count('index_cache_misses')
         print("Building new document index...")
-        self.documents = []
-        self.metadata = []
-        
-        # Find all markdown files in the continuity system
-        doc_patterns = [
-            "**/PORTFOLIO_CONTEXT.md",
-            "**/PROJECT_CONTEXT.md", 
-            "**/SESSION_BRIEFING*.md",
-            "**/CONTINUITY*.md",
-            "**/*_CONTEXT.md",
-            "**/README.md"
-        ]
+        self.chunks = ChunkTable()
+        self._verified_files = {}
+        self._drifted_files = set()
+        texts = []  # Chunk text is only held until it has been embedded
+        
+        # Find all markdown files in the continuity system (one walk, shared
+        # with the caller when it passes its own scan)
+        if scan is None:
+            with self.stats.timer('discover'):
+                scan = scan_workspace(self.docs_root)
         
-        for pattern in doc_patterns:
-            for doc_path in self.docs_root.glob(pattern):
-                if self._should_index(doc_path):
-                    self._index_document(doc_path)
+        with self.stats.timer('chunk'):
+            for doc in scan.files:
+                self.stats.count('files_discovered')
+                self._index_document(doc, texts)
+            self.chunks.finalize()
         
-        if not self.documents:
+        if not texts:
             print("Warning: No documents found to index!")
             return
             
         # Create embeddings
-        print(f"Creating embeddings for {len(self.documents)} document chunks...")
-        embeddings = self.model.encode(self.documents, show_progress_bar=True)
+        print(f"Creating embeddings for {len(texts)} document chunks...")
+        with self.stats.timer('encode'):
+            embeddings = self.model.encode(
+                texts,
+                batch_size=self.encode_batch_size,
+                show_progress_bar=True,
+            )
+        self.stats.count('encode_batches', -(-len(texts) // self.encode_batch_size))
+        del texts
         
         # Build FAISS index
-        self.index = faiss.IndexFlatL2(self.dimension)
-        self.index.add(np.array(embeddings).astype('float32'))
+        with self.stats.timer('index_add'):
+            self.index = faiss.IndexFlatL2(self.dimension)
+            self.index.add(np.array(embeddings).astype('float32'))
         
         # Save index
-        self._save_index()
-        print(f"Index built: {len(self.documents)} chunks indexed")
-        
-    def _should_index(self, path: Path) -> bool:
-        """Check if document should be indexed."""
-        # Skip git directories and certain files
-        excluded = ['.git', 'node_modules', '__pycache__', 'venv']
-        return not any(ex in str(path) for ex in excluded)
-    
-    def _index_document(self, doc_path: Path):
-        """Index a single document by chunking it."""
+        with self.stats.timer('save'):
+            self._save_index()
+        print(f"Index built: {len(self.chunks)} chunks indexed")
+        
+    def _index_document(self, doc: ScannedFile, texts: List[str]):
+        """Index a single document by chunking it into byte spans."""
+        doc_path = doc.path
         try:
-            with open(doc_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            with open(doc_path, 'rb') as f:
+                data = f.read()
+            data.decode('utf-8')  # Only UTF-8 documents are indexed
+            self.stats.count('bytes_read', len(data))
             
-            # Split into chunks (roughly 500 chars with overlap)
-            chunks = self._chunk_text(content, chunk_size=500, overlap=100)
+            # The scan's stat is reused; if the file changed since, the
+            # hash check in _verify_file still accepts the content read here
+            file_id = self.chunks.add_file(
+                str(doc_path.relative_to(self.docs_root)),
+                doc.mtime,
+                doc.size,
+                _content_hash(data),
+            )
+            doc_type = self._classify_doc(doc_path)
             
-            for i, chunk in enumerate(chunks):
+            # Split into chunks (roughly 500 bytes with overlap)
+            spans = self._chunk_spans(data, chunk_size=500, overlap=100)
+            
+            for i, (start, end) in enumerate(spans):
+                chunk = data[start:end].decode('utf-8')
                 if len(chunk.strip()) > 50:  # Skip tiny chunks
-                    self.documents.append(chunk)
-                    self.metadata.append({
-                        'file': str(doc_path.relative_to(self.docs_root)),
-                        'chunk_id': i,
-                        'type': self._classify_doc(doc_path)
-                    })
+                    self.stats.count('chunks_produced')
+                    texts.append(chunk)
+                    self.chunks.add_chunk(file_id, i, doc_type, start, end)
                     
         except Exception as e:
             print(f"Error indexing {doc_path}: {e}")
     
-    def _chunk_text(self, text: str, chunk_size: int = 500, overlap: int = 100) -> List[str]:
-        """Split text into overlapping chunks."""
-        chunks = []
+    def _chunk_spans(self, data: bytes, chunk_size: int = 500, overlap: int = 100) -> List[Tuple[int, int]]:
+        """
+        Return (start, end) byte offsets of overlapping chunks of UTF-8 data.
+        
+        Breaks prefer a sentence or line end; otherwise both ends are moved
+        back to a character boundary so every span decodes on its own.
+        """
+        spans = []
         start = 0
         
-        while start < len(text):
+        while start < len(data):
             end = start + chunk_size
-            chunk = text[start:end]
             
             # Try to break at sentence boundary
-            if end < len(text):
-                last_period = chunk.rfind('.')
-                last_newline = chunk.rfind('\n')
+            if end < len(data):
+                chunk = data[start:end]
+                last_period = chunk.rfind(b'.')
+                last_newline = chunk.rfind(b'\n')
                 break_point = max(last_period, last_newline)
                 
                 if break_point > chunk_size // 2:
-                    chunk = chunk[:break_point + 1]
                     end = start + break_point + 1
+                else:
+                    end = self._char_boundary(data, end)
             
-            chunks.append(chunk)
-            start = end - overlap
+            spans.append((start, end))
+            start = self._char_boundary(data, end - overlap)
             
-        return chunks
+        return spans
+    
+    @staticmethod
+    def _char_boundary(data: bytes, pos: int) -> int:
+        """Move pos back to the start of a UTF-8 character."""
+        while 0 < pos < len(data) and (data[pos] & 0xC0) == 0x80:
+            pos -= 1
+        return pos
     
     def _classify_doc(self, path: Path) -> str:
         """Classify document type based on name."""
@@ -138,38 +513,215 @@ class ContinuityRAG:
         else:
             return 'general'
     
-    def retrieve_context(self, query: str, top_k: int = 5) -> List[Dict]:
-        """Retrieve most relevant context for a query."""
+    def retrieve_context(
+        self,
+        query: str,
+        top_k: int = 5,
+        rerank: Optional[bool] = None,
+    ) -> List[ChunkRecord]:
+        """
+        Retrieve most relevant context for a query.
+        
+        Args:
+            query: Natural language query
+            top_k: Number of results to return
+            rerank: Rescore FAISS candidates with the cross-encoder
+                (defaults to True when a rerank_model is configured)
+        """
+        return list(self.iter_context(query, top_k, rerank))
+    
+    def iter_context(
+        self,
+        query: str,
+        top_k: int = 5,
+        rerank: Optional[bool] = None,
+    ) -> Iterator[ChunkRecord]:
+        """
+        Yield the most relevant chunks for a query lazily, in rank order.
+        
+        Chunk text is only fetched as each result is yielded, so callers
+        that stop early never touch the remaining chunks (reranking still
+        reads the candidate text it scores).
+        """
+        for idx, relevance, rerank_score in self._ranked_hits(query, top_k, rerank):
+            yield self._make_result(idx, relevance, rerank_score)
+    
+    def _ranked_hits(
+        self,
+        query: str,
+        top_k: int,
+        rerank: Optional[bool] = None,
+    ) -> List[Tuple[int, float, Optional[float]]]:
+        """Return (chunk index, relevance, rerank score) in final rank order."""
         
         if self.index is None:
             self.index_documents()
         
-        if not self.documents:
+        if len(self.chunks) == 0:
             return []
         
+        if rerank is None:
+            rerank = self.rerank_model is not None
+        num_candidates = max(top_k, self.rerank_candidates) if rerank else top_k
+        
+        hits = [hit for hit in self._search(query, num_candidates)
+                if self._verify_file(int(self.chunks.file_index[hit[0]]))]
+        
+        if rerank:
+            return self._rerank(query, hits)[:top_k]
+        return [(idx, relevance, None) for idx, relevance in hits[:top_k]]
+    
+    def _search(self, query: str, num_candidates: int) -> List[Tuple[int, float]]:
+        """Return (chunk index, relevance) pairs for the nearest chunks."""
+        self.stats.count('queries')
+        
         # Encode query
-        query_embedding = self.model.encode([query])
+        with self.stats.timer('query_encode'):
+            query_embedding = self.model.encode([query])
         
         # Search index
-        distances, indices = self.index.search(
-            np.array(query_embedding).astype('float32'), 
-            min(top_k, len(self.documents))
+        with self.stats.timer('index_search'):
+            distances, indices = self.index.search(
+                np.array(query_embedding).astype('float32'), 
+                min(num_candidates, len(self.chunks))
+            )
+        
+        return [
+            (int(idx), float(1 / (1 + dist)))  # Convert distance to relevance
+            for dist, idx in zip(distances[0], indices[0])
+            if 0 <= idx < len(self.chunks)
+        ]
+    
+    def _make_result(self, idx: int, relevance: float, rerank_score: Optional[float] = None) -> ChunkRecord:
+        """Build the result view for one chunk."""
+        return ChunkRecord(self, idx, relevance, rerank_score)
+    
+    def _chunk_content(self, idx: int) -> str:
+        """Read the text of a chunk from its source file."""
+        file_id = int(self.chunks.file_index[idx])
+        start = int(self.chunks.start[idx])
+        end = int(self.chunks.end[idx])
+        
+        if not self._verify_file(file_id):
+            return ""
+        
+        with self.stats.timer('span_read'):
+            path = self.docs_root / self.chunks.files[file_id]
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = mm[start:end]
+        self.stats.count('span_bytes_read', len(data))
+        return data.decode('utf-8', errors='replace')
+    
+    def _verify_file(self, file_id: int) -> bool:
+        """
+        Check that a source file still matches the indexed content.
+        
+        Unchanged (mtime, size) is trusted; otherwise the file is hashed and
+        compared with the digest recorded at index time. Files that drifted
+        are reported once and their chunks are dropped from results until
+        the index is rebuilt.
+        """
+        if file_id in self._drifted_files:
+            return False
+        
+        path = self.docs_root / self.chunks.files[file_id]
+        try:
+            stat = path.stat()
+        except OSError:
+            stat = None
+        
+        if stat is not None:
+            signature = (stat.st_mtime, stat.st_size)
+            if self._verified_files.get(file_id) == signature:
+                return True
+            if signature == (self.chunks.file_mtime[file_id], self.chunks.file_size[file_id]):
+                self._verified_files[file_id] = signature
+                return True
+            
+            self.stats.count('hash_checks')
+            if _content_hash(path) == self.chunks.file_hashes[file_id]:
+                self._verified_files[file_id] = signature
+                return True
+        
+        self.stats.count('drifted_files')
+        self._drifted_files.add(file_id)
+        print(f"Warning: {self.chunks.files[file_id]} changed since indexing; "
+              "rebuild the index with index_documents(force_rebuild=True)")
+        return False
+    
+    def _get_cross_encoder(self):
+        """Load the rerank cross-encoder on first use."""
+        if self._cross_encoder is None:
+            from sentence_transformers import CrossEncoder
+            
+            print("Loading rerank model...")
+            with self.stats.timer('rerank_model_load'):
+                self._cross_encoder = CrossEncoder(self.rerank_model or DEFAULT_RERANK_MODEL)
+        return self._cross_encoder
+    
+    def _rerank(
+        self,
+        query: str,
+        hits: List[Tuple[int, float]],
+    ) -> List[Tuple[int, float, Optional[float]]]:
+        """
+        Rescore the leading candidates with the cross-encoder in one batch.
+        
+        The per-pair cost observed on previous calls predicts how many
+        candidates fit in rerank_budget_ms. Under load the prediction grows,
+        so fewer candidates are rescored (the rest keep FAISS order), and the
+        stage is skipped entirely when fewer than two would fit.
+        """
+        count = len(hits)
+        if self.rerank_budget_ms is not None and self._rerank_ms_per_pair:
+            count = min(count, int(self.rerank_budget_ms / self._rerank_ms_per_pair))
+        
+        if count < 2:
+            self.stats.count('rerank_skipped')
+            return [(idx, relevance, None) for idx, relevance in hits]
+        if count < len(hits):
+            self.stats.count('rerank_truncated')
+        
+        encoder = self._get_cross_encoder()
+        head = hits[:count]
+        
+        start = time.perf_counter()
+        scores = encoder.predict(
+            [(query, self._chunk_content(idx)) for idx, _ in head],
+            batch_size=count,
+            show_progress_bar=False,
         )
+        elapsed = time.perf_counter() - start
+        if self.stats.enabled:
+            self.stats.add_time('rerank', elapsed)
+        self.stats.count('rerank_pairs', count)
+        
+        per_pair_ms = elapsed * 1000 / count
+        if self._rerank_ms_per_pair is None:
+            self._rerank_ms_per_pair = per_pair_ms
+        else:
+            self._rerank_ms_per_pair = 0.7 * self._rerank_ms_per_pair + 0.3 * per_pair_ms
         
-        # Gather results
-        results = []
-        for dist, idx in zip(distances[0], indices[0]):
-            if idx < len(self.documents):
-                results.append({
-                    'content': self.documents[idx],
-                    'metadata': self.metadata[idx],
-                    'relevance': float(1 / (1 + dist))  # Convert distance to relevance
-                })
-        
-        return results
+        reranked = sorted(
+            ((idx, relevance, float(score)) for (idx, relevance), score in zip(head, scores)),
+            key=lambda hit: hit[2],
+            reverse=True,
+        )
+        return reranked + [(idx, relevance, None) for idx, relevance in hits[count:]]
     
     def get_session_context(self, project_name: str = None) -> str:
         """Get comprehensive context for starting a session."""
+        return "\n".join(self.iter_session_context(project_name))
+    
+    def iter_session_context(self, project_name: str = None) -> Iterator[str]:
+        """
+        Yield the parts of the session context lazily.
+        
+        Joining the parts with newlines gives get_session_context(). Results
+        are grouped by document type using metadata only, and chunk text is
+        fetched as each part is yielded, so consumers with a size budget
+        can stop early.
+        """
         
         # Build context query
         if project_name:
@@ -177,96 +729,179 @@ class ContinuityRAG:
         else:
             query = "What are the active projects and recent work? What is the current state?"
         
-        # Retrieve relevant chunks
-        results = self.retrieve_context(query, top_k=10)
+        yield "=== CONTINUITY CONTEXT ===\n"
         
-        # Build context string
-        context_parts = ["=== CONTINUITY CONTEXT ===\n"]
+        # Retrieve relevant chunks
+        hits = self._ranked_hits(query, top_k=10)
         
         # Group by document type
         by_type = {}
-        for result in results:
-            doc_type = result['metadata']['type']
+        for idx, _, _ in hits:
+            by_type.setdefault(self.chunks.doc_type(idx), []).append(idx)
+        
+        sections = [
+            ('portfolio', "\n## Portfolio Context:", 2),      # Portfolio context first
+            ('project', "\n## Project Context:", 3),          # Project context
+            ('session', "\n## Recent Sessions:", 3),          # Recent session info
+            ('theory', "\n## Continuity Principles:", 2),     # Theory/principles
+        ]
+        for doc_type, heading, limit in sections:
             if doc_type not in by_type:
-                by_type[doc_type] = []
-            by_type[doc_type].append(result)
-        
-        # Portfolio context first
-        if 'portfolio' in by_type:
-            context_parts.append("\n## Portfolio Context:")
-            for r in by_type['portfolio'][:2]:
-                context_parts.append(f"\n{r['content']}\n")
-        
-        # Project context
-        if 'project' in by_type:
-            context_parts.append("\n## Project Context:")
-            for r in by_type['project'][:3]:
-                context_parts.append(f"\n{r['content']}\n")
-        
-        # Recent session info
-        if 'session' in by_type:
-            context_parts.append("\n## Recent Sessions:")
-            for r in by_type['session'][:3]:
-                context_parts.append(f"\n{r['content']}\n")
-        
-        # Theory/principles
-        if 'theory' in by_type:
-            context_parts.append("\n## Continuity Principles:")
-            for r in by_type['theory'][:2]:
-                context_parts.append(f"\n{r['content']}\n")
-        
-        context_parts.append("\n=== END CONTEXT ===")
-        
-        return "\n".join(context_parts)
+                continue
+            yield heading
+            for idx in by_type[doc_type][:limit]:
+                yield f"\n{self._chunk_content(idx)}\n"
+        
+        yield "\n=== END CONTEXT ==="
     
     def _save_index(self):
         """Save index and metadata to disk."""
         faiss.write_index(self.index, str(self.index_file))
         
+        self.chunks.save(self.chunks_file)
         with open(self.metadata_file, 'w') as f:
             json.dump({
-                'documents': self.documents,
-                'metadata': self.metadata
+                'version': 3,
+                'files': self.chunks.files,
+                'file_hashes': self.chunks.file_hashes,
             }, f)
     
-    def _load_index(self):
-        """Load index and metadata from disk."""
-        self.index = faiss.read_index(str(self.index_file))
+    def _load_index(self) -> bool:
+        """Load index and metadata from disk; False if they need a rebuild."""
+        with self.stats.timer('load'):
+            with open(self.metadata_file, 'r') as f:
+                data = json.load(f)
+            if data.get('version') != 3:
+                # Older indexes stored chunk text rather than byte spans
+                return False
+            
+            self.index = faiss.read_index(str(self.index_file))
+            self.chunks = ChunkTable.load(data['files'], data['file_hashes'], self.chunks_file)
+            self._verified_files = {}
+            self._drifted_files = set()
+        return True
+    
+    def get_stats(self, fmt: str = "dict"):
+        """
+        Return collected profiling stats.
+        
+        Args:
+            fmt: "dict", "json" (single log line) or "prometheus"
+        """
+        if fmt == "json":
+            return self.stats.to_json()
+        if fmt == "prometheus":
+            return self.stats.to_prometheus()
+        return self.stats.as_dict()
+
+
+class ExtractiveSummarizer:
+    """
+    Budget-sized extractive summaries using the shared embedding model.
+    
+    Text is split into lines and sentences, each unit is embedded, and
+    units are ranked by centrality (mean cosine similarity to the rest of
+    the document, measured against at most `max_reference_units` evenly
+    spaced units so long files stay linear). The most central units that
+    fit the budget are returned in their original order, so later
+    sections such as current status and next steps can survive where a
+    head-of-file cut would drop them.
+    """
+    
+    _SENTENCE_SPLIT = re.compile(r'(?<=[.!?])\s+(?=\S)')
+    
+    def __init__(self, model: Optional[SentenceTransformer] = None, max_reference_units: int = 512):
+        self.model = model or load_embedding_model()
+        self.max_reference_units = max_reference_units
+    
+    def _units(self, text: str) -> List[str]:
+        """Split text into lines, and long lines into sentences."""
+        units = []
+        for line in text.splitlines():
+            line = line.rstrip()
+            if not line.strip():
+                continue
+            if len(line) > 200:
+                units.extend(part for part in self._SENTENCE_SPLIT.split(line) if part.strip())
+            else:
+                units.append(line)
+        return units
+    
+    def summarize(self, text: str, max_chars: int) -> str:
+        """Return at most max_chars of the most central lines/sentences."""
+        if len(text) <= max_chars:
+            return text
+        
+        units = self._units(text)
+        if not units:
+            return text[:max_chars]
         
-        with open(self.metadata_file, 'r') as f:
-            data = json.load(f)
-            self.documents = data['documents']
-            self.metadata = data['metadata']
+        embeddings = np.asarray(
+            self.model.encode(units, batch_size=64, show_progress_bar=False, normalize_embeddings=True),
+            dtype='float32',
+        )
+        step = max(1, len(units) // self.max_reference_units)
+        reference = embeddings[::step]
+        centrality = (embeddings @ reference.T).mean(axis=1)
+        
+        # The first line is usually the document title; keep it
+        chosen = {0}
+        used = len(units[0]) + 1
+        for i in np.argsort(-centrality):
+            i = int(i)
+            if i in chosen:
+                continue
+            if max_chars - used < 20:
+                break
+            cost = len(units[i]) + 1
+            if used + cost > max_chars:
+                continue
+            chosen.add(i)
+            used += cost
+        
+        return "\n".join(units[i] for i in sorted(chosen))[:max_chars]
 
 
 def main():
     """Test the RAG system."""
-    import sys
+    args = sys.argv[1:]
+    profile = '--profile' in args
+    rerank = '--rerank' in args
+    args = [a for a in args if a not in ('--profile', '--rerank')]
     
-    if len(sys.argv) < 2:
-        print("Usage: python continuity_rag.py <docs_root> [query]")
+    if not args:
+        print("Usage: python continuity_rag.py [--profile] [--rerank] <docs_root> [query]")
         sys.exit(1)
     
-    docs_root = sys.argv[1]
-    rag = ContinuityRAG(docs_root)
+    docs_root = args[0]
+    rag = ContinuityRAG(
+        docs_root,
+        profile=profile,
+        rerank_model=DEFAULT_RERANK_MODEL if rerank else None,
+    )
     
     # Index documents
     rag.index_documents()
     
-    if len(sys.argv) > 2:
+    if len(args) > 1:
         # Run query
-        query = " ".join(sys.argv[2:])
+        query = " ".join(args[1:])
         print(f"\nQuery: {query}\n")
         results = rag.retrieve_context(query, top_k=3)
         
         for i, result in enumerate(results, 1):
             print(f"\n--- Result {i} (relevance: {result['relevance']:.3f}) ---")
+            if 'rerank_score' in result:
+                print(f"Rerank score: {result['rerank_score']:.3f}")
             print(f"File: {result['metadata']['file']}")
             print(f"Type: {result['metadata']['type']}")
             print(f"Content:\n{result['content'][:300]}...")
     else:
         # Get session context
         print("\n" + rag.get_session_context())
+    
+    if profile:
+        print("\n" + rag.get_stats("json"))
 
 
 if __name__ == "__main__":
@@ -11,11 +11,43 @@ echo ""
 MODEL_PATH="${MODEL_PATH:-./models/mistral-7b-continuity}"
 USE_GPU="${USE_GPU:-true}"
 QUANTIZE="${QUANTIZE:-true}"
+# Quantization of the transformers model on CPU: int8, int4 or none
+CPU_QUANTIZATION="${CPU_QUANTIZATION:-int8}"
+# Quantized models are saved here on the first start and memory-mapped on
+# later ones (empty: quantize on every start)
+CHECKPOINT_CACHE_DIR="${CHECKPOINT_CACHE_DIR-$HOME/.cache/continuity-orchestrator/checkpoints}"
 PORT="${PORT:-5000}"
-WORKERS="${WORKERS:-4}"
+# Each worker's threads share its batch scheduler. With PRELOAD=true the model
+# is loaded and warmed up once before the workers fork, and on CPU they share
+# that copy of the weights (on GPU every worker loads its own: keep WORKERS=1)
+WORKERS="${WORKERS:-1}"
+THREADS="${THREADS:-32}"
+PRELOAD="${PRELOAD:-true}"
+MAX_BATCH_SIZE="${MAX_BATCH_SIZE:-8}"
+# Speculative decoding (used only with MAX_BATCH_SIZE=1): a small draft model,
+# or drafts of up to PROMPT_LOOKUP_TOKENS tokens copied from the prompt (0: off)
+DRAFT_MODEL_PATH="${DRAFT_MODEL_PATH:-}"
+PROMPT_LOOKUP_TOKENS="${PROMPT_LOOKUP_TOKENS:-0}"
+# Requests waiting beyond the batch before 429, and the default deadline (seconds)
+MAX_QUEUE="${MAX_QUEUE:-32}"
+REQUEST_TIMEOUT="${REQUEST_TIMEOUT:-120}"
+# Cached /generate responses (0 disables); SEMANTIC_CACHE=true also serves them
+# to paraphrased prompts (installs sentence-transformers)
+RESPONSE_CACHE_SIZE="${RESPONSE_CACHE_SIZE:-1024}"
+RESPONSE_CACHE_TTL="${RESPONSE_CACHE_TTL:-3600}"
+SEMANTIC_CACHE="${SEMANTIC_CACHE:-false}"
+# Set ASGI=true to serve orchestrator_asgi.py with uvicorn instead
+ASGI="${ASGI:-false}"
+# Inference backend: auto serves a GGUF file (GGUF_PATH, default: found next to
+# MODEL_PATH, see convert_to_gguf.py) with llama.cpp when USE_GPU=false;
+# LLAMA_THREADS defaults to the cores split between workers
+BACKEND="${BACKEND:-auto}"
+GGUF_PATH="${GGUF_PATH:-}"
+CONTEXT_LENGTH="${CONTEXT_LENGTH:-4096}"
+LLAMA_THREADS="${LLAMA_THREADS:-0}"
 
 # Check if model exists
-if [ ! -d "$MODEL_PATH" ]; then
+if [ ! -d "$MODEL_PATH" ] && [ ! -f "$GGUF_PATH" ]; then
     echo "Error: Model not found at $MODEL_PATH"
     echo "Please upload your fine-tuned model to the VPS first"
     exit 1
@@ -43,7 +75,13 @@ echo ""
 echo "Step 3: Installing Python dependencies..."
 pip install --upgrade pip
 pip install -r ../requirements.txt
-pip install gunicorn flask-cors
+pip install gunicorn flask-cors uvicorn starlette
+if [ "$SEMANTIC_CACHE" = "true" ]; then
+    pip install sentence-transformers
+fi
+if [ "$USE_GPU" != "true" ] || [ "$BACKEND" = "llama.cpp" ]; then
+    pip install llama-cpp-python
+fi
 
 # Step 4: Check GPU availability
 echo ""
@@ -53,6 +91,11 @@ python3 -c "import torch; print(f'CUDA available: {torch.cuda.is_available()}')"
 # Step 5: Create systemd service
 echo ""
 echo "Step 5: Creating systemd service..."
+if [ "$ASGI" = "true" ]; then
+    EXEC_START="$(pwd)/venv/bin/uvicorn orchestrator_asgi:app --host 127.0.0.1 --port $PORT"
+else
+    EXEC_START="$(pwd)/venv/bin/gunicorn -c gunicorn.conf.py orchestrator_api:app"
+fi
 sudo tee /etc/systemd/system/orchestrator-vps.service > /dev/null << EOF
 [Unit]
 Description=Orchestrator VPS API
@@ -65,7 +108,25 @@ WorkingDirectory=$(pwd)
 Environment="MODEL_PATH=$MODEL_PATH"
 Environment="USE_GPU=$USE_GPU"
 Environment="QUANTIZE=$QUANTIZE"
-ExecStart=$(pwd)/venv/bin/gunicorn -w $WORKERS -b 127.0.0.1:$PORT orchestrator_api:app
+Environment="CPU_QUANTIZATION=$CPU_QUANTIZATION"
+Environment="CHECKPOINT_CACHE_DIR=$CHECKPOINT_CACHE_DIR"
+Environment="MAX_BATCH_SIZE=$MAX_BATCH_SIZE"
+Environment="DRAFT_MODEL_PATH=$DRAFT_MODEL_PATH"
+Environment="PROMPT_LOOKUP_TOKENS=$PROMPT_LOOKUP_TOKENS"
+Environment="BACKEND=$BACKEND"
+Environment="GGUF_PATH=$GGUF_PATH"
+Environment="CONTEXT_LENGTH=$CONTEXT_LENGTH"
+Environment="LLAMA_THREADS=$LLAMA_THREADS"
+Environment="MAX_QUEUE=$MAX_QUEUE"
+Environment="REQUEST_TIMEOUT=$REQUEST_TIMEOUT"
+Environment="PORT=$PORT"
+Environment="WORKERS=$WORKERS"
+Environment="THREADS=$THREADS"
+Environment="PRELOAD=$PRELOAD"
+Environment="RESPONSE_CACHE_SIZE=$RESPONSE_CACHE_SIZE"
+Environment="RESPONSE_CACHE_TTL=$RESPONSE_CACHE_TTL"
+Environment="SEMANTIC_CACHE=$SEMANTIC_CACHE"
+ExecStart=$EXEC_START
 Restart=always
 RestartSec=10
 
@@ -4,123 +4,667 @@ Automatically creates a comprehensive context prompt for GitHub Copilot
 to restore session memory across instances.
 """
 
+import os
+import re
 import sys
+import json
+import time
+import io
+import codecs
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from pathlib import Path
 from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
 
 # Add current dir to path for continuity_rag import
 sys.path.insert(0, str(Path(__file__).parent))
 
+from workspace_scanner import (
+    WorkspaceScan, scan_workspace, PROJECT_CONTEXT, SESSION_BRIEFING,
+)
+
 try:
-    from continuity_rag import ContinuityRAG
+    from continuity_rag import ContinuityRAG, ExtractiveSummarizer
     RAG_AVAILABLE = True
 except ImportError:
     RAG_AVAILABLE = False
     print("Warning: continuity_rag not available")
 
+# Rendered sections are cached here, relative to the workspace root
+CACHE_FILE = ".copilot_context_cache.json"
+CACHE_VERSION = 2
+
+# Extractive summaries, keyed by content hash and budget
+SUMMARY_CACHE_FILE = ".copilot_summary_cache.json"
+SUMMARY_CACHE_ENTRIES = 512
+
+# Threads used to read and render sections concurrently
+MAX_WORKERS = 8
+
+# --max-tokens: share of the budget per section group, and fitting knobs
+SECTION_WEIGHTS = {'portfolio': 0.2, 'projects': 0.35, 'briefings': 0.25, 'rag': 0.2}
+INITIAL_CHARS_PER_TOKEN = 4.0
+MIN_SECTION_CHARS = 200
+FIT_ROUNDS = 3
+TRIM_NOTE = "\n[...truncated...]"
+DEFAULT_TIKTOKEN_ENCODING = "cl100k_base"
+
+
+def _newline_decoder(encoding: str) -> io.IncrementalNewlineDecoder:
+    """Incremental decoder with universal newline translation (as in text mode)."""
+    return io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(), translate=True)
 
-def read_file_safe(file_path: Path) -> str:
-    """Safely read a file with fallback encoding."""
+
+def _decode_text(data: bytes) -> str:
+    """Decode file bytes as UTF-8, falling back to latin-1, with universal newlines."""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
+        text = data.decode('utf-8')
     except UnicodeDecodeError:
+        text = data.decode('latin-1')
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def read_file_bounded(file_path: Path, max_chars: int) -> Tuple[str, bool]:
+    """
+    Read at most max_chars characters from the start of a file.
+    
+    Only the bytes needed for the budget are read: each pass requests one
+    byte per character still missing, which is exact for ASCII and never
+    overshoots by more than a few bytes for multi-byte UTF-8. Decoding is
+    incremental with universal newlines (like text mode); if the data is
+    not valid UTF-8, the bytes already read are re-decoded as latin-1 and
+    reading continues in that encoding.
+    
+    Returns:
+        (text, truncated) where truncated is True if the file holds more
+        than max_chars characters
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            decoder = _newline_decoder('utf-8')
+            raw = bytearray()  # Kept until the encoding is settled
+            text = ""
+            consumed = 0
+            
+            while len(text) <= max_chars:
+                block = f.read(max_chars + 1 - len(text))
+                consumed += len(block)
+                if raw is not None:
+                    raw += block
+                try:
+                    text += decoder.decode(block, final=not block)
+                except UnicodeDecodeError:
+                    decoder = _newline_decoder('latin-1')
+                    text = decoder.decode(bytes(raw), final=not block)
+                    raw = None
+                if not block:
+                    break
+        
+        truncated = len(text) > max_chars or consumed < size
+        return text[:max_chars], truncated
+    except Exception as e:
+        return f"[Error reading file: {e}]", False
+
+
+class SummaryReader:
+    """
+    Drop-in replacement for read_file_bounded that returns an extractive
+    summary instead of the head of the file.
+    
+    Summaries are cached on disk by (content hash, budget), so each file
+    version is only summarized once regardless of its path or mtime.
+    Safe to call from the section thread pool.
+    """
+    
+    def __init__(self, cache_file: Path):
+        self.cache_file = cache_file
+        self.summarizer = None  # Loaded on the first cache miss
+        self.entries: Dict[str, str] = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        
+        if cache_file.exists():
+            try:
+                with open(cache_file, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+    
+    def __call__(self, file_path: Path, max_chars: int) -> Tuple[str, bool]:
         try:
-            with open(file_path, 'r', encoding='latin-1') as f:
-                return f.read()
+            with open(file_path, 'rb') as f:
+                data = f.read()
         except Exception as e:
-            return f"[Error reading file: {e}]"
-    except Exception as e:
-        return f"[Error: {e}]"
+            return f"[Error reading file: {e}]", False
+        
+        content = _decode_text(data)
+        if len(content) <= max_chars:
+            return content, False
+        
+        key = f"{hashlib.blake2b(data, digest_size=16).hexdigest()}:{max_chars}"
+        with self.lock:
+            summary = self.entries.pop(key, None)
+            if summary is not None:
+                self.entries[key] = summary  # Most recently used last
+                return summary, True
+        
+        with self.lock:
+            if self.summarizer is None:
+                self.summarizer = ExtractiveSummarizer()
+        summary = self.summarizer.summarize(content, max_chars)
+        with self.lock:
+            self.entries[key] = summary
+            while len(self.entries) > SUMMARY_CACHE_ENTRIES:
+                del self.entries[next(iter(self.entries))]
+            self.dirty = True
+        return summary, True
+    
+    def save(self):
+        """Write the summary cache back to disk if anything changed."""
+        if not self.dirty:
+            return
+        try:
+            with open(self.cache_file, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f)
+            self.dirty = False
+        except OSError as e:
+            print(f"⚠ Could not write summary cache: {e}")
 
 
-def generate_context_prompt(workspace_root: Path, project_filter: str = None) -> str:
-    """Generate comprehensive context prompt for Copilot."""
+class SectionCache:
+    """
+    On-disk cache of rendered prompt sections.
+    
+    Each entry stores the section text, whether its source was truncated,
+    and the (mtime, size, content hash) of every file it was built from.
+    An entry is reused while all of its files keep the same mtime and size;
+    if only the mtime moved (e.g. after a checkout) the hash decides, and
+    the entry is refreshed.
+    """
+    
+    def __init__(self, cache_file: Path, enabled: bool = True, scan: Optional[WorkspaceScan] = None):
+        self.cache_file = cache_file
+        self.enabled = enabled
+        self.scan = scan  # Stat info from the walk is reused when available
+        self.entries: Dict[str, Dict] = {}
+        self.touched = set()  # Keys read or written in this run
+        self.dirty = False
+        
+        if enabled and cache_file.exists():
+            try:
+                with open(cache_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == CACHE_VERSION:
+                    self.entries = data['sections']
+            except (OSError, ValueError, KeyError):
+                self.entries = {}
+    
+    def _signature(self, path: Path) -> Optional[List]:
+        scanned = self.scan.stat_of(path) if self.scan is not None else None
+        if scanned is not None:
+            return [scanned.mtime_ns, scanned.size]
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+    
+    @staticmethod
+    def _hash(path: Path) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
     
+    def get(self, key: str) -> Optional[Tuple[str, bool]]:
+        """Return the cached (text, truncated) for key if none of its files changed."""
+        if not self.enabled:
+            return None
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.touched.add(key)
+        
+        for name, (mtime_ns, size, digest) in entry['deps'].items():
+            path = Path(name)
+            signature = self._signature(path)
+            if signature is None:
+                return None
+            if signature == [mtime_ns, size]:
+                continue
+            if signature[1] != size or self._hash(path) != digest:
+                return None
+            # Same content, new mtime: refresh the entry
+            entry['deps'][name] = signature + [digest]
+            self.dirty = True
+        return entry['text'], entry['truncated']
+    
+    def put(self, key: str, deps: List[Path], text: str, truncated: bool = False):
+        """Store the text for key along with the signatures of its files."""
+        if not self.enabled:
+            return
+        dep_info = {}
+        for path in deps:
+            signature = self._signature(path)
+            if signature is None:
+                return  # Can't validate later, so don't cache
+            dep_info[str(path)] = signature + [self._hash(path)]
+        self.entries[key] = {'deps': dep_info, 'text': text, 'truncated': truncated}
+        self.touched.add(key)
+        self.dirty = True
+    
+    def prune(self, predicate):
+        """Drop entries not used in this run whose key matches predicate."""
+        stale = [key for key in self.entries if key not in self.touched and predicate(key)]
+        for key in stale:
+            del self.entries[key]
+        self.dirty = self.dirty or bool(stale)
+    
+    def save(self):
+        """Write the cache back to disk if anything changed."""
+        if not (self.enabled and self.dirty):
+            return
+        try:
+            with open(self.cache_file, 'w', encoding='utf-8') as f:
+                json.dump({'version': CACHE_VERSION, 'sections': self.entries}, f)
+            self.dirty = False
+        except OSError as e:
+            print(f"⚠ Could not write section cache: {e}")
+
+
+def render_portfolio_section(
+    portfolio_file: Path,
+    max_chars: int = 3000,
+    reader=read_file_bounded,
+) -> Tuple[str, bool]:
+    """Render the portfolio context section, returning (text, truncated)."""
     lines = []
-    lines.append("=" * 80)
-    lines.append("CONTINUITY CONTEXT INITIALIZATION")
-    lines.append(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    lines.append("=" * 80)
+    lines.append("## PORTFOLIO CONTEXT")
+    lines.append("-" * 80)
+    content, truncated = reader(portfolio_file, max_chars)  # First 3000 chars by default
+    lines.append(content)
+    if truncated:
+        lines.append("\n[...truncated for brevity...]")
     lines.append("")
-    lines.append("**Instructions for AI Assistant:**")
-    lines.append("Read and internalize the following context to restore continuity.")
-    lines.append("This represents the state of our collaborative work.")
+    return "\n".join(lines), truncated
+
+
+def render_project_section(
+    project_file: Path,
+    workspace_root: Path,
+    max_chars: int = 2000,
+    reader=read_file_bounded,
+) -> Tuple[str, bool]:
+    """Render the context block for one project, returning (text, truncated)."""
+    lines = []
+    project_name = project_file.parent.name
+    lines.append(f"\n### Project: {project_name}")
+    lines.append(f"Path: {project_file.relative_to(workspace_root)}")
     lines.append("")
     
-    # 1. Portfolio Context
-    portfolio_file = workspace_root / "PORTFOLIO_CONTEXT.md"
-    if portfolio_file.exists():
-        lines.append("## PORTFOLIO CONTEXT")
-        lines.append("-" * 80)
-        content = read_file_safe(portfolio_file)
-        lines.append(content[:3000])  # First 3000 chars
-        if len(content) > 3000:
-            lines.append("\n[...truncated for brevity...]")
-        lines.append("")
+    content, truncated = reader(project_file, max_chars)  # First 2000 chars per project by default
+    lines.append(content)
+    if truncated:
+        lines.append("\n[...see full file for details...]")
+    lines.append("")
+    return "\n".join(lines), truncated
+
+
+def render_briefing_section(
+    briefing: Path,
+    max_chars: int = 1500,
+    reader=read_file_bounded,
+) -> Tuple[str, bool]:
+    """Render one recent session briefing, returning (text, truncated)."""
+    lines = []
+    project_name = briefing.parent.name
+    lines.append(f"\n### {project_name} - {briefing.name}")
+    lines.append("")
     
-    # 2. Project-Specific Context
-    lines.append("## PROJECT CONTEXTS")
+    content, truncated = reader(briefing, max_chars)
+    lines.append(content)
+    if truncated:
+        lines.append("\n[...truncated...]")
+    lines.append("")
+    return "\n".join(lines), truncated
+
+
+def rag_index_files(workspace_root: Path) -> List[Path]:
+    """Files the RAG section depends on: the index and every indexed source."""
+    index_file = workspace_root / "continuity.index"
+    meta_file = workspace_root / "continuity.index.meta.json"
+    chunks_file = workspace_root / "continuity.index.chunks.npz"
+    if not (index_file.exists() and meta_file.exists()):
+        return []
+    
+    deps = [index_file, meta_file, chunks_file]
+    try:
+        with open(meta_file, 'r', encoding='utf-8') as f:
+            sources = json.load(f).get('files', [])
+    except (OSError, ValueError):
+        return []
+    return deps + [workspace_root / name for name in sources]
+
+
+def render_rag_section(body: str) -> str:
+    """Render the RAG-retrieved context section around its body text."""
+    lines = []
+    lines.append("## RAG-RETRIEVED RELEVANT CONTEXT")
     lines.append("-" * 80)
+    lines.append("")
+    lines.append(body)
+    lines.append("")
+    return "\n".join(lines)
+
+
+def open_rag_index(workspace_root: Path, scan: Optional[WorkspaceScan] = None) -> "ContinuityRAG":
+    """Load (or build) the workspace RAG index."""
+    rag = ContinuityRAG(str(workspace_root))
+    rag.index_documents(scan=scan)
+    return rag
+
+
+def retrieve_rag_context(
+    workspace_root: Path,
+    project_filter: str = None,
+    scan: Optional[WorkspaceScan] = None,
+    max_chars: int = 2000,
+    rag: Optional["ContinuityRAG"] = None,
+) -> Tuple[str, bool]:
+    """
+    Retrieve up to max_chars of session context from the RAG index,
+    returning (text, truncated).
+    """
+    if rag is None:
+        rag = open_rag_index(workspace_root, scan)
     
-    # Find all PROJECT_CONTEXT.md files
-    project_contexts = list(workspace_root.glob("**/PROJECT_CONTEXT.md"))
+    # Get session context, stopping once the char budget is filled
+    parts = []
+    size = 0
+    for part in rag.iter_session_context(project_filter):
+        parts.append(part)
+        size += len(part) + 1
+        if size >= max_chars:
+            break
+    text = "\n".join(parts)
+    return text[:max_chars], len(text) > max_chars
+
+
+def render_rag_context(
+    workspace_root: Path,
+    project_filter: str = None,
+    scan: Optional[WorkspaceScan] = None,
+    max_chars: int = 2000,
+    open_rag=None,
+) -> Tuple[str, bool]:
+    """
+    Render the RAG section, returning (text, truncated); raises
+    RAGUnavailable with a placeholder on failure.
+    """
+    try:
+        rag = open_rag() if open_rag is not None else None
+        body, truncated = retrieve_rag_context(workspace_root, project_filter, scan, max_chars, rag)
+        return render_rag_section(body), truncated
+    except Exception as e:
+        raise RAGUnavailable(render_rag_section(f"[RAG unavailable: {e}]")) from e
+
+
+class RAGUnavailable(Exception):
+    """Raised by render_rag_context; carries the placeholder section text."""
+
+
+class TokenCounter:
+    """
+    Counts tokens for budgeting.
     
-    if project_filter:
-        project_contexts = [p for p in project_contexts if project_filter.lower() in str(p).lower()]
+    `tokenizer` may be a local HF tokenizer.json (or a model directory
+    containing one, e.g. the fine-tuned Mistral) loaded with the fast
+    `tokenizers` library, or a tiktoken encoding name. Without either, a
+    word-piece estimate is used (about one token per 4 chars of a word,
+    one per punctuation mark).
+    """
+    
+    _PIECES = re.compile(r"\w+|[^\w\s]")
     
-    for project_file in project_contexts[:5]:  # Limit to 5 projects
-        project_name = project_file.parent.name
-        lines.append(f"\n### Project: {project_name}")
-        lines.append(f"Path: {project_file.relative_to(workspace_root)}")
-        lines.append("")
+    def __init__(self, tokenizer: Optional[str] = None):
+        self.name = "estimate"
+        self._count = None
         
-        content = read_file_safe(project_file)
-        lines.append(content[:2000])  # First 2000 chars per project
-        if len(content) > 2000:
-            lines.append("\n[...see full file for details...]")
-        lines.append("")
+        path = Path(tokenizer) if tokenizer else None
+        if path is not None and path.is_dir():
+            path = path / "tokenizer.json"
+        
+        try:
+            if path is not None and path.is_file():
+                from tokenizers import Tokenizer
+                tok = Tokenizer.from_file(str(path))
+                self._count = lambda text: len(tok.encode(text, add_special_tokens=False).ids)
+                self.name = str(path)
+            else:
+                import tiktoken
+                encoding = tiktoken.get_encoding(tokenizer or DEFAULT_TIKTOKEN_ENCODING)
+                self._count = lambda text: len(encoding.encode_ordinary(text))
+                self.name = f"tiktoken:{encoding.name}"
+        except Exception as e:
+            if tokenizer:
+                print(f"⚠ Tokenizer '{tokenizer}' unavailable ({e}); estimating tokens")
     
-    # 3. Recent Session Briefings
-    lines.append("## RECENT SESSION BRIEFINGS")
-    lines.append("-" * 80)
+    def count(self, text: str) -> int:
+        if self._count is not None:
+            return self._count(text)
+        return sum(1 + (len(piece) - 1) // 4 for piece in self._PIECES.findall(text))
+
+
+class PromptSection:
+    """One cacheable block of the prompt."""
     
-    session_briefings = sorted(
-        workspace_root.glob("**/SESSION_BRIEFING*.md"),
-        key=lambda p: p.stat().st_mtime,
-        reverse=True
-    )
+    __slots__ = ('key', 'group', 'deps', 'render', 'max_chars', 'default_chars')
     
-    for briefing in session_briefings[:3]:  # Most recent 3
-        project_name = briefing.parent.name
-        lines.append(f"\n### {project_name} - {briefing.name}")
-        lines.append("")
-        
-        content = read_file_safe(briefing)
-        lines.append(content[:1500])
-        if len(content) > 1500:
-            lines.append("\n[...truncated...]")
-        lines.append("")
+    def __init__(self, key: str, group: str, deps: Optional[List[Path]], render, max_chars: int):
+        self.key = key
+        self.group = group
+        self.deps = deps        # None: collected after rendering (RAG)
+        self.render = render    # render(max_chars) -> (text, truncated)
+        self.max_chars = max_chars
+        self.default_chars = max_chars
     
-    # 4. RAG-Retrieved Context (if available)
-    if RAG_AVAILABLE:
-        lines.append("## RAG-RETRIEVED RELEVANT CONTEXT")
-        lines.append("-" * 80)
-        lines.append("")
-        
+    @property
+    def cache_key(self) -> str:
+        if self.max_chars == self.default_chars:
+            return self.key
+        return f"{self.key}@{self.max_chars}"
+
+
+BUDGETED_KEY = re.compile(r"@\d+$")
+
+
+def _timed(func, *args):
+    """Run func(*args) and return (result, elapsed seconds)."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def _render_sections(
+    sections: List[PromptSection],
+    cache: SectionCache,
+    pool: ThreadPoolExecutor,
+    workspace_root: Path,
+    timings: Dict[str, Optional[float]],
+) -> Tuple[Dict[str, str], Set[str]]:
+    """
+    Render sections, serving unchanged ones from the cache.
+    
+    Returns the texts by key and the keys of sections whose source was
+    truncated to fit their max_chars. Misses are submitted to the pool in
+    list order, so the (slow) RAG section should come first; cache writes
+    stay on this thread.
+    """
+    texts = {}
+    truncated = set()
+    futures = {}
+    for section in sections:
+        cached = cache.get(section.cache_key)
+        if cached is None:
+            futures[section.key] = pool.submit(_timed, section.render, section.max_chars)
+            continue
+        texts[section.key], was_truncated = cached
+        timings[section.key] = None
+        if was_truncated:
+            truncated.add(section.key)
+    
+    for section in sections:
+        if section.key not in futures:
+            continue
         try:
-            rag = ContinuityRAG(str(workspace_root))
-            rag.index_documents()
+            (texts[section.key], was_truncated), timings[section.key] = futures[section.key].result()
+        except RAGUnavailable as e:
+            texts[section.key] = e.args[0]
+            continue
+        if was_truncated:
+            truncated.add(section.key)
+        # The RAG index may have just been built, so collect its deps now
+        deps = section.deps if section.deps is not None else rag_index_files(workspace_root)
+        if deps:
+            cache.put(section.cache_key, deps, texts[section.key], was_truncated)
+    return texts, truncated
+
+
+def _allocate_tokens(sections: List[PromptSection], available: int) -> Dict[str, float]:
+    """Split a token budget across groups by SECTION_WEIGHTS, evenly within a group."""
+    group_sizes: Dict[str, int] = {}
+    for section in sections:
+        group_sizes[section.group] = group_sizes.get(section.group, 0) + 1
+    total_weight = sum(SECTION_WEIGHTS[group] for group in group_sizes)
+    
+    return {
+        section.key: available * SECTION_WEIGHTS[section.group] / total_weight / group_sizes[section.group]
+        for section in sections
+    }
+
+
+def _trim_section(text: str, max_chars: int) -> str:
+    """
+    Cut a rendered section to about max_chars, marking the cut with
+    TRIM_NOTE. The cut falls at a line end when there is one in range and
+    mid-line otherwise; the heading (first non-blank line) is always kept.
+    """
+    heading_end = text.find("\n", len(text) - len(text.lstrip("\n")))
+    if heading_end == -1:
+        return text  # Heading only
+    limit = max(heading_end, max_chars - len(TRIM_NOTE))
+    if limit >= len(text):
+        return text
+    end = text.rfind("\n", heading_end, limit + 1)
+    return text[:end if end > heading_end else limit] + TRIM_NOTE
+
+
+def _fit_to_budget(
+    sections: List[PromptSection],
+    available: int,
+    counter: TokenCounter,
+    render_all,
+) -> Tuple[Dict[str, str], Dict[str, float]]:
+    """
+    Size every section so the prompt uses as much of the budget as is
+    useful without exceeding it.
+    
+    Sections start with a proportional token allocation converted to chars
+    at INITIAL_CHARS_PER_TOKEN. After rendering, each section is resized
+    from its measured tokens (its chars-per-token ratio at first, then the
+    slope between the last two renders, which accounts for the fixed
+    heading): sections over their allocation shrink, and the allocation
+    left unused by sections that fit entirely is handed to the ones that
+    were cut. If the estimates still overshoot, the largest sections are
+    trimmed (_trim_section) until the budget holds or only their headings
+    are left.
+    """
+    alloc = _allocate_tokens(sections, available)
+    for section in sections:
+        section.max_chars = max(MIN_SECTION_CHARS, int(alloc[section.key] * INITIAL_CHARS_PER_TOKEN))
+    texts, truncated = render_all(sections)
+    previous: Dict[str, Tuple[int, int]] = {}  # key -> (max_chars, tokens) of the last render
+    
+    for _ in range(FIT_ROUNDS):
+        used = {key: counter.count(text) for key, text in texts.items()}
+        cut = [s for s in sections if s.key in truncated]
+        spare = sum(
+            max(0.0, alloc[s.key] - used[s.key]) for s in sections if s not in cut
+        )
+        cut_alloc = sum(alloc[s.key] for s in cut)
+        
+        resized = []
+        for section in sections:
+            key = section.key
+            target = alloc[key]
+            if section in cut and cut_alloc:
+                target += spare * alloc[key] / cut_alloc
+            elif used[key] <= target:
+                continue
+            alloc[key] = target
             
-            # Get session context
-            rag_context = rag.get_session_context(project_filter)
-            lines.append(rag_context[:2000])
-            lines.append("")
-        except Exception as e:
-            lines.append(f"[RAG unavailable: {e}]")
-            lines.append("")
+            tokens_per_char = used[key] / max(1, len(texts[key]))
+            if key in previous:
+                last_chars, last_used = previous[key]
+                if last_chars != section.max_chars and last_used != used[key]:
+                    tokens_per_char = (used[key] - last_used) / (section.max_chars - last_chars)
+            previous[key] = (section.max_chars, used[key])
+            
+            step = (target - used[key]) / max(tokens_per_char, 1e-3)
+            max_chars = max(MIN_SECTION_CHARS, int(section.max_chars + step))
+            if max_chars != section.max_chars:
+                section.max_chars = max_chars
+                resized.append(section)
+        
+        for section in sections:
+            if section not in cut and section not in resized:
+                alloc[section.key] = used[section.key]  # Fits entirely; spare was handed out
+        if not resized:
+            break
+        new_texts, new_truncated = render_all(resized)
+        texts.update(new_texts)
+        truncated = (truncated - set(new_texts)) | new_truncated
     
-    # 5. Summary Instructions
+    # Guarantee the budget even if the ratio estimates were off
+    used = {key: counter.count(text) for key, text in texts.items()}
+    trimmable = set(texts)
+    while sum(used.values()) > available and trimmable:
+        excess = sum(used.values()) - available
+        key = max(trimmable, key=used.get)
+        keep = max(0.0, 1 - (excess + 1) / used[key])
+        trimmed = _trim_section(texts[key], int(len(texts[key]) * keep))
+        if len(trimmed) >= len(texts[key]):
+            trimmable.discard(key)  # Down to its heading
+            continue
+        texts[key] = trimmed
+        used[key] = counter.count(trimmed)
+    if sum(used.values()) > available:
+        print(f"⚠ Section headings alone exceed the token budget ({sum(used.values())} > {available} tokens)")
+    
+    return texts, alloc
+
+
+def _header_lines() -> List[str]:
+    lines = []
+    lines.append("=" * 80)
+    lines.append("CONTINUITY CONTEXT INITIALIZATION")
+    lines.append(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    lines.append("=" * 80)
+    lines.append("")
+    lines.append("**Instructions for AI Assistant:**")
+    lines.append("Read and internalize the following context to restore continuity.")
+    lines.append("This represents the state of our collaborative work.")
+    lines.append("")
+    return lines
+
+
+def _footer_lines() -> List[str]:
+    lines = []
     lines.append("=" * 80)
     lines.append("CONTEXT LOADED - READY FOR SESSION")
     lines.append("=" * 80)
@@ -136,6 +680,163 @@ def generate_context_prompt(workspace_root: Path, project_filter: str = None) ->
     lines.append("2. What the most recent work involved")
     lines.append("3. That you're ready to continue from where we left off")
     lines.append("")
+    return lines
+
+
+PROJECTS_HEADING = ["## PROJECT CONTEXTS", "-" * 80]
+BRIEFINGS_HEADING = ["## RECENT SESSION BRIEFINGS", "-" * 80]
+
+
+def generate_context_prompt(
+    workspace_root: Path,
+    project_filter: str = None,
+    use_cache: bool = True,
+    verbose: bool = False,
+    summarize: bool = False,
+    max_tokens: Optional[int] = None,
+    counter: Optional[TokenCounter] = None,
+) -> str:
+    """
+    Generate comprehensive context prompt for Copilot.
+    
+    Each section is cached in CACHE_FILE keyed by the files it was built
+    from, so a rerun only re-renders sections whose sources changed.
+    Sections that do need rendering are read concurrently on a thread
+    pool, with RAG retrieval started first so it overlaps the file reads;
+    the prompt is still assembled in a fixed order.
+    
+    With summarize=True, files over their budget are replaced by an
+    extractive summary (cached per content hash) instead of being cut.
+    
+    With max_tokens, the fixed char limits are replaced by a token budget
+    split across portfolio/project/briefing/RAG sections (SECTION_WEIGHTS)
+    and measured with `counter`; per-section usage is printed.
+    """
+    started = time.perf_counter()
+    timings: Dict[str, Optional[float]] = {}  # None marks a cache hit
+    
+    # One walk of the workspace feeds every section and the RAG indexer
+    scan, timings['scan'] = _timed(scan_workspace, workspace_root)
+    cache = SectionCache(workspace_root / CACHE_FILE, enabled=use_cache, scan=scan)
+    
+    reader = read_file_bounded
+    mode = ""
+    if summarize:
+        if RAG_AVAILABLE:
+            reader = SummaryReader(workspace_root / SUMMARY_CACHE_FILE)
+            mode = ":summary"
+        else:
+            print("⚠ Summaries need continuity_rag; falling back to truncation")
+    
+    # Plan the sections in output order
+    portfolio_sections = []
+    portfolio = scan.get("PORTFOLIO_CONTEXT.md")
+    if portfolio is not None:
+        portfolio_sections.append(PromptSection(
+            f"portfolio{mode}", "portfolio", [portfolio.path],
+            partial(render_portfolio_section, portfolio.path, reader=reader), 3000,
+        ))
+    
+    # Find all PROJECT_CONTEXT.md files
+    project_contexts = [f.path for f in scan.by_kind(PROJECT_CONTEXT)]
+    
+    if project_filter:
+        project_contexts = [p for p in project_contexts if project_filter.lower() in str(p).lower()]
+    
+    project_sections = [
+        PromptSection(
+            f"project:{project_file}{mode}", "projects", [project_file],
+            partial(render_project_section, project_file, workspace_root, reader=reader), 2000,
+        )
+        for project_file in project_contexts[:5]  # Limit to 5 projects
+    ]
+    
+    session_briefings = [
+        f.path for f in sorted(scan.by_kind(SESSION_BRIEFING), key=lambda f: f.mtime, reverse=True)
+    ]
+    
+    briefing_sections = [
+        PromptSection(
+            f"briefing:{briefing}{mode}", "briefings", [briefing],
+            partial(render_briefing_section, briefing, reader=reader), 1500,
+        )
+        for briefing in session_briefings[:3]  # Most recent 3
+    ]
+    
+    rag_sections = []
+    if RAG_AVAILABLE:
+        # Opened on first render only, then reused if the budget re-renders it
+        open_rag = lru_cache(maxsize=1)(partial(open_rag_index, workspace_root, scan))
+        rag_sections.append(PromptSection(
+            f"rag:{project_filter or ''}", "rag", None,
+            partial(render_rag_context, workspace_root, project_filter, scan, open_rag=open_rag), 2000,
+        ))
+    
+    # RAG is the slowest section, so it goes to the pool first
+    sections = rag_sections + portfolio_sections + project_sections + briefing_sections
+    header = _header_lines()
+    footer = _footer_lines()
+    
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        render_all = partial(
+            _render_sections, cache=cache, pool=pool,
+            workspace_root=workspace_root, timings=timings,
+        )
+        if max_tokens is None:
+            texts, _ = render_all(sections)
+        else:
+            counter = counter or TokenCounter()
+            fixed = "\n".join(header + PROJECTS_HEADING + BRIEFINGS_HEADING + footer)
+            overhead = counter.count(fixed) + len(sections)
+            if overhead >= max_tokens:
+                print(f"⚠ --max-tokens {max_tokens} leaves no room after the fixed text ({overhead} tokens)")
+            available = max(0, max_tokens - overhead)
+            texts, alloc = _fit_to_budget(sections, available, counter, render_all)
+    
+    # Sizes chosen for other budgets (or older file versions) won't be hit again
+    cache.prune(lambda key: BUDGETED_KEY.search(key) is not None)
+    cache.save()
+    if isinstance(reader, SummaryReader):
+        reader.save()
+    
+    lines = header
+    
+    # 1. Portfolio Context
+    for section in portfolio_sections:
+        lines.append(texts[section.key])
+    
+    # 2. Project-Specific Context
+    lines.extend(PROJECTS_HEADING)
+    for section in project_sections:
+        lines.append(texts[section.key])
+    
+    # 3. Recent Session Briefings
+    lines.extend(BRIEFINGS_HEADING)
+    for section in briefing_sections:
+        lines.append(texts[section.key])
+    
+    # 4. RAG-Retrieved Context (if available)
+    for section in rag_sections:
+        lines.append(texts[section.key])
+    
+    # 5. Summary Instructions
+    lines.extend(footer)
+    
+    if verbose:
+        print("\nTiming breakdown:")
+        for key, seconds in timings.items():
+            label = "cached" if seconds is None else f"{seconds * 1000:8.1f} ms"
+            print(f"  {label:>12}  {key}")
+        total = f"{(time.perf_counter() - started) * 1000:8.1f} ms"
+        print(f"  {total:>12}  total")
+    
+    if max_tokens is not None:
+        print(f"\nToken budget ({counter.name}): {max_tokens}")
+        print(f"  {'used':>7} {'alloc':>7}  section")
+        for section in portfolio_sections + project_sections + briefing_sections + rag_sections:
+            used = counter.count(texts[section.key])
+            print(f"  {used:>7} {int(alloc[section.key]):>7}  {section.key}")
+        print(f"  {counter.count(chr(10).join(lines)):>7} {max_tokens:>7}  total")
     
     return "\n".join(lines)
 
@@ -149,6 +850,14 @@ def main():
     parser.add_argument("--project", help="Filter for specific project")
     parser.add_argument("--output", default="COPILOT_CONTEXT.txt", help="Output file")
     parser.add_argument("--clipboard", action="store_true", help="Copy to clipboard")
+    parser.add_argument("--no-cache", action="store_true", help="Re-render every section")
+    parser.add_argument("--verbose", action="store_true", help="Print a per-section timing breakdown")
+    parser.add_argument("--summarize", action="store_true",
+                        help="Use cached extractive summaries instead of truncating long files")
+    parser.add_argument("--max-tokens", type=int,
+                        help="Token budget for the whole prompt, split across sections")
+    parser.add_argument("--tokenizer",
+                        help="tokenizer.json / model dir, or tiktoken encoding (default: cl100k_base)")
     
     args = parser.parse_args()
     
@@ -158,8 +867,18 @@ def main():
     if args.project:
         print(f"Filtering for project: {args.project}")
     
+    counter = TokenCounter(args.tokenizer)
+    
     # Generate context
-    context = generate_context_prompt(workspace_root, args.project)
+    context = generate_context_prompt(
+        workspace_root,
+        args.project,
+        use_cache=not args.no_cache,
+        verbose=args.verbose,
+        summarize=args.summarize,
+        max_tokens=args.max_tokens,
+        counter=counter,
+    )
     
     # Write to file
     output_file = workspace_root / args.output
@@ -167,7 +886,7 @@ def main():
         f.write(context)
     
     print(f"\n✓ Context written to: {output_file}")
-    print(f"  ({len(context)} characters)")
+    print(f"  ({len(context)} characters, {counter.count(context)} tokens via {counter.name})")
     
     # Copy to clipboard if requested
     if args.clipboard:
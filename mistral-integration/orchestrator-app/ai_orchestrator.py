@@ -4,20 +4,106 @@ AI Orchestrator - Mistral 7B Integration
 This module provides the core AI orchestration functionality for the desktop app,
 using fine-tuned Mistral 7B for continuity-aware conversations.
 
-Hardware: Optimized for RTX 2080 (8GB VRAM)
+Hardware: Optimized for RTX 2080 (8GB VRAM); int8/int4 quantization on CPU-only machines
 Framework: Transformers with 4-bit quantization
 """
 
 import torch
+import transformers
+from packaging import version
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     BitsAndBytesConfig,
+    DynamicCache,
+    StoppingCriteriaList,
     pipeline,
 )
-from typing import List, Dict, Optional
+from typing import Any, Callable, List, Dict, Optional, Tuple
+import copy
 import json
 import os
+import threading
+import time
+
+from checkpoint_cache import DEFAULT_CACHE_DIR, CheckpointCache, cpu_quantization_config, load_quantized_model
+from cpu_quantization import CPU_QUANTIZATION, INT8, quantize_for_cpu
+from generation_utils import SpeculationStats, StopWhen
+
+# Model quantization: bitsandbytes NF4 on the GPU, or one of the CPU modes
+# (auto: NF4 with CUDA, int8 without)
+QUANTIZATION = ('auto', 'nf4') + CPU_QUANTIZATION
+
+# First release whose generate() takes a draft model with its own tokenizer
+ASSISTANT_TOKENIZER_MIN_TRANSFORMERS = "4.46.0"
+
+
+class SequenceCache:
+    """
+    KV cache for a token sequence.
+    
+    Any prompt that starts with the same tokens can resume from it instead
+    of prefilling them again.
+    """
+    
+    def __init__(self, input_ids: torch.Tensor, cache: DynamicCache):
+        self.input_ids = input_ids  # 1-D token ids the cache was built from
+        self.cache = cache
+    
+    def common_length(self, input_ids: torch.Tensor) -> int:
+        """
+        Number of leading tokens of input_ids (1-D) this cache covers.
+        
+        At least one prompt token is always left for generate() to prefill.
+        """
+        n = min(len(self.input_ids), self.cache.get_seq_length(), len(input_ids) - 1)
+        if n <= 0:
+            return 0
+        mismatch = (self.input_ids[:n] != input_ids[:n]).nonzero()
+        return int(mismatch[0]) if len(mismatch) else n
+
+
+class ConversationSession:
+    """
+    State of one conversation: history, running summary and KV cache.
+    
+    Sessions share the orchestrator's model; the lock keeps one generation
+    at a time per session so its history stays in order.
+    """
+    
+    def __init__(self, session_id: str = "default", history: Optional[List[Dict[str, str]]] = None):
+        self.session_id = session_id
+        self.history: List[Dict[str, str]] = history if history is not None else []
+        self.summary = ""           # Summary of history entries before summarized_upto
+        self.summarized_upto = 0
+        self.kv_cache: Optional[SequenceCache] = None  # Previous turn's prompt + response
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+    
+    def reset(self, history: Optional[List[Dict[str, str]]] = None):
+        """Replace the history and drop everything derived from it."""
+        self.history = history if history is not None else []
+        self.summary = ""
+        self.summarized_upto = 0
+        self.kv_cache = None
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Serializable state (the KV cache is rebuilt on demand instead)."""
+        return {
+            'session_id': self.session_id,
+            'history': self.history,
+            'summary': self.summary,
+            'summarized_upto': self.summarized_upto,
+            'last_used': self.last_used,
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ConversationSession":
+        session = cls(data['session_id'], data.get('history', []))
+        session.summary = data.get('summary', "")
+        session.summarized_upto = data.get('summarized_upto', 0)
+        session.last_used = data.get('last_used', session.last_used)
+        return session
 
 
 class MistralOrchestrator:
@@ -28,6 +114,14 @@ class MistralOrchestrator:
         model_path: str,
         max_memory_gb: int = 7,
         device_map: str = "auto",
+        use_prefix_cache: bool = True,
+        use_conversation_cache: bool = True,
+        max_context_tokens: Optional[int] = 8192,
+        summarize_evicted: bool = False,
+        draft_model_path: Optional[str] = None,
+        prompt_lookup_tokens: Optional[int] = None,
+        quantization: str = "auto",
+        checkpoint_cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
     ):
         """
         Initialize the Mistral orchestrator.
@@ -36,37 +130,154 @@ class MistralOrchestrator:
             model_path: Path to fine-tuned model or HuggingFace model name
             max_memory_gb: Maximum memory to use (default: 7GB for 8GB VRAM)
             device_map: Device mapping strategy
+            use_prefix_cache: Reuse the KV cache of the system prompt across requests
+            use_conversation_cache: Resume each turn from the previous turn's KV cache
+            max_context_tokens: Prompt + response token budget; history that doesn't
+                fit is dropped oldest first (None: limit by turn count only)
+            summarize_evicted: Keep a running summary of turns dropped from the window
+            draft_model_path: Small model that drafts tokens for this one to
+                verify several at a time (speculative decoding); None to
+                decode one token per forward pass
+            prompt_lookup_tokens: Instead of a draft model, draft up to this
+                many tokens by copying what followed the latest earlier
+                occurrence of the last few tokens in the prompt (prompt
+                lookup decoding: free drafts for answers that quote the
+                context); None to turn off
+            quantization: One of QUANTIZATION: "nf4" loads 4-bit with
+                bitsandbytes (CUDA only); "int8", "int4" and "none" load
+                on the CPU (see cpu_quantization.py); "auto" picks "nf4"
+                with CUDA and "int8" without
+            checkpoint_cache_dir: Where the quantized model is saved on
+                the first start and loaded from on later ones (see
+                checkpoint_cache.py); None to quantize on every start
+                
+        Raises:
+            ValueError: If both a draft model and prompt lookup are given,
+                the quantization is unknown, or the draft model's tokenizer
+                differs and transformers is older than
+                ASSISTANT_TOKENIZER_MIN_TRANSFORMERS
         """
+        if draft_model_path and prompt_lookup_tokens:
+            raise ValueError("Use either a draft model or prompt lookup decoding, not both")
+        if quantization not in QUANTIZATION:
+            raise ValueError(f"Quantization must be one of {', '.join(QUANTIZATION)}, not {quantization!r}")
+        if quantization == 'auto':
+            quantization = 'nf4' if torch.cuda.is_available() else INT8
+        
         self.model_path = model_path
         self.max_memory_gb = max_memory_gb
         self.device_map = device_map
+        self.quantization = quantization
+        self.checkpoint_cache = CheckpointCache(checkpoint_cache_dir) if checkpoint_cache_dir else None
+        
+        # KV caches reused across requests: the system prompt prefix, kept as
+        # (prefix text, cache), and each session's previous turn
+        self.use_prefix_cache = use_prefix_cache
+        self.use_conversation_cache = use_conversation_cache
+        self._prefix: Optional[Tuple[str, SequenceCache]] = None
+        # Queue workers (--max-concurrent) prepare generations concurrently
+        self._prefix_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.kv_cache_stats = {
+            'prefix_hits': 0,
+            'prefix_misses': 0,
+            'conversation_hits': 0,
+            'reused_tokens': 0,
+            'prefilled_tokens': 0,
+        }
         
         # Initialize model and tokenizer
         self._load_model()
         
-        # Conversation history
-        self.conversation_history: List[Dict[str, str]] = []
+        # Speculative decoding: the draft model (or prompt lookup) proposes a
+        # few tokens, the model checks them all in one forward pass and keeps
+        # the prefix it agrees with (same output distribution, fewer slow passes)
+        self.draft_model_path = draft_model_path
+        self.draft_model = None
+        self.draft_tokenizer = None  # Set only if its vocabulary differs
+        if draft_model_path:
+            self._load_draft_model()
+        self.prompt_lookup_tokens = prompt_lookup_tokens or None
+        # Acceptance counters (None without speculative decoding)
+        self.speculation = (
+            SpeculationStats(self.model) if draft_model_path or self.prompt_lookup_tokens else None
+        )
+        
+        # Default conversation (methods take a session to serve others)
+        self.session = ConversationSession()
         self.max_history_turns = 12  # Keep last 12 turns
+        # The window start advances this many entries at a time, so the
+        # prompt keeps the same token prefix (and KV cache) for several turns
+        self.history_window_step = 4
         
+        # Token budget for the window (capped by the model's context length)
+        model_context = getattr(self.model.config, 'max_position_embeddings', None)
+        if max_context_tokens is not None and model_context:
+            max_context_tokens = min(max_context_tokens, model_context)
+        self.max_context_tokens = max_context_tokens
+        self._token_counts: Dict[str, int] = {}  # Formatted text -> token count
+        
+        # Running summary of turns that left the window (kept per session)
+        self.summarize_evicted = summarize_evicted
+        self.summary_max_tokens = 128
+        
+    @property
+    def conversation_history(self) -> List[Dict[str, str]]:
+        """History of the default session."""
+        return self.session.history
+    
+    @conversation_history.setter
+    def conversation_history(self, history: List[Dict[str, str]]):
+        self.session.history = history
+    
     def _load_model(self):
-        """Load model with 4-bit quantization for 8GB VRAM."""
-        print(f"Loading model from {self.model_path}...")
-        
-        # Configure 4-bit quantization
-        bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16,
-        )
+        """Load model with 4-bit quantization for 8GB VRAM (or quantized for the CPU)."""
+        print(f"Loading model from {self.model_path} (quantization: {self.quantization})...")
+        start = time.perf_counter()
         
-        # Load model
-        self.model = AutoModelForCausalLM.from_pretrained(
+        if self.quantization == 'nf4':
+            # Configure 4-bit quantization
+            bnb_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            )
+            quant_config = bnb_config.to_dict()
+            load_kwargs = dict(
+                device_map=self.device_map,
+                max_memory={0: f"{self.max_memory_gb}GB"},
+            )
+            
+            def create():
+                # Load model
+                return AutoModelForCausalLM.from_pretrained(
+                    self.model_path,
+                    quantization_config=bnb_config,
+                    trust_remote_code=True,
+                    **load_kwargs,
+                )
+        else:
+            quant_config = cpu_quantization_config(self.quantization)
+            load_kwargs = {}
+            
+            def create():
+                # CPU: load in float32, then swap the Linear layers for int8/int4 ones
+                model = AutoModelForCausalLM.from_pretrained(
+                    self.model_path,
+                    device_map="cpu",
+                    torch_dtype=torch.float32,
+                    trust_remote_code=True,
+                )
+                return quantize_for_cpu(model, self.quantization)
+        
+        # Quantized on the first start, loaded ready-made afterwards
+        self.model, self.checkpoint_status = load_quantized_model(
+            self.checkpoint_cache,
             self.model_path,
-            quantization_config=bnb_config,
-            device_map=self.device_map,
-            trust_remote_code=True,
-            max_memory={0: f"{self.max_memory_gb}GB"},
+            quant_config,
+            create,
+            **load_kwargs,
         )
         
         # Load tokenizer
@@ -78,34 +289,74 @@ class MistralOrchestrator:
         if self.tokenizer.pad_token is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
             
+        # Sampling settings shared by the pipeline and direct generate() calls
+        self.sampling_kwargs = dict(
+            do_sample=True,
+            temperature=0.7,
+            top_p=0.95,
+            repetition_penalty=1.15,
+        )
+        
         # Create pipeline
         self.pipe = pipeline(
             "text-generation",
             model=self.model,
             tokenizer=self.tokenizer,
             max_new_tokens=512,
-            do_sample=True,
-            temperature=0.7,
-            top_p=0.95,
-            repetition_penalty=1.15,
+            **self.sampling_kwargs,
         )
         
-        print("Model loaded successfully!")
+        self.load_time = time.perf_counter() - start
+        print(f"Model loaded successfully! ({self.load_time:.1f}s, checkpoint cache: {self.checkpoint_status})")
+    
+    def _load_draft_model(self):
+        """Load the speculative decoding draft model next to the main model."""
+        print(f"Loading draft model from {self.draft_model_path}...")
         
-    def format_prompt(self, user_message: str, system_context: str = "") -> str:
-        """
-        Format prompt with conversation history and continuity context.
+        draft_tokenizer = AutoTokenizer.from_pretrained(
+            self.draft_model_path,
+            trust_remote_code=True,
+        )
+        if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+            if version.parse(transformers.__version__) < version.parse(ASSISTANT_TOKENIZER_MIN_TRANSFORMERS):
+                raise ValueError(
+                    f"Draft model {self.draft_model_path} has a different tokenizer, which needs "
+                    f"transformers>={ASSISTANT_TOKENIZER_MIN_TRANSFORMERS} (installed: {transformers.__version__})"
+                )
+            # generate() re-tokenizes drafts between the two vocabularies
+            self.draft_tokenizer = draft_tokenizer
         
-        Uses Mistral instruction format: <s>[INST] {system_prompt}\n\n{message} [/INST] {response}</s>
-        Includes up to max_history_turns of conversation history to maintain context
-        while preventing token overflow.
+        on_gpu = self.model.device.type == 'cuda'
+        self.draft_model = AutoModelForCausalLM.from_pretrained(
+            self.draft_model_path,
+            device_map=self.device_map if on_gpu else "cpu",
+            torch_dtype=torch.float16 if on_gpu else torch.float32,
+            trust_remote_code=True,
+        )
+        
+        print("Draft model loaded successfully!")
+    
+    @property
+    def speculative_kwargs(self) -> Dict[str, Any]:
+        """generate() arguments that turn speculative decoding on (empty when off)."""
+        if self.prompt_lookup_tokens:
+            return {'prompt_lookup_num_tokens': self.prompt_lookup_tokens}
+        if self.draft_model is None:
+            return {}
+        kwargs: Dict[str, Any] = {'assistant_model': self.draft_model}
+        if self.draft_tokenizer is not None:
+            kwargs.update(tokenizer=self.tokenizer, assistant_tokenizer=self.draft_tokenizer)
+        return kwargs
+    
+    def format_system_prefix(self, system_context: str = "") -> str:
+        """
+        Format the constant start of every prompt: BOS, [INST] and the system prompt.
         
         Args:
-            user_message: Current user message
             system_context: Additional system context (from SESSION_BRIEFING, etc.)
             
         Returns:
-            Formatted prompt string in Mistral instruction format
+            Prompt prefix shared by all turns with the same system context
         """
         # Base system prompt
         system_prompt = """You are an AI assistant trained in continuity theory and consciousness principles.
@@ -115,27 +366,365 @@ You help coordinate the orchestrator ecosystem across desktop, VPS, and mobile c
         if system_context:
             system_prompt += f"\n\nCurrent Context:\n{system_context}"
         
+        return f"<s>[INST] {system_prompt}"
+    
+    @staticmethod
+    def _format_turn(turn: Dict[str, str]) -> str:
+        """Format one history entry as it appears in the prompt."""
+        if turn['role'] == 'user':
+            return f"\n{turn['content']}"
+        return f"[/INST] {turn['content']}</s><s>[INST]"
+    
+    def count_tokens(self, text: str) -> int:
+        """
+        Count the tokens of a prompt fragment, memoized by text.
+        
+        History entries are counted once, not on every request.
+        """
+        count = self._token_counts.get(text)
+        if count is None:
+            if len(self._token_counts) > 4096:
+                self._token_counts.clear()
+            count = len(self.tokenizer(text, add_special_tokens=False).input_ids)
+            self._token_counts[text] = count
+        return count
+    
+    def _history_budget(self, prefix: str, user_message: str, max_new_tokens: int) -> Optional[int]:
+        """Tokens left for history after the system prompt, message, summary and response."""
+        if self.max_context_tokens is None:
+            return None
+        reserved = (
+            self.count_tokens(prefix)
+            + self.count_tokens(f"\n{user_message}[/INST]")
+            + max_new_tokens
+        )
+        if self.summarize_evicted:
+            reserved += self.summary_max_tokens + 16  # Summary plus its heading
+        return max(0, self.max_context_tokens - reserved)
+    
+    def _history_start(self, history: List[Dict[str, str]], token_budget: Optional[int] = None) -> int:
+        """
+        Index of the first history entry inside the window.
+        
+        The window holds at most max_history_turns entries and, given a
+        budget, at most token_budget tokens. Its start only moves in whole
+        history_window_step increments.
+        """
+        step = max(1, self.history_window_step)
+        
+        start = 0
+        overflow = len(history) - self.max_history_turns
+        if overflow > 0:
+            start = -(-overflow // step) * step  # Round up to a whole step
+        
+        if token_budget is not None:
+            sizes = [self.count_tokens(self._format_turn(turn)) for turn in history]
+            total = sum(sizes[start:])
+            while start < len(history) and total > token_budget:
+                total -= sum(sizes[start:start + step])
+                start += step
+        return min(start, len(history))
+    
+    def _summarize_turns(self, summary: str, turns: List[Dict[str, str]]) -> str:
+        """
+        Fold turns into a running summary with one greedy generation.
+        
+        Args:
+            summary: Summary so far (may be empty)
+            turns: History entries leaving the window
+            
+        Returns:
+            Updated summary text
+        """
+        transcript = "\n".join(f"{turn['role'].title()}: {turn['content']}" for turn in turns)
+        previous = f"Summary so far:\n{summary}\n\n" if summary else ""
+        prompt = (
+            "<s>[INST] Summarize this conversation in a few sentences. Keep names, "
+            f"decisions and open tasks.\n\n{previous}{transcript} [/INST]"
+        )
+        inputs = self.tokenizer(prompt, return_tensors="pt", add_special_tokens=False).to(self.model.device)
+        with torch.no_grad():
+            output_ids = self.model.generate(
+                **inputs,
+                max_new_tokens=self.summary_max_tokens,
+                do_sample=False,
+                repetition_penalty=self.sampling_kwargs['repetition_penalty'],
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        return self.tokenizer.decode(
+            output_ids[0, inputs['input_ids'].shape[1]:],
+            skip_special_tokens=True,
+        ).strip()
+    
+    def update_history_summary(
+        self,
+        user_message: str,
+        system_context: str = "",
+        max_new_tokens: int = 512,
+        session: Optional[ConversationSession] = None,
+    ):
+        """
+        Summarize history entries that the next prompt's window drops.
+        
+        Args:
+            user_message: Next user message
+            system_context: Additional system context
+            max_new_tokens: Tokens reserved for the next response
+            session: Conversation to update (default: self.session)
+        """
+        session = session or self.session
+        if len(session.history) < session.summarized_upto:
+            # History was replaced; the summary no longer applies
+            session.summary = ""
+            session.summarized_upto = 0
+        
+        budget = self._history_budget(
+            self.format_system_prefix(system_context), user_message, max_new_tokens,
+        )
+        start = self._history_start(session.history, budget)
+        if start > session.summarized_upto:
+            session.summary = self._summarize_turns(
+                session.summary,
+                session.history[session.summarized_upto:start],
+            )
+            session.summarized_upto = start
+    
+    def format_prompt(
+        self,
+        user_message: str,
+        system_context: str = "",
+        max_new_tokens: int = 512,
+        session: Optional[ConversationSession] = None,
+    ) -> str:
+        """
+        Format prompt with conversation history and continuity context.
+        
+        Uses Mistral instruction format: <s>[INST] {system_prompt}\n\n{message} [/INST] {response}</s>
+        Includes the most recent history that fits both max_history_turns and
+        max_context_tokens (less the system prompt, the message and
+        max_new_tokens for the response). The window start jumps ahead by
+        history_window_step entries rather than sliding every turn. With
+        summarize_evicted, the running summary of dropped turns follows the
+        system prompt.
+        
+        Args:
+            user_message: Current user message
+            system_context: Additional system context (from SESSION_BRIEFING, etc.)
+            max_new_tokens: Tokens reserved for the response
+            session: Conversation to continue (default: self.session)
+            
+        Returns:
+            Formatted prompt string in Mistral instruction format
+        """
+        session = session or self.session
+        
         # Build conversation with history
-        messages = [f"<s>[INST] {system_prompt}"]
+        prefix = self.format_system_prefix(system_context)
+        messages = [prefix]
         
         # Add conversation history (limited to prevent context overflow)
-        history_to_use = self.conversation_history[-self.max_history_turns:]
-        for turn in history_to_use:
-            if turn['role'] == 'user':
-                messages.append(f"\n{turn['content']}")
-            else:
-                messages.append(f"[/INST] {turn['content']}</s><s>[INST]")
+        history = session.history
+        start = self._history_start(history, self._history_budget(prefix, user_message, max_new_tokens))
+        if self.summarize_evicted and session.summary and start > 0:
+            messages.append(f"\n\nEarlier in this conversation:\n{session.summary}")
+        for turn in history[start:]:
+            messages.append(self._format_turn(turn))
         
         # Add current message
         messages.append(f"\n{user_message}[/INST]")
         
         return "".join(messages)
     
+    def _prefix_cache(self, prefix: str) -> SequenceCache:
+        """
+        Return the KV cache of the system prompt prefix.
+        
+        Computed once per distinct prefix, i.e. recomputed when the system
+        context changes. Built under a lock, so concurrent requests compute
+        it once and never see one that is being replaced.
+        
+        Args:
+            prefix: Prompt prefix from format_system_prefix
+            
+        Returns:
+            Cache covering the prefix tokens
+        """
+        with self._prefix_lock:
+            cached = self._prefix
+            if cached is not None and cached[0] == prefix:
+                return cached[1]
+            
+            prefix_ids = self.tokenizer(
+                prefix, return_tensors="pt", add_special_tokens=False,
+            ).input_ids.to(self.model.device)
+            with torch.no_grad():
+                cache = self.model(
+                    input_ids=prefix_ids,
+                    past_key_values=DynamicCache(),
+                    use_cache=True,
+                ).past_key_values
+            
+            entry = SequenceCache(prefix_ids[0], cache)
+            self._prefix = (prefix, entry)
+        self._count(prefix_misses=1)
+        return entry
+    
+    def _count(self, **increments: int):
+        """Add to kv_cache_stats (shared by concurrent requests)."""
+        with self._stats_lock:
+            for name, value in increments.items():
+                self.kv_cache_stats[name] += value
+    
+    def kv_cache_metrics(self) -> Dict[str, int]:
+        """Snapshot of the KV cache reuse counters."""
+        with self._stats_lock:
+            return dict(self.kv_cache_stats)
+    
+    @staticmethod
+    def _crop_cache(cache: DynamicCache, length: int) -> Optional[DynamicCache]:
+        """Crop cache to its first length tokens (None if it can't be cropped)."""
+        excess = cache.get_seq_length() - length
+        try:
+            if excess > 0:
+                cache.crop(-excess)  # Negative: number of tokens to remove
+        except (RuntimeError, ValueError):
+            # e.g. a sliding-window layer that already dropped older tokens
+            return None
+        return cache
+    
+    def prepare_generation(
+        self,
+        user_message: str,
+        system_context: str = "",
+        max_new_tokens: int = 512,
+        session: Optional[ConversationSession] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+        **generate_kwargs: Any,
+    ) -> Dict[str, Any]:
+        """
+        Build model.generate() arguments for the next turn.
+        
+        The prompt is tokenized as-is (it already starts with <s>) and
+        resumed from whichever cache shares the longest token prefix with
+        it: the previous turn's (covering the history, so only the new
+        message is prefilled) or the system prompt's (after the history
+        window slid or the conversation was cleared). Matching is done on
+        token ids, so a cache is never applied to text it wasn't built from.
+        
+        With speculative decoding (a draft model or prompt lookup) the whole
+        prompt is prefilled: assisted generation runs its first forward pass over every prompt token, so
+        a cache given to it would hold the reused prefix twice.
+        
+        Args:
+            user_message: Current user message
+            system_context: Additional system context
+            max_new_tokens: Maximum tokens to generate
+            session: Conversation to continue (default: self.session)
+            should_stop: Called every token; generation ends early once it
+                returns True (e.g. the request was cancelled)
+            **generate_kwargs: Extra generate() arguments (e.g. streamer)
+            
+        Returns:
+            Keyword arguments for generate_ids / self.model.generate
+        """
+        session = session or self.session
+        if self.summarize_evicted:
+            self.update_history_summary(user_message, system_context, max_new_tokens, session)
+        
+        prompt = self.format_prompt(user_message, system_context, max_new_tokens, session)
+        inputs = self.tokenizer(
+            prompt, return_tensors="pt", add_special_tokens=False,
+        ).to(self.model.device)
+        input_ids = inputs['input_ids'][0]
+        
+        if self.max_context_tokens is not None and len(input_ids) + max_new_tokens > self.max_context_tokens:
+            print(
+                f"⚠ Prompt ({len(input_ids)} tokens) + max_new_tokens ({max_new_tokens}) "
+                f"exceeds max_context_tokens ({self.max_context_tokens}) even without history"
+            )
+        
+        speculative = self.speculative_kwargs
+        conversation = session.kv_cache if self.use_conversation_cache and not speculative else None
+        conversation_length = conversation.common_length(input_ids) if conversation is not None else 0
+        
+        prefix = None
+        prefix_length = 0
+        if self.use_prefix_cache and not speculative:
+            prefix = self._prefix_cache(self.format_system_prefix(system_context))
+            prefix_length = prefix.common_length(input_ids)
+        
+        past = None
+        reused = 0
+        if conversation_length > prefix_length:
+            # Take over the previous turn's cache and drop the tokens that differ
+            session.kv_cache = None
+            past = self._crop_cache(conversation.cache, conversation_length)
+            if past is not None:
+                reused = conversation_length
+                self._count(conversation_hits=1)
+        
+        if past is None and prefix_length:
+            # generate() extends the cache it is given, so keep the original intact
+            past = copy.deepcopy(prefix.cache)
+            reused = prefix_length
+            self._count(prefix_hits=1)
+        
+        self._count(reused_tokens=reused, prefilled_tokens=len(input_ids) - reused)
+        
+        kwargs = dict(
+            inputs,
+            max_new_tokens=max_new_tokens,
+            pad_token_id=self.tokenizer.pad_token_id,
+            **self.sampling_kwargs,
+        )
+        if past is not None:
+            kwargs['past_key_values'] = past
+        if should_stop is not None:
+            kwargs['stopping_criteria'] = StoppingCriteriaList([StopWhen(should_stop)])
+        kwargs.update(speculative)
+        kwargs.update(generate_kwargs)
+        return kwargs
+    
+    def generate_ids(
+        self,
+        generation_kwargs: Dict[str, Any],
+        session: Optional[ConversationSession] = None,
+    ) -> torch.Tensor:
+        """
+        Run model.generate() and keep its KV cache for the session's next turn.
+        
+        Args:
+            generation_kwargs: Arguments from prepare_generation
+            session: Conversation the turn belongs to (default: self.session)
+            
+        Returns:
+            Token ids of the prompt followed by the generated tokens
+        """
+        session = session or self.session
+        if self.speculation is None:
+            with torch.no_grad():
+                output = self.model.generate(**generation_kwargs, return_dict_in_generate=True)
+        else:
+            prompt_length = generation_kwargs['input_ids'].shape[1]
+            with self.speculation.track(prompt_length) as counter, torch.no_grad():
+                stopping_criteria = StoppingCriteriaList(generation_kwargs.get('stopping_criteria', []))
+                stopping_criteria.append(counter)
+                output = self.model.generate(
+                    **{**generation_kwargs, 'stopping_criteria': stopping_criteria},
+                    return_dict_in_generate=True,
+                )
+        
+        if self.use_conversation_cache and self.speculation is None and output.past_key_values is not None:
+            session.kv_cache = SequenceCache(output.sequences[0], output.past_key_values)
+        return output.sequences
+    
     def generate_response(
         self,
         user_message: str,
         system_context: str = "",
         max_new_tokens: int = 512,
+        session: Optional[ConversationSession] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
     ) -> str:
         """
         Generate response to user message.
@@ -144,33 +733,57 @@ You help coordinate the orchestrator ecosystem across desktop, VPS, and mobile c
             user_message: User's message
             system_context: Additional context from continuity system
             max_new_tokens: Maximum tokens to generate
+            session: Conversation to continue (default: self.session)
+            should_stop: Called every token; once it returns True generation
+                ends and the partial response is not added to the history
             
         Returns:
             Generated response
         """
-        # Format prompt
-        prompt = self.format_prompt(user_message, system_context)
+        session = session or self.session
         
-        # Generate
-        outputs = self.pipe(
-            prompt,
-            max_new_tokens=max_new_tokens,
-            return_full_text=False,
+        # Format and tokenize prompt, resuming from a cached KV prefix
+        kwargs = self.prepare_generation(
+            user_message, system_context, max_new_tokens, session, should_stop=should_stop,
         )
         
-        response = outputs[0]['generated_text'].strip()
+        # Generate
+        output_ids = self.generate_ids(kwargs, session)
+        
+        prompt_length = kwargs['input_ids'].shape[1]
+        response = self.tokenizer.decode(
+            output_ids[0, prompt_length:],
+            skip_special_tokens=True,
+        ).strip()
+        
+        if should_stop is not None and should_stop():
+            # Interrupted: keep the half-finished turn out of the history
+            return response
         
         # Update conversation history
-        self.conversation_history.append({
+        self.record_turn(user_message, response, session)
+        
+        return response
+    
+    def record_turn(self, user_message: str, response: str, session: Optional[ConversationSession] = None):
+        """
+        Append a user message and its response to a session's history.
+        
+        Args:
+            user_message: User's message
+            response: Generated response
+            session: Conversation the turn belongs to (default: self.session)
+        """
+        session = session or self.session
+        session.history.append({
             'role': 'user',
             'content': user_message,
         })
-        self.conversation_history.append({
+        session.history.append({
             'role': 'assistant',
             'content': response,
         })
-        
-        return response
+        session.last_used = time.time()
     
     def load_session_context(self, briefing_path: str) -> str:
         """
@@ -189,29 +802,40 @@ You help coordinate the orchestrator ecosystem across desktop, VPS, and mobile c
         except FileNotFoundError:
             return ""
     
-    def save_conversation(self, output_path: str):
+    def save_conversation(self, output_path: str, session: Optional[ConversationSession] = None):
         """
         Save conversation history to JSON.
         
         Args:
             output_path: Path to save conversation
+            session: Conversation to save (default: self.session)
         """
+        session = session or self.session
         with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(self.conversation_history, f, indent=2)
+            json.dump(session.history, f, indent=2)
     
-    def load_conversation(self, input_path: str):
+    def load_conversation(self, input_path: str, session: Optional[ConversationSession] = None):
         """
         Load conversation history from JSON.
         
         Args:
             input_path: Path to load conversation from
+            session: Conversation to replace (default: self.session)
         """
+        session = session or self.session
         if os.path.exists(input_path):
             with open(input_path, 'r', encoding='utf-8') as f:
-                self.conversation_history = json.load(f)
+                session.reset(json.load(f))
+    
+    def clear_conversation(self, session: Optional[ConversationSession] = None):
+        """Forget a session's history, its summary and its KV cache."""
+        (session or self.session).reset()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
     
     def clear_cache(self):
-        """Clear GPU cache to free memory."""
+        """Drop the default session's KV cache and clear GPU cache to free memory."""
+        self.session.kv_cache = None
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
 
@@ -236,8 +860,7 @@ if __name__ == "__main__":
         if user_input.lower() == 'quit':
             break
         elif user_input.lower() == 'clear':
-            orchestrator.conversation_history = []
-            orchestrator.clear_cache()
+            orchestrator.clear_conversation()
             print("Conversation cleared!")
             continue
         
@@ -0,0 +1,130 @@
+"""
+Benchmark CPU quantization against float32.
+
+Loads the model on the CPU in float32 and with its Linear layers quantized
+to int8 (dynamic) and int4 (weight-only), then generates the continuity
+dataset's prompts one at a time with each. Reports the weights' memory,
+the time quantization took, tokens/sec, latency and how often the next
+token the quantized model ranks first is the float32 model's (a cheap
+proxy for lost quality).
+
+    python benchmark_quantization.py                  # tiny random model
+    python benchmark_quantization.py --model ./models/mistral-7b-continuity
+
+Without --model the tiny random Mistral from benchmark_batching.py is
+used. Quantization pays off when reading weights dominates each decoding
+step, i.e. for large models; a random model's near-uniform logits also make
+its agreement column a check of the mechanism, not of quality.
+"""
+
+import argparse
+import copy
+import os
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from cpu_quantization import CPU_QUANTIZATION, quantize_for_cpu, weights_size_mb
+
+# Shared with the VPS batching benchmark
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'orchestrator-vps'))
+from benchmark_batching import build_tiny_model, load_prompts
+
+
+def next_token_ids(model, tokenizer, prompts: List[str]) -> torch.Tensor:
+    """The token model ranks first after each position of each prompt."""
+    ids = []
+    with torch.no_grad():
+        for prompt in prompts:
+            inputs = tokenizer(prompt, return_tensors='pt')
+            ids.append(model(**inputs).logits.argmax(-1).flatten())
+    return torch.cat(ids)
+
+
+def run(model, tokenizer, prompts: List[str], max_new_tokens: int) -> Dict:
+    """
+    Generate every prompt in turn (greedy, so modes are comparable).
+    
+    Returns:
+        Dictionary with throughput and latency figures
+    """
+    latencies = []
+    tokens = 0
+    start = time.perf_counter()
+    for prompt in prompts:
+        inputs = tokenizer(prompt, return_tensors='pt')
+        began = time.perf_counter()
+        with torch.no_grad():
+            output = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.pad_token_id,
+            )
+        latencies.append(time.perf_counter() - began)
+        tokens += output.shape[1] - inputs.input_ids.shape[1]
+    wall = time.perf_counter() - start
+    
+    return {
+        'tokens': tokens,
+        'tok_per_s': tokens / wall,
+        'p50_ms': statistics.median(latencies) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CPU quantization")
+    parser.add_argument('--model', help='Model path (default: tiny random Mistral)')
+    parser.add_argument('--modes', nargs='+', default=list(CPU_QUANTIZATION), choices=CPU_QUANTIZATION)
+    parser.add_argument('--prompts', type=int, default=8, help='Dataset prompts to generate')
+    parser.add_argument('--max-new-tokens', type=int, default=64)
+    parser.add_argument('--hidden-size', type=int, default=512, help='Tiny model width')
+    parser.add_argument('--layers', type=int, default=8, help='Tiny model depth')
+    args = parser.parse_args()
+    
+    if args.model:
+        tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        
+        def load_float32():
+            return AutoModelForCausalLM.from_pretrained(
+                args.model,
+                device_map="cpu",
+                torch_dtype=torch.float32,
+                trust_remote_code=True,
+            ).eval()
+        print(f"Model: {args.model} (CPU, {torch.get_num_threads()} threads)")
+    else:
+        base, tokenizer = build_tiny_model(args.hidden_size, args.layers)
+        
+        def load_float32():
+            return copy.deepcopy(base)
+        print(f"Model: tiny random Mistral (hidden {args.hidden_size}, {args.layers} layers), "
+              f"{torch.get_num_threads()} threads")
+    
+    prompts = load_prompts()[:args.prompts]
+    reference = next_token_ids(load_float32(), tokenizer, prompts)
+    
+    print(f"\n{'mode':<6} {'weights MB':>11} {'quant s':>8} {'tok/s':>8} {'p50 ms':>8} {'agree':>7}")
+    for mode in args.modes:
+        model = load_float32()
+        began = time.perf_counter()
+        quantize_for_cpu(model, mode)
+        quantize_seconds = time.perf_counter() - began
+        
+        run(model, tokenizer, prompts[:1], 8)  # Warm up
+        result = run(model, tokenizer, prompts, args.max_new_tokens)
+        agreement = (next_token_ids(model, tokenizer, prompts) == reference).float().mean().item()
+        
+        print(f"{mode:<6} {weights_size_mb(model):>11.0f} {quantize_seconds:>8.2f} {result['tok_per_s']:>8.1f} "
+              f"{result['p50_ms']:>8.0f} {agreement:>7.0%}")
+        del model
+
+
+if __name__ == "__main__":
+    main()
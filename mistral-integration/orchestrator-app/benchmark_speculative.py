@@ -0,0 +1,155 @@
+"""
+Benchmark speculative decoding against plain decoding.
+
+Generates the continuity dataset's prompts one at a time: normally, with
+a draft model proposing tokens for the model to verify, and with prompt
+lookup (drafts copied from the prompt). Reports tokens/sec, latency, how
+many tokens each forward pass of the model produced and the share of
+drafted tokens it accepted.
+
+    python benchmark_speculative.py                   # tiny random models
+    python benchmark_speculative.py --model ./models/mistral-7b-continuity \\
+        --draft-model ./models/draft --context ../../SESSION_BRIEFING.md
+
+--context puts a file in front of every prompt, like the desktop app's
+session briefing: prompt lookup pays off when answers quote such context.
+
+Without --model the tiny random Mistral from benchmark_batching.py is used,
+with its upper layers damped so that a draft made of its first layers
+(sharing its embeddings and output head) agrees with it often enough to
+exercise the acceptance path offline. Tiny models are bound by per-step
+overhead rather than by reading their weights, so expect tokens per pass
+to rise there but not tokens/sec; the speedup comes with a large model and
+a draft that agrees with it. A random model repeats its context only by
+accident (e.g. greedy loops), so its prompt lookup row is a check of the
+mechanism, not of how often real answers quote.
+"""
+
+import argparse
+import copy
+import os
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+import torch
+from transformers import AutoModelForCausalLM, StoppingCriteriaList
+
+from generation_utils import SpeculationStats
+
+# Shared with the VPS batching benchmark
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'orchestrator-vps'))
+from benchmark_batching import build_tiny_model, load_model, load_prompts
+
+
+def damp_upper_layers(model, layers: int, scale: float = 0.1):
+    """Shrink what the layers above the first ones add to the residual stream."""
+    with torch.no_grad():
+        for layer in model.model.layers[layers:]:
+            layer.self_attn.o_proj.weight.mul_(scale)
+            layer.mlp.down_proj.weight.mul_(scale)
+
+
+def build_truncated_draft(model, layers: int):
+    """Draft model made of the first layers of model (same embeddings and head)."""
+    config = copy.deepcopy(model.config)
+    config.num_hidden_layers = layers
+    draft = type(model)(config).eval()
+    draft.load_state_dict(model.state_dict(), strict=False)
+    # Random logits are nearly uniform, so transformers' default confidence
+    # threshold would end every draft after one token
+    draft.generation_config.assistant_confidence_threshold = 0.0
+    return draft
+
+
+def run(model, tokenizer, prompts: List[str], generate_kwargs: Dict) -> Dict:
+    """
+    Generate every prompt in turn.
+
+    Returns:
+        Dictionary with throughput, latency and SpeculationStats metrics
+    """
+    speculation = SpeculationStats(model)
+    latencies = []
+    tokens = 0
+    start = time.perf_counter()
+    for prompt in prompts:
+        inputs = tokenizer(prompt, return_tensors='pt').to(model.device)
+        began = time.perf_counter()
+        with speculation.track(inputs.input_ids.shape[1]) as counter, torch.no_grad():
+            output = model.generate(
+                **inputs,
+                pad_token_id=tokenizer.pad_token_id,
+                stopping_criteria=StoppingCriteriaList([counter]),
+                **generate_kwargs,
+            )
+        latencies.append(time.perf_counter() - began)
+        tokens += output.shape[1] - inputs.input_ids.shape[1]
+    wall = time.perf_counter() - start
+
+    return {
+        'tokens': tokens,
+        'tok_per_s': tokens / wall,
+        'p50_ms': statistics.median(latencies) * 1000,
+        **speculation.metrics(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark speculative decoding")
+    parser.add_argument('--model', help='Model path (default: tiny random Mistral)')
+    parser.add_argument('--draft-model', help='Draft model path (default with --model: none)')
+    parser.add_argument('--draft-layers', type=int, default=2, help='Layers of the tiny model kept for its draft')
+    parser.add_argument('--lookup-tokens', type=int, default=10, help='Prompt lookup draft length (0 skips the mode)')
+    parser.add_argument('--context', help='File put in front of every prompt (first 2000 characters)')
+    parser.add_argument('--prompts', type=int, default=8, help='Dataset prompts to generate')
+    parser.add_argument('--max-new-tokens', type=int, default=128)
+    parser.add_argument('--greedy', action='store_true', help='Greedy decoding instead of sampling')
+    parser.add_argument('--hidden-size', type=int, default=512, help='Tiny model width')
+    parser.add_argument('--layers', type=int, default=8, help='Tiny model depth')
+    args = parser.parse_args()
+
+    draft = None
+    if args.model:
+        model, tokenizer = load_model(args.model)
+        print(f"Model: {args.model}")
+        if args.draft_model:
+            draft = AutoModelForCausalLM.from_pretrained(
+                args.draft_model,
+                torch_dtype=model.dtype,
+                trust_remote_code=True,
+            ).to(model.device).eval()
+            print(f"Draft: {args.draft_model}")
+    else:
+        model, tokenizer = build_tiny_model(args.hidden_size, args.layers)
+        damp_upper_layers(model, args.draft_layers)
+        draft = build_truncated_draft(model, args.draft_layers)
+        print(f"Model: tiny random Mistral (hidden {args.hidden_size}, {args.layers} layers), "
+              f"draft: its first {args.draft_layers} layers")
+
+    prompts = load_prompts()[:args.prompts]
+    if args.context:
+        with open(args.context, encoding='utf-8') as f:
+            context = f.read()[:2000]  # As MistralOrchestrator.load_session_context
+        prompts = [prompt.replace("[INST] ", f"[INST] {context}\n\n", 1) for prompt in prompts]
+    sampling = {'do_sample': False} if args.greedy else {'do_sample': True, 'temperature': 0.7, 'top_p': 0.95}
+    base = dict(max_new_tokens=args.max_new_tokens, **sampling)
+    modes = [('plain', base)]
+    if draft is not None:
+        modes.append(('draft', dict(base, assistant_model=draft)))
+    if args.lookup_tokens:
+        modes.append(('lookup', dict(base, prompt_lookup_num_tokens=args.lookup_tokens)))
+
+    run(model, tokenizer, prompts[:1], base)  # Warm up
+
+    print(f"\n{'mode':<8} {'tokens':>7} {'tok/s':>8} {'p50 ms':>8} {'tok/pass':>9} {'accepted':>9}")
+    for mode, generate_kwargs in modes:
+        torch.manual_seed(0)
+        result = run(model, tokenizer, prompts, generate_kwargs)
+        print(f"{mode:<8} {result['tokens']:>7} {result['tok_per_s']:>8.1f} {result['p50_ms']:>8.0f} "
+              f"{result['tokens_per_pass']:>9.2f} {result['acceptance_rate']:>9.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Checkpoint Cache - Quantize a model once, memory-map it on later starts
+
+Loading the fine-tuned checkpoint used to quantize it again on every
+start: to NF4 with bitsandbytes, or on a CPU to float32 (~28GB for 7B)
+and then int8/int4 (cpu_quantization.py). The first start now saves the
+quantized model in a cache directory, keyed by the checkpoint's version
+and the quantization config, and later starts load it from there:
+
+    nf4        save_pretrained() with serialized 4-bit weights, loaded by
+               from_pretrained() without quantizing again
+    int8/int4  model.safetensors of the quantized tensors, memory-mapped
+               into a model skeleton whose weights are never allocated in
+               float32 (int4 tensors stay file-backed and shared through
+               the page cache; int8 weights are repacked for fbgemm)
+
+The checkpoint's version is model_version() (response_cache.py), a hash
+of its files' sizes and modification times rather than of their contents,
+so checking for a hit does not read the weights. Entries for an older
+version of a model are removed when the new one is saved.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import torch
+import transformers
+from accelerate import init_empty_weights
+from safetensors.torch import load_file, save_file
+from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+
+from cpu_quantization import INT4, INT4_GROUP_SIZE, NONE, load_quantized_state_dict, quantized_state_dict
+from response_cache import model_version
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'continuity-orchestrator', 'checkpoints')
+
+# How a model was loaded (reported in /info and /model/info)
+HIT = 'hit'
+SAVED = 'saved'
+MISS = 'miss'  # Quantized, but could not be saved
+OFF = 'off'
+
+METADATA_FILE = 'checkpoint.json'
+WEIGHTS_FILE = 'model.safetensors'
+WEIGHTS_EXTENSIONS = ('.safetensors', '.bin')  # Also save_pretrained() shards
+
+
+def cpu_quantization_config(mode: str) -> Optional[Dict[str, Any]]:
+    """Cache key settings of a CPU quantization mode (None: float32, nothing to cache)."""
+    if mode == NONE:
+        return None
+    config = {'cpu_quantization': mode}
+    if mode == INT4:
+        config['group_size'] = INT4_GROUP_SIZE
+    return config
+
+
+class CheckpointCache:
+    """Quantized models on disk, by checkpoint version and quantization config."""
+    
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+    
+    def path(self, model_path: str, quant_config: Dict[str, Any]) -> str:
+        """Directory of a checkpoint quantized with quant_config."""
+        key = json.dumps({
+            'model': model_version(model_path),
+            'quantization': quant_config,
+            # Serialization formats follow the libraries
+            'torch': torch.__version__,
+            'transformers': transformers.__version__,
+        }, sort_keys=True, default=str)
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest()[:16])
+    
+    def load(self, model_path: str, quant_config: Dict[str, Any], **load_kwargs) -> Optional[Any]:
+        """
+        Load a cached quantized model.
+        
+        Args:
+            model_path: Original checkpoint
+            quant_config: Quantization settings it was saved with
+            load_kwargs: from_pretrained() arguments for an NF4 model
+                (device map, memory limits)
+                
+        Returns:
+            The model, or None if it is not cached (or fails to load)
+        """
+        path = self.path(model_path, quant_config)
+        if not os.path.exists(os.path.join(path, METADATA_FILE)):
+            return None
+        
+        try:
+            if 'cpu_quantization' not in quant_config:
+                # The quantization config is in the saved config.json
+                return AutoModelForCausalLM.from_pretrained(path, trust_remote_code=True, **load_kwargs)
+            
+            config = AutoConfig.from_pretrained(path, trust_remote_code=True)
+            with init_empty_weights():
+                model = AutoModelForCausalLM.from_config(config, torch_dtype=torch.float32, trust_remote_code=True)
+            load_quantized_state_dict(model, load_file(os.path.join(path, WEIGHTS_FILE)))
+            if os.path.exists(os.path.join(path, 'generation_config.json')):
+                model.generation_config = GenerationConfig.from_pretrained(path)
+            return model.eval()
+        except Exception as e:
+            print(f"⚠ Cached checkpoint {path} failed to load ({e}); quantizing again")
+            return None
+    
+    def save(self, model, model_path: str, quant_config: Dict[str, Any]) -> bool:
+        """
+        Save a quantized model (best effort: failures only print a warning).
+        
+        Args:
+            model: Model quantized with quant_config
+            model_path: Original checkpoint
+            quant_config: Quantization settings
+            
+        Returns:
+            Whether the model is now cached
+        """
+        path = self.path(model_path, quant_config)
+        # Written aside and renamed, so a reader never sees half an entry
+        # (concurrent savers: the first rename wins)
+        staging = f"{path}.tmp-{os.getpid()}"
+        try:
+            if 'cpu_quantization' in quant_config:
+                model.config.save_pretrained(staging)
+                model.generation_config.save_pretrained(staging)
+                save_file(quantized_state_dict(model), os.path.join(staging, WEIGHTS_FILE))
+            else:
+                model.save_pretrained(staging)
+            # Older bitsandbytes/transformers skip 4-bit weights with only a warning
+            if not any(name.endswith(WEIGHTS_EXTENSIONS) for name in os.listdir(staging)):
+                raise RuntimeError("no weights were written (bitsandbytes too old to serialize 4-bit weights?)")
+            
+            with open(os.path.join(staging, METADATA_FILE), 'w', encoding='utf-8') as f:
+                json.dump({
+                    'model_path': os.path.abspath(model_path),
+                    'model_version': model_version(model_path),
+                    'quantization': quant_config,
+                    'created': time.time(),
+                }, f, indent=2, default=str)
+            
+            if os.path.exists(path):
+                shutil.rmtree(staging)
+            else:
+                os.replace(staging, path)
+        except Exception as e:
+            print(f"⚠ Could not cache the quantized checkpoint in {path}: {e}")
+            shutil.rmtree(staging, ignore_errors=True)
+            return False
+        
+        print(f"Saved quantized checkpoint to {path}")
+        self._prune(path, model_path, quant_config)
+        return True
+    
+    def _prune(self, keep: str, model_path: str, quant_config: Dict[str, Any]):
+        """
+        Remove the model's other entries that are stale: saved from another
+        version of it, or with the same quantization by other libraries.
+        """
+        model_path = os.path.abspath(model_path)
+        version = model_version(model_path)
+        quant_config = json.loads(json.dumps(quant_config, default=str))  # As stored
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if entry == keep:
+                continue
+            try:
+                with open(os.path.join(entry, METADATA_FILE), encoding='utf-8') as f:
+                    metadata = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if metadata.get('model_path') != model_path:
+                continue
+            if metadata.get('model_version') != version or metadata.get('quantization') == quant_config:
+                shutil.rmtree(entry, ignore_errors=True)
+
+
+def load_quantized_model(
+    cache: Optional[CheckpointCache],
+    model_path: str,
+    quant_config: Optional[Dict[str, Any]],
+    create: Callable[[], Any],
+    **load_kwargs,
+) -> Tuple[Any, str]:
+    """
+    Load a quantized model through the cache.
+    
+    Args:
+        cache: Checkpoint cache (None: always create)
+        model_path: Original checkpoint
+        quant_config: Quantization settings (None: not quantized, nothing
+            to cache)
+        create: Loads and quantizes the model from model_path
+        load_kwargs: from_pretrained() arguments for a cached NF4 model
+        
+    Returns:
+        (model, HIT, SAVED, MISS or OFF)
+    """
+    if cache is None or quant_config is None:
+        return create(), OFF
+    
+    model = cache.load(model_path, quant_config, **load_kwargs)
+    if model is not None:
+        print(f"Loaded quantized checkpoint from {cache.path(model_path, quant_config)}")
+        return model, HIT
+    
+    model = create()
+    return model, SAVED if cache.save(model, model_path, quant_config) else MISS
@@ -0,0 +1,115 @@
+"""
+Generation Utilities - generate() helpers shared by both orchestrators
+
+StopWhen ends a generate() call when a callback says so (request timeouts
+and client disconnects). SpeculationStats counts how many drafted tokens
+speculative decoding (draft model or prompt lookup) gets accepted.
+"""
+
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator
+
+import torch
+from transformers import StoppingCriteria
+
+
+class StopWhen(StoppingCriteria):
+    """Stop generate() as soon as a callback returns True (checked every token)."""
+    
+    def __init__(self, should_stop: Callable[[], bool]):
+        self.should_stop = should_stop
+    
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.should_stop(), dtype=torch.bool, device=input_ids.device)
+
+
+class SpeculationCounter(StoppingCriteria):
+    """
+    Passes and drafted tokens of one speculative generate() call.
+    
+    Pass it in the call's stopping criteria: it never stops generation,
+    but sees the sequence length after every pass.
+    """
+    
+    def __init__(self, prompt_length: int):
+        self.prompt_length = prompt_length
+        self.length = prompt_length
+        self.passes = 0
+        self.drafted = 0
+    
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        self.length = input_ids.shape[1]
+        return torch.zeros((input_ids.shape[0],), dtype=torch.bool, device=input_ids.device)
+
+
+class SpeculationStats:
+    """
+    How many drafted tokens the model accepts (draft model or prompt lookup).
+    
+    Each forward pass of the model verifies the tokens drafted since the
+    previous one, keeps those it agrees with and adds one of its own, so a
+    call that generated N tokens in P passes accepted N - P drafted tokens.
+    A forward pre-hook counts the passes and the drafted tokens each is fed
+    (the first pass also prefills the prompt, later ones start with the
+    previous pass's own token).
+    """
+    
+    def __init__(self, model):
+        self._local = threading.local()  # Counter of this thread's generate() call
+        self._lock = threading.Lock()
+        self._stats = {
+            'generations': 0,
+            'passes': 0,
+            'generated_tokens': 0,
+            'drafted_tokens': 0,
+            'accepted_tokens': 0,
+        }
+        model.register_forward_pre_hook(self._count_pass, with_kwargs=True)
+    
+    @contextmanager
+    def track(self, prompt_length: int) -> Iterator[SpeculationCounter]:
+        """
+        Count the generate() call made in the block on this thread.
+        
+        Args:
+            prompt_length: Prompt tokens of the call
+            
+        Yields:
+            SpeculationCounter to add to the call's stopping criteria
+        """
+        counter = SpeculationCounter(prompt_length)
+        self._local.counter = counter
+        try:
+            yield counter
+        finally:
+            self._local.counter = None
+        
+        generated = counter.length - prompt_length
+        # A pass cut short by max_new_tokens or EOS keeps fewer tokens
+        accepted = min(counter.drafted, max(0, generated - counter.passes))
+        with self._lock:
+            self._stats['generations'] += 1
+            self._stats['passes'] += counter.passes
+            self._stats['generated_tokens'] += generated
+            self._stats['drafted_tokens'] += counter.drafted
+            self._stats['accepted_tokens'] += accepted
+    
+    def metrics(self) -> Dict[str, Any]:
+        """Counters plus acceptance rate and tokens per forward pass."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['acceptance_rate'] = (
+            round(stats['accepted_tokens'] / stats['drafted_tokens'], 3) if stats['drafted_tokens'] else 0.0
+        )
+        stats['tokens_per_pass'] = round(stats['generated_tokens'] / stats['passes'], 2) if stats['passes'] else 0.0
+        return stats
+    
+    def _count_pass(self, module, args, kwargs):
+        counter = getattr(self._local, 'counter', None)
+        input_ids = kwargs.get('input_ids')
+        if counter is None or input_ids is None:
+            return
+        known = counter.prompt_length if counter.passes == 0 else 1
+        counter.drafted += max(0, input_ids.shape[1] - known)
+        counter.passes += 1
@@ -3,32 +3,220 @@ Orchestrator API - REST API wrapper for Mistral 7B orchestrator
 
 Provides HTTP endpoints for the Electron frontend and external clients.
 Supports streaming responses for better UX.
+
+Each client conversation is a session, selected by "session_id" in the
+request body, the X-Session-ID header or the session_id query parameter
+(default: "default"). Sessions share one loaded model.
+
+Generation requests go through a bounded queue: 429 when it is full, 504
+when a request misses its deadline ("timeout" in seconds), and
+"priority": "batch" (or an X-Priority header) to yield to interactive
+chat. GET /metrics reports queue depth and wait times.
+
+/chat responses are cached (response_cache.py) by prompt, conversation
+state, sampling parameters and model; the X-Cache response header says
+whether one was served, and "Cache-Control: no-cache" asks for a fresh one.
 """
 
 from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
+import atexit
 import json
+import queue
+import threading
 import time
-from typing import Generator
-from ai_orchestrator import MistralOrchestrator
+from typing import Generator, Optional, Tuple
+from ai_orchestrator import QUANTIZATION, MistralOrchestrator
+from checkpoint_cache import DEFAULT_CACHE_DIR
+from cpu_quantization import weights_size_mb
+from request_queue import (
+    DeadlineExceeded,
+    QueueFull,
+    RequestQueue,
+    parse_options,
+)
+from response_cache import ResponseCache, load_embedder, model_version, wants_fresh
+from session_store import SessionStore
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for Electron frontend
 
 # Initialize orchestrator (lazy loading)
 orchestrator = None
+orchestrator_lock = threading.Lock()
+# Extra MistralOrchestrator arguments (reconfigured from the command line)
+orchestrator_options = {}
+
+# Conversations by session id (reconfigured from the command line)
+DEFAULT_SESSION_ID = "default"
+session_store = SessionStore()
+
+# Generation work, one request at a time on the shared model (reconfigured
+# from the command line)
+request_queue = RequestQueue(max_queue=16, workers=1)
+
+# Responses to repeated chat turns (reconfigured from the command line;
+# None disables it)
+response_cache: Optional[ResponseCache] = ResponseCache(max_entries=256)
+
+# How often a stream checks on its request while no tokens arrive (seconds)
+STREAM_POLL_INTERVAL = 0.5
 
 
 def get_orchestrator() -> MistralOrchestrator:
     """Get or create orchestrator instance."""
     global orchestrator
     if orchestrator is None:
-        orchestrator = MistralOrchestrator(
-            model_path="./models/mistral-7b-continuity",
-        )
+        with orchestrator_lock:
+            if orchestrator is None:
+                orchestrator = MistralOrchestrator(
+                    model_path="./models/mistral-7b-continuity",
+                    **orchestrator_options,
+                )
     return orchestrator
 
 
+def get_session_id(data: dict = None) -> str:
+    """
+    Get the id of the session a request refers to.
+    
+    Raises:
+        ValueError: If the session id is malformed
+    """
+    session_id = (
+        (data or {}).get('session_id')
+        or request.headers.get('X-Session-ID')
+        or request.args.get('session_id')
+        or DEFAULT_SESSION_ID
+    )
+    return SessionStore.validate_id(session_id)
+
+
+def get_request_options(data: dict = None) -> Tuple[str, Optional[float]]:
+    """
+    Get a generation request's priority class and timeout.
+    
+    Raises:
+        ValueError: If the timeout is not a number
+    """
+    data = data or {}
+    return parse_options(data.get('priority') or request.headers.get('X-Priority'), data.get('timeout'))
+
+
+def run_chat_turn(
+    item,
+    session_id: str,
+    user_message: str,
+    system_context: str,
+    max_tokens: int,
+    fresh: bool = False,
+) -> Tuple[str, Optional[str]]:
+    """
+    Generate a chat turn on a queue worker (also used by the ASGI app).
+    
+    A turn found in the response cache is added to the history without
+    generating. fresh skips the lookup.
+    
+    Returns:
+        (response, cache status for the X-Cache header, None when the
+        cache is off)
+    """
+    orch = get_orchestrator()
+    # One turn at a time per session
+    with session_store.use(session_id) as session, session.lock:
+        lookup = None
+        if response_cache is not None:
+            lookup = response_cache.lookup(
+                user_message,
+                dict(orch.sampling_kwargs, max_new_tokens=max_tokens),
+                model_version(orch.model_path),
+                # Everything the model sees before the message: context and history
+                scope=orch.format_prompt("", system_context, max_tokens, session),
+                fresh=fresh,
+            )
+            if lookup.response is not None:
+                orch.record_turn(user_message, lookup.response, session)
+                return lookup.response, lookup.status
+        
+        response = orch.generate_response(
+            user_message,
+            system_context,
+            max_tokens,
+            session=session,
+            should_stop=item.should_stop,
+        )
+        if lookup is None:
+            return response, None
+        if not item.should_stop():
+            response_cache.store(lookup, response)
+        return response, lookup.status
+
+
+def run_stream_turn(item, streamer, session_id: str, user_message: str, system_context: str):
+    """
+    Generate a chat turn on a queue worker, feeding a streamer (also used
+    by the ASGI app).
+    """
+    orch = get_orchestrator()
+    try:
+        # One turn at a time per session
+        with session_store.use(session_id) as session, session.lock:
+            # Format and tokenize prompt, resuming from a cached KV prefix
+            generation_kwargs = orch.prepare_generation(
+                user_message,
+                system_context,
+                max_new_tokens=512,
+                session=session,
+                should_stop=item.should_stop,
+                streamer=streamer,
+            )
+            output_ids = orch.generate_ids(generation_kwargs, session)
+            
+            # Update history, unless the client went away or time ran out
+            if not item.should_stop():
+                prompt_length = generation_kwargs['input_ids'].shape[1]
+                response = orch.tokenizer.decode(
+                    output_ids[0, prompt_length:],
+                    skip_special_tokens=True,
+                ).strip()
+                orch.record_turn(user_message, response, session)
+    except Exception:
+        streamer.end()  # Wake the stream up so it reports the error
+        raise
+
+
+def clear_session(session_id: str) -> bool:
+    """
+    Clear a session's conversation unless a turn is using it (also used
+    by the ASGI app).
+    
+    Returns:
+        False if a turn is in flight on the session (its result would be
+        lost), True otherwise, including when the session doesn't exist
+    """
+    orch = get_orchestrator()
+    with session_store.use(session_id, create=False) as session:
+        if session is None:
+            return True
+        # Our own pin is one; any other is a running turn
+        if session_store.pin_count(session_id) > 1 or not session.lock.acquire(blocking=False):
+            return False
+        try:
+            orch.clear_conversation(session)
+        finally:
+            session.lock.release()
+    return True
+
+
+def queue_error_response(error: Exception):
+    """HTTP response for a request the queue rejected or timed out."""
+    if isinstance(error, QueueFull):
+        response = jsonify({'error': str(error)})
+        response.headers['Retry-After'] = str(request_queue.retry_after())
+        return response, 429
+    return jsonify({'error': str(error)}), 504
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint."""
@@ -47,12 +235,14 @@ def chat():
     {
         "message": "User message",
         "context": "Optional system context",
-        "max_tokens": 512
+        "max_tokens": 512,
+        "session_id": "Optional session id"
     }
     
     Response:
     {
         "response": "Assistant response",
+        "session_id": "Session the turn was added to",
         "timestamp": "ISO timestamp"
     }
     """
@@ -65,17 +255,35 @@ def chat():
         return jsonify({'error': 'Message is required'}), 400
     
     try:
-        orch = get_orchestrator()
-        response = orch.generate_response(
-            user_message,
-            system_context,
-            max_tokens,
-        )
+        session_id = get_session_id(data)
+        priority, timeout = get_request_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    fresh = wants_fresh(request.headers.get('Cache-Control'))
+    
+    def run(item) -> Tuple[str, Optional[str]]:
+        return run_chat_turn(item, session_id, user_message, system_context, max_tokens, fresh)
+    
+    try:
+        item = request_queue.submit(run, priority, timeout)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except QueueFull as e:
+        return queue_error_response(e)
+    
+    try:
+        response, cache_status = request_queue.wait(item)
         
-        return jsonify({
+        result = jsonify({
             'response': response,
+            'session_id': session_id,
             'timestamp': time.time(),
         })
+        if cache_status:
+            result.headers['X-Cache'] = cache_status
+        return result
+    except DeadlineExceeded as e:
+        return queue_error_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -96,58 +304,57 @@ def chat_stream():
     if not user_message:
         return jsonify({'error': 'Message is required'}), 400
     
+    try:
+        session_id = get_session_id(data)
+        priority, timeout = get_request_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    from transformers import TextIteratorStreamer
+    
+    orch = get_orchestrator()
+    streamer = TextIteratorStreamer(
+        orch.tokenizer,
+        skip_prompt=True,
+        skip_special_tokens=True,
+        timeout=STREAM_POLL_INTERVAL,
+    )
+    
+    def run(item):
+        run_stream_turn(item, streamer, session_id, user_message, system_context)
+    
+    try:
+        item = request_queue.submit(run, priority, timeout)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except QueueFull as e:
+        return queue_error_response(e)
+    
     def generate() -> Generator[str, None, None]:
         """Generate streaming response."""
         try:
-            orch = get_orchestrator()
-            
-            # Format prompt
-            prompt = orch.format_prompt(user_message, system_context)
-            
-            # Tokenize
-            inputs = orch.tokenizer(prompt, return_tensors="pt").to(orch.model.device)
-            
-            # Generate with streaming
-            from transformers import TextIteratorStreamer
-            from threading import Thread
-            
-            streamer = TextIteratorStreamer(
-                orch.tokenizer,
-                skip_special_tokens=True,
-            )
-            
-            generation_kwargs = dict(
-                inputs,
-                streamer=streamer,
-                max_new_tokens=512,
-                do_sample=True,
-                temperature=0.7,
-                top_p=0.95,
-            )
-            
-            thread = Thread(target=orch.model.generate, kwargs=generation_kwargs)
-            thread.start()
-            
-            # Stream tokens
-            full_response = ""
-            for token in streamer:
-                full_response += token
-                yield f"data: {json.dumps({'token': token})}\n\n"
-            
-            # Update history
-            orch.conversation_history.append({
-                'role': 'user',
-                'content': user_message,
-            })
-            orch.conversation_history.append({
-                'role': 'assistant',
-                'content': full_response.strip(),
-            })
-            
-            yield f"data: {json.dumps({'done': True})}\n\n"
+            # Stream tokens as the worker produces them
+            while True:
+                try:
+                    token = next(streamer)
+                except StopIteration:
+                    break
+                except queue.Empty:
+                    if item.future.done() or item.expired():
+                        break
+                    continue
+                if token:
+                    yield f"data: {json.dumps({'token': token})}\n\n"
             
+            request_queue.wait(item)
+            yield f"data: {json.dumps({'done': True, 'session_id': session_id})}\n\n"
+        
         except Exception as e:
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            # Client disconnected: stop generating for it
+            if not item.future.done():
+                request_queue.cancel(item)
     
     return Response(
         stream_with_context(generate()),
@@ -157,21 +364,33 @@ def chat_stream():
 
 @app.route('/conversation', methods=['GET'])
 def get_conversation():
-    """Get current conversation history."""
-    orch = get_orchestrator()
+    """Get a session's conversation history."""
+    try:
+        session = session_store.get(get_session_id(), create=False)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if session is None:
+        return jsonify({'error': 'Session not found'}), 404
     return jsonify({
-        'history': orch.conversation_history,
-        'turn_count': len(orch.conversation_history),
+        'session_id': session.session_id,
+        'history': session.history,
+        'turn_count': len(session.history),
+        'summary': session.summary,
     })
 
 
 @app.route('/conversation', methods=['DELETE'])
 def clear_conversation():
-    """Clear conversation history."""
-    orch = get_orchestrator()
-    orch.conversation_history = []
-    orch.clear_cache()
-    return jsonify({'status': 'cleared'})
+    """Clear a session's conversation history."""
+    try:
+        session_id = get_session_id()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if not clear_session(session_id):
+        return jsonify({'error': 'A turn is in progress on this session'}), 409
+    return jsonify({'status': 'cleared', 'session_id': session_id})
 
 
 @app.route('/conversation/save', methods=['POST'])
@@ -181,9 +400,10 @@ def save_conversation():
     path = data.get('path', 'conversation_history.json')
     
     try:
+        session_id = get_session_id(data)
         orch = get_orchestrator()
-        orch.save_conversation(path)
-        return jsonify({'status': 'saved', 'path': path})
+        orch.save_conversation(path, session_store.get(session_id))
+        return jsonify({'status': 'saved', 'path': path, 'session_id': session_id})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -195,17 +415,42 @@ def load_conversation():
     path = data.get('path', 'conversation_history.json')
     
     try:
+        session_id = get_session_id(data)
         orch = get_orchestrator()
-        orch.load_conversation(path)
+        with session_store.use(session_id) as session, session.lock:
+            orch.load_conversation(path, session)
         return jsonify({
             'status': 'loaded',
             'path': path,
-            'turn_count': len(orch.conversation_history),
+            'session_id': session_id,
+            'turn_count': len(session.history),
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/sessions', methods=['GET'])
+def list_sessions():
+    """List sessions, in memory and spilled to disk."""
+    return jsonify({
+        'sessions': session_store.list_sessions(),
+        'stats': session_store.stats,
+    })
+
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+def delete_session(session_id: str):
+    """Delete a session and its saved state."""
+    try:
+        existed = session_store.delete(session_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if not existed:
+        return jsonify({'error': 'Session not found'}), 404
+    return jsonify({'status': 'deleted', 'session_id': session_id})
+
+
 @app.route('/context/load', methods=['POST'])
 def load_context():
     """Load context from SESSION_BRIEFING.md or other file."""
@@ -224,31 +469,125 @@ def load_context():
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/model/info', methods=['GET'])
-def model_info():
-    """Get model information."""
+def get_model_info() -> dict:
+    """Model, cache, session and queue information (also used by the ASGI app)."""
     orch = get_orchestrator()
     
     import torch
     
-    return jsonify({
+    return {
         'model_path': orch.model_path,
         'max_memory_gb': orch.max_memory_gb,
         'device': str(orch.model.device) if hasattr(orch.model, 'device') else 'unknown',
         'cuda_available': torch.cuda.is_available(),
         'cuda_memory_allocated': torch.cuda.memory_allocated() / 1e9 if torch.cuda.is_available() else 0,
         'cuda_memory_reserved': torch.cuda.memory_reserved() / 1e9 if torch.cuda.is_available() else 0,
-    })
+        'quantization': orch.quantization,
+        'weights_mb': round(weights_size_mb(orch.model), 1),
+        'load_time': orch.load_time,
+        'checkpoint_cache': orch.checkpoint_status,
+        'kv_cache': orch.kv_cache_metrics(),
+        'draft_model': orch.draft_model_path,
+        'prompt_lookup_tokens': orch.prompt_lookup_tokens,
+        'speculation': orch.speculation.metrics() if orch.speculation is not None else None,
+        'sessions': session_store.stats,
+        'queue': request_queue.metrics(),
+        'response_cache': response_cache.metrics() if response_cache is not None else None,
+    }
+
+
+def get_metrics() -> dict:
+    """Request queue, session, response cache and speculative decoding metrics (also used by the ASGI app)."""
+    metrics_dict = {
+        'queue': request_queue.metrics(),
+        'sessions': session_store.stats,
+        'response_cache': response_cache.metrics() if response_cache is not None else None,
+    }
+    if orchestrator is not None and orchestrator.speculation is not None:
+        metrics_dict['speculation'] = orchestrator.speculation.metrics()
+    return metrics_dict
+
+
+@app.route('/model/info', methods=['GET'])
+def model_info():
+    """Get model information."""
+    return jsonify(get_model_info())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Request queue depth, outcomes and wait/run times."""
+    return jsonify(get_metrics())
+
+
+def add_server_arguments(parser):
+    """
+    Add the options both servers (this one and orchestrator_asgi.py) take.
+    
+    Args:
+        parser: argparse.ArgumentParser to extend
+    """
+    parser.add_argument('--host', default='127.0.0.1', help='Host to bind to')
+    parser.add_argument('--port', type=int, default=5000, help='Port to bind to')
+    parser.add_argument('--sessions-dir', default='sessions', help='Directory for sessions spilled from memory')
+    parser.add_argument('--max-sessions', type=int, default=32, help='Sessions kept in memory')
+    parser.add_argument('--max-queue', type=int, default=16, help='Generation requests waiting before 429')
+    parser.add_argument('--max-concurrent', type=int, default=1, help='Generation requests run at once')
+    parser.add_argument('--request-timeout', type=float, default=120.0, help='Default request deadline (seconds)')
+    parser.add_argument('--cache-size', type=int, default=256, help='Chat responses cached (0 disables the cache)')
+    parser.add_argument('--cache-ttl', type=float, default=3600.0, help='Seconds a cached response is served')
+    parser.add_argument('--semantic-cache', action='store_true', help='Also serve cached responses to paraphrases')
+    parser.add_argument('--semantic-threshold', type=float, default=0.92, help='Least similarity for a paraphrase hit')
+    parser.add_argument('--draft-model', help='Small model for speculative decoding')
+    parser.add_argument('--prompt-lookup', type=int, nargs='?', const=10, metavar='TOKENS',
+                        help='Draft tokens copied from the prompt (prompt lookup decoding; default 10)')
+    parser.add_argument('--quantization', choices=QUANTIZATION, default='auto',
+                        help='nf4 (bitsandbytes, CUDA) or int8/int4/none on the CPU (default: nf4 with CUDA, else int8)')
+    parser.add_argument('--checkpoint-cache', default=DEFAULT_CACHE_DIR, metavar='DIR',
+                        help='Where the quantized model is kept between starts')
+    parser.add_argument('--no-checkpoint-cache', action='store_true', help='Quantize the model on every start')
+
+
+def configure(args):
+    """
+    Set up the orchestrator options, sessions, request queue and response
+    cache from parsed add_server_arguments() options.
+    
+    Args:
+        args: argparse.Namespace from a parser given add_server_arguments()
+    """
+    global session_store, request_queue, response_cache
+    
+    if args.draft_model:
+        orchestrator_options['draft_model_path'] = args.draft_model
+    if args.prompt_lookup:
+        orchestrator_options['prompt_lookup_tokens'] = args.prompt_lookup
+    orchestrator_options['quantization'] = args.quantization
+    orchestrator_options['checkpoint_cache_dir'] = None if args.no_checkpoint_cache else args.checkpoint_cache
+    
+    session_store = SessionStore(args.sessions_dir, args.max_sessions)
+    request_queue = RequestQueue(
+        max_queue=args.max_queue,
+        workers=args.max_concurrent,
+        default_timeout=args.request_timeout,
+    )
+    response_cache = ResponseCache(
+        max_entries=args.cache_size,
+        ttl=args.cache_ttl,
+        embed=load_embedder() if args.semantic_cache else None,
+        similarity_threshold=args.semantic_threshold,
+    ) if args.cache_size > 0 else None
+    atexit.register(session_store.flush)
 
 
 if __name__ == '__main__':
     import argparse
     
     parser = argparse.ArgumentParser(description='Orchestrator API Server')
-    parser.add_argument('--host', default='127.0.0.1', help='Host to bind to')
-    parser.add_argument('--port', type=int, default=5000, help='Port to bind to')
+    add_server_arguments(parser)
     parser.add_argument('--debug', action='store_true', help='Enable debug mode')
     args = parser.parse_args()
+    configure(args)
     
     print(f"Starting Orchestrator API on {args.host}:{args.port}")
     print("Endpoints:")
@@ -256,7 +595,10 @@ if __name__ == '__main__':
     print("  POST /chat/stream - Generate streaming chat response")
     print("  GET  /conversation - Get conversation history")
     print("  DELETE /conversation - Clear conversation history")
+    print("  GET  /sessions - List sessions")
+    print("  DELETE /sessions/<id> - Delete a session")
     print("  GET  /health - Health check")
     print("  GET  /model/info - Model information")
+    print("  GET  /metrics - Request queue metrics")
     
-    app.run(host=args.host, port=args.port, debug=args.debug)
+    app.run(host=args.host, port=args.port, debug=args.debug, threaded=True)
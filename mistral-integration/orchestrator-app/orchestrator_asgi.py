@@ -0,0 +1,367 @@
+"""
+Orchestrator ASGI API - Async variant of orchestrator_api.py
+
+Serves the same endpoints with the same request and response bodies, and
+shares that module's orchestrator, sessions and request queue. Generation
+still runs on the queue's worker threads; request handlers only await it,
+and streamed tokens reach them through an asyncio.Queue, so an idle SSE
+connection holds no thread and one process can serve many streams.
+Requests are cancelled as soon as their client disconnects, streaming or
+not. /chat uses the same response cache.
+
+Run with:
+    python orchestrator_asgi.py --port 5000
+    uvicorn orchestrator_asgi:app --host 127.0.0.1 --port 5000
+"""
+
+import asyncio
+import json
+import time
+from typing import AsyncGenerator
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from transformers import TextStreamer
+
+import orchestrator_api as api
+from request_queue import (
+    DeadlineExceeded,
+    QueueFull,
+    RequestCancelled,
+    parse_options,
+)
+from response_cache import wants_fresh
+from session_store import SessionStore
+
+
+class AsyncTextStreamer(TextStreamer):
+    """
+    Streamer that hands decoded text from the generating thread to an
+    asyncio.Queue on the event loop (None marks the end).
+    """
+    
+    def __init__(self, tokenizer, loop: asyncio.AbstractEventLoop, **decode_kwargs):
+        super().__init__(tokenizer, skip_prompt=True, **decode_kwargs)
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+    
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+
+async def read_json(request: Request) -> dict:
+    """Request body as JSON (empty dict if there is none)."""
+    body = await request.body()
+    return json.loads(body) if body else {}
+
+
+def get_session_id(request: Request, data: dict = None) -> str:
+    """
+    Get the id of the session a request refers to.
+    
+    Raises:
+        ValueError: If the session id is malformed
+    """
+    session_id = (
+        (data or {}).get('session_id')
+        or request.headers.get('X-Session-ID')
+        or request.query_params.get('session_id')
+        or api.DEFAULT_SESSION_ID
+    )
+    return SessionStore.validate_id(session_id)
+
+
+def get_request_options(request: Request, data: dict):
+    """Get a generation request's priority class and timeout (see parse_options)."""
+    return parse_options(data.get('priority') or request.headers.get('X-Priority'), data.get('timeout'))
+
+
+def error_response(error, status: int) -> JSONResponse:
+    return JSONResponse({'error': str(error)}, status_code=status)
+
+
+def queue_error_response(error: Exception) -> JSONResponse:
+    """HTTP response for a request the queue rejected or timed out."""
+    if isinstance(error, QueueFull):
+        return JSONResponse(
+            {'error': str(error)},
+            status_code=429,
+            headers={'Retry-After': str(api.request_queue.retry_after())},
+        )
+    return error_response(error, 504)
+
+
+async def health(request: Request) -> JSONResponse:
+    """Health check endpoint."""
+    return JSONResponse({
+        'status': 'healthy',
+        'model_loaded': api.orchestrator is not None,
+    })
+
+
+async def chat(request: Request) -> JSONResponse:
+    """Generate chat response (body and response as orchestrator_api /chat)."""
+    data = await read_json(request)
+    user_message = data.get('message', '')
+    system_context = data.get('context', '')
+    max_tokens = data.get('max_tokens', 512)
+    
+    if not user_message:
+        return error_response('Message is required', 400)
+    
+    fresh = wants_fresh(request.headers.get('Cache-Control'))
+    
+    try:
+        session_id = get_session_id(request, data)
+        priority, timeout = get_request_options(request, data)
+        item = api.request_queue.submit(
+            lambda item: api.run_chat_turn(item, session_id, user_message, system_context, max_tokens, fresh),
+            priority,
+            timeout,
+        )
+    except ValueError as e:
+        return error_response(e, 400)
+    except QueueFull as e:
+        return queue_error_response(e)
+    
+    try:
+        response, cache_status = await api.request_queue.wait_async(item, request.is_disconnected)
+        
+        return JSONResponse(
+            {
+                'response': response,
+                'session_id': session_id,
+                'timestamp': time.time(),
+            },
+            headers={'X-Cache': cache_status} if cache_status else None,
+        )
+    except DeadlineExceeded as e:
+        return queue_error_response(e)
+    except RequestCancelled as e:
+        return error_response(e, 499)  # Nobody is listening any more
+    except Exception as e:
+        return error_response(e, 500)
+
+
+async def chat_stream(request: Request):
+    """Generate streaming chat response as Server-Sent Events."""
+    data = await read_json(request)
+    user_message = data.get('message', '')
+    system_context = data.get('context', '')
+    
+    if not user_message:
+        return error_response('Message is required', 400)
+    
+    try:
+        session_id = get_session_id(request, data)
+        priority, timeout = get_request_options(request, data)
+    except ValueError as e:
+        return error_response(e, 400)
+    
+    orch = await run_in_threadpool(api.get_orchestrator)
+    streamer = AsyncTextStreamer(
+        orch.tokenizer,
+        asyncio.get_running_loop(),
+        skip_special_tokens=True,
+    )
+    
+    try:
+        item = api.request_queue.submit(
+            lambda item: api.run_stream_turn(item, streamer, session_id, user_message, system_context),
+            priority,
+            timeout,
+        )
+    except ValueError as e:
+        return error_response(e, 400)
+    except QueueFull as e:
+        return queue_error_response(e)
+    
+    async def generate() -> AsyncGenerator[str, None]:
+        """Generate streaming response."""
+        try:
+            # Stream tokens as the worker produces them
+            while True:
+                try:
+                    token = await asyncio.wait_for(streamer.queue.get(), timeout=item.remaining())
+                except asyncio.TimeoutError:
+                    break
+                if token is None:
+                    break
+                yield f"data: {json.dumps({'token': token})}\n\n"
+            
+            # Let the worker finish recording the turn
+            await api.request_queue.wait_async(item)
+            yield f"data: {json.dumps({'done': True, 'session_id': session_id})}\n\n"
+        
+        except Exception as e:
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            # Client disconnected (the generator was cancelled): stop generating for it
+            if not item.future.done():
+                api.request_queue.cancel(item)
+    
+    return StreamingResponse(generate(), media_type='text/event-stream')
+
+
+async def get_conversation(request: Request) -> JSONResponse:
+    """Get a session's conversation history."""
+    try:
+        session = await run_in_threadpool(api.session_store.get, get_session_id(request), False)
+    except ValueError as e:
+        return error_response(e, 400)
+    
+    if session is None:
+        return error_response('Session not found', 404)
+    return JSONResponse({
+        'session_id': session.session_id,
+        'history': session.history,
+        'turn_count': len(session.history),
+        'summary': session.summary,
+    })
+
+
+async def clear_conversation(request: Request) -> JSONResponse:
+    """Clear a session's conversation history."""
+    try:
+        session_id = get_session_id(request)
+    except ValueError as e:
+        return error_response(e, 400)
+    
+    if not await run_in_threadpool(api.clear_session, session_id):
+        return error_response('A turn is in progress on this session', 409)
+    return JSONResponse({'status': 'cleared', 'session_id': session_id})
+
+
+async def save_conversation(request: Request) -> JSONResponse:
+    """Save conversation to file."""
+    data = await read_json(request)
+    path = data.get('path', 'conversation_history.json')
+    
+    try:
+        session_id = get_session_id(request, data)
+        
+        def save():
+            api.get_orchestrator().save_conversation(path, api.session_store.get(session_id))
+        
+        await run_in_threadpool(save)
+        return JSONResponse({'status': 'saved', 'path': path, 'session_id': session_id})
+    except Exception as e:
+        return error_response(e, 500)
+
+
+async def load_conversation(request: Request) -> JSONResponse:
+    """Load conversation from file."""
+    data = await read_json(request)
+    path = data.get('path', 'conversation_history.json')
+    
+    try:
+        session_id = get_session_id(request, data)
+        
+        def load() -> int:
+            orch = api.get_orchestrator()
+            with api.session_store.use(session_id) as session, session.lock:
+                orch.load_conversation(path, session)
+                return len(session.history)
+        
+        turn_count = await run_in_threadpool(load)
+        return JSONResponse({
+            'status': 'loaded',
+            'path': path,
+            'session_id': session_id,
+            'turn_count': turn_count,
+        })
+    except Exception as e:
+        return error_response(e, 500)
+
+
+async def list_sessions(request: Request) -> JSONResponse:
+    """List sessions, in memory and spilled to disk."""
+    sessions = await run_in_threadpool(api.session_store.list_sessions)
+    return JSONResponse({
+        'sessions': sessions,
+        'stats': api.session_store.stats,
+    })
+
+
+async def delete_session(request: Request) -> JSONResponse:
+    """Delete a session and its saved state."""
+    session_id = request.path_params['session_id']
+    try:
+        existed = await run_in_threadpool(api.session_store.delete, session_id)
+    except ValueError as e:
+        return error_response(e, 400)
+    
+    if not existed:
+        return error_response('Session not found', 404)
+    return JSONResponse({'status': 'deleted', 'session_id': session_id})
+
+
+async def load_context(request: Request) -> JSONResponse:
+    """Load context from SESSION_BRIEFING.md or other file."""
+    data = await read_json(request)
+    path = data.get('path', 'SESSION_BRIEFING.md')
+    
+    try:
+        context = await run_in_threadpool(lambda: api.get_orchestrator().load_session_context(path))
+        return JSONResponse({
+            'status': 'loaded',
+            'path': path,
+            'context_length': len(context),
+        })
+    except Exception as e:
+        return error_response(e, 500)
+
+
+async def model_info(request: Request) -> JSONResponse:
+    """Get model information."""
+    return JSONResponse(await run_in_threadpool(api.get_model_info))
+
+
+async def metrics(request: Request) -> JSONResponse:
+    """Request queue depth, outcomes and wait/run times."""
+    return JSONResponse(api.get_metrics())
+
+
+async def bad_json(request: Request, exc: json.JSONDecodeError) -> JSONResponse:
+    return error_response(f"Invalid JSON body: {exc}", 400)
+
+
+app = Starlette(
+    routes=[
+        Route('/health', health, methods=['GET']),
+        Route('/chat', chat, methods=['POST']),
+        Route('/chat/stream', chat_stream, methods=['POST']),
+        Route('/conversation', get_conversation, methods=['GET']),
+        Route('/conversation', clear_conversation, methods=['DELETE']),
+        Route('/conversation/save', save_conversation, methods=['POST']),
+        Route('/conversation/load', load_conversation, methods=['POST']),
+        Route('/sessions', list_sessions, methods=['GET']),
+        Route('/sessions/{session_id}', delete_session, methods=['DELETE']),
+        Route('/context/load', load_context, methods=['POST']),
+        Route('/model/info', model_info, methods=['GET']),
+        Route('/metrics', metrics, methods=['GET']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    exception_handlers={json.JSONDecodeError: bad_json},
+)
+
+
+if __name__ == '__main__':
+    import argparse
+    import uvicorn
+    
+    parser = argparse.ArgumentParser(description='Orchestrator API Server (ASGI)')
+    api.add_server_arguments(parser)
+    args = parser.parse_args()
+    api.configure(args)
+    
+    print(f"Starting Orchestrator ASGI API on {args.host}:{args.port}")
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,375 @@
+"""
+Request Queue - Bounded, prioritized work queue for the orchestrator APIs
+
+Generation requests are admitted into a bounded queue (QueueFull when it
+is full, which the APIs answer with 429), run by a fixed number of worker
+threads, interactive requests first, and carry a deadline and a cancel
+flag. Generation polls WorkItem.should_stop() between tokens, so a request
+that timed out or whose client went away stops using the model.
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Future, TimeoutError as FutureTimeout
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+# Priority classes, most urgent first
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+PRIORITIES = (INTERACTIVE, BATCH)
+
+# Wait/run times kept per priority for percentiles
+TIMING_WINDOW = 1000
+
+# How often wait_async checks whether the client is still there (seconds)
+DISCONNECT_POLL_INTERVAL = 0.5
+
+
+def parse_options(priority: Optional[str] = None, timeout: Any = None) -> Tuple[str, Optional[float]]:
+    """
+    Priority class and timeout from a request's fields.
+    
+    Args:
+        priority: Requested priority class (default: INTERACTIVE)
+        timeout: Requested deadline in seconds, or None for the default
+        
+    Returns:
+        (priority, timeout) for RequestQueue.submit
+        
+    Raises:
+        ValueError: If the timeout is not a number (the priority is
+            checked by submit)
+    """
+    if timeout is not None:
+        try:
+            timeout = float(timeout)
+        except (TypeError, ValueError):
+            raise ValueError("timeout must be a number of seconds")
+    return priority or INTERACTIVE, timeout
+
+
+class QueueFull(Exception):
+    """The queue has no room for another request."""
+
+
+class DeadlineExceeded(Exception):
+    """A request did not finish before its deadline."""
+
+
+class RequestCancelled(Exception):
+    """A request was cancelled (e.g. its client disconnected)."""
+
+
+class WorkItem:
+    """A queued call, its deadline and its result."""
+    
+    __slots__ = ('fn', 'priority', 'enqueued_at', 'deadline', 'started_at', 'future', '_cancelled')
+    
+    def __init__(self, fn: Callable[["WorkItem"], Any], priority: str, timeout: float):
+        self.fn = fn
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.deadline = self.enqueued_at + timeout
+        self.started_at = None
+        self.future: Future = Future()
+        self._cancelled = threading.Event()
+    
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+    
+    def expired(self) -> bool:
+        return time.monotonic() >= self.deadline
+    
+    def remaining(self) -> float:
+        """Seconds left until the deadline."""
+        return max(0.0, self.deadline - time.monotonic())
+    
+    def should_stop(self) -> bool:
+        """Whether work on this request should stop now."""
+        return self.cancelled or self.expired()
+
+
+class RequestQueue:
+    """Bounded priority queue served by a fixed pool of worker threads."""
+    
+    def __init__(
+        self,
+        max_queue: int = 32,
+        workers: int = 1,
+        default_timeout: float = 120.0,
+        max_timeout: float = 600.0,
+        batch_share: float = 0.5,
+    ):
+        """
+        Initialize the queue.
+        
+        Args:
+            max_queue: Most requests waiting (running ones not counted)
+            workers: Requests run at once
+            default_timeout: Deadline in seconds when a request sets none
+            max_timeout: Longest deadline a request may ask for
+            batch_share: Fraction of max_queue batch requests may fill, so
+                interactive requests are still admitted under batch load
+        """
+        self.max_queue = max_queue
+        self.workers = workers
+        self.default_timeout = default_timeout
+        self.max_timeout = max_timeout
+        self.batch_share = batch_share
+        
+        self._heap: List = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._running = False
+        self._active = 0
+        
+        self.stats = {
+            'admitted': 0,
+            'rejected': 0,
+            'completed': 0,
+            'failed': 0,
+            'cancelled': 0,
+            'expired': 0,
+        }
+        self._wait_times = {p: deque(maxlen=TIMING_WINDOW) for p in PRIORITIES}
+        self._run_times = {p: deque(maxlen=TIMING_WINDOW) for p in PRIORITIES}
+    
+    def start(self):
+        """
+        Start the worker threads.
+        
+        submit() does this on first use, so a server process that forks
+        after importing the app starts them in each child.
+        """
+        with self._cond:
+            self._start()
+    
+    def _start(self):
+        # Called with self._cond held
+        if self._threads:
+            return
+        self._running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"request-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def stop(self):
+        """Stop the workers once their current requests finish; queued ones fail."""
+        with self._cond:
+            self._running = False
+            pending = [entry[2] for entry in self._heap]
+            self._heap.clear()
+            self._cond.notify_all()
+        for item in pending:
+            item.future.set_exception(RequestCancelled("Server shutting down"))
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+    
+    def submit(
+        self,
+        fn: Callable[[WorkItem], Any],
+        priority: str = INTERACTIVE,
+        timeout: Optional[float] = None,
+    ) -> WorkItem:
+        """
+        Admit a call into the queue.
+        
+        Args:
+            fn: Called with the WorkItem on a worker thread; should poll
+                item.should_stop() while it works
+            priority: INTERACTIVE or BATCH
+            timeout: Seconds until the deadline (default: default_timeout)
+            
+        Returns:
+            The queued WorkItem
+            
+        Raises:
+            ValueError: If the priority is unknown or the timeout invalid
+            QueueFull: If the queue has no room for this priority
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{priority}' (expected one of {', '.join(PRIORITIES)})")
+        timeout = self.default_timeout if timeout is None else float(timeout)
+        if timeout <= 0:
+            raise ValueError("Timeout must be positive")
+        item = WorkItem(fn, priority, min(timeout, self.max_timeout))
+        
+        with self._cond:
+            self._start()
+            limit = self.max_queue if priority == INTERACTIVE else int(self.max_queue * self.batch_share)
+            if len(self._heap) >= limit:
+                self.stats['rejected'] += 1
+                raise QueueFull(f"Request queue is full ({len(self._heap)} waiting)")
+            heapq.heappush(self._heap, (PRIORITIES.index(priority), next(self._order), item))
+            self.stats['admitted'] += 1
+            self._cond.notify()
+        return item
+    
+    def wait(self, item: WorkItem) -> Any:
+        """
+        Wait for a submitted item's result until its deadline.
+        
+        Raises:
+            DeadlineExceeded: If the deadline passes first (the item is cancelled)
+            RequestCancelled: If the item was cancelled
+            Exception: Whatever the call raised
+        """
+        try:
+            return item.future.result(timeout=item.remaining())
+        except FutureTimeout:
+            self.cancel(item)
+            raise DeadlineExceeded("Request did not finish within its deadline")
+        except CancelledError:
+            raise RequestCancelled("Request was cancelled")
+    
+    async def wait_async(
+        self,
+        item: WorkItem,
+        is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+    ) -> Any:
+        """
+        Like wait(), for async servers: awaits without blocking the event loop.
+        
+        Args:
+            item: Submitted item
+            is_disconnected: Coroutine function polled while waiting; the
+                item is cancelled once it returns True
+                
+        Raises:
+            DeadlineExceeded: If the deadline passes first (the item is cancelled)
+            RequestCancelled: If the client disconnected (the item is cancelled)
+            Exception: Whatever the call raised
+        """
+        future = asyncio.wrap_future(item.future)
+        while not future.done():
+            await asyncio.wait({future}, timeout=min(DISCONNECT_POLL_INTERVAL, item.remaining()))
+            if future.done():
+                break
+            if item.expired():
+                error = DeadlineExceeded("Request did not finish within its deadline")
+            elif is_disconnected is not None and await is_disconnected():
+                error = RequestCancelled("Client disconnected")
+            else:
+                continue
+            self.cancel(item)
+            future.cancel()  # Nobody will look at its result
+            raise error
+        try:
+            return future.result()
+        except asyncio.CancelledError:
+            raise RequestCancelled("Request was cancelled")
+    
+    def run(self, fn: Callable[[WorkItem], Any], priority: str = INTERACTIVE, timeout: Optional[float] = None) -> Any:
+        """Submit a call and wait for its result (see submit and wait)."""
+        return self.wait(self.submit(fn, priority, timeout))
+    
+    def cancel(self, item: WorkItem):
+        """
+        Cancel an item: a queued one is removed, a running one sees
+        should_stop() return True.
+        """
+        item._cancelled.set()
+        with self._cond:
+            for index, entry in enumerate(self._heap):
+                if entry[2] is item:
+                    self._heap[index] = self._heap[-1]
+                    self._heap.pop()
+                    heapq.heapify(self._heap)
+                    self._count_stopped(item)
+                    item.future.cancel()
+                    break
+    
+    def retry_after(self) -> int:
+        """Seconds a rejected client should wait before retrying (estimate)."""
+        runs = [t for times in self._run_times.values() for t in times]
+        average = sum(runs) / len(runs) if runs else 1.0
+        return max(1, math.ceil(average * (len(self._heap) + 1) / self.workers))
+    
+    def metrics(self) -> Dict[str, Any]:
+        """Queue depth, outcome counters and wait/run time percentiles."""
+        with self._cond:
+            depth = {p: 0 for p in PRIORITIES}
+            for entry in self._heap:
+                depth[entry[2].priority] += 1
+            active = self._active
+        
+        return {
+            'depth': sum(depth.values()),
+            'depth_by_priority': depth,
+            'active': active,
+            'max_queue': self.max_queue,
+            'workers': self.workers,
+            **self.stats,
+            'wait_ms': {p: self._percentiles(self._wait_times[p]) for p in PRIORITIES},
+            'run_ms': {p: self._percentiles(self._run_times[p]) for p in PRIORITIES},
+        }
+    
+    def _work(self):
+        """Worker loop: run queued items, most urgent first."""
+        while True:
+            with self._cond:
+                while self._running and not self._heap:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                item = heapq.heappop(self._heap)[2]
+            
+            if item.should_stop():
+                self._count_stopped(item)
+                item.future.set_exception(
+                    DeadlineExceeded("Request expired in the queue")
+                    if item.expired() else RequestCancelled("Request was cancelled")
+                )
+                continue
+            if not item.future.set_running_or_notify_cancel():
+                continue
+            
+            item.started_at = time.monotonic()
+            self._wait_times[item.priority].append(item.started_at - item.enqueued_at)
+            with self._cond:
+                self._active += 1
+            try:
+                result = item.fn(item)
+            except Exception as e:
+                self.stats['failed'] += 1
+                item.future.set_exception(e)
+            else:
+                if item.should_stop():
+                    # The call returned early because it was told to stop
+                    self._count_stopped(item)
+                    item.future.set_exception(
+                        DeadlineExceeded("Request did not finish within its deadline")
+                        if item.expired() else RequestCancelled("Request was cancelled")
+                    )
+                else:
+                    self.stats['completed'] += 1
+                    item.future.set_result(result)
+            finally:
+                self._run_times[item.priority].append(time.monotonic() - item.started_at)
+                with self._cond:
+                    self._active -= 1
+    
+    def _count_stopped(self, item: WorkItem):
+        # A request past its deadline counts as expired even if it was also cancelled
+        self.stats['expired' if item.expired() else 'cancelled'] += 1
+    
+    @staticmethod
+    def _percentiles(times) -> Dict[str, float]:
+        if not times:
+            return {'avg': 0.0, 'p50': 0.0, 'p95': 0.0}
+        ordered = sorted(times)
+        return {
+            'avg': round(sum(ordered) / len(ordered) * 1000, 1),
+            'p50': round(ordered[len(ordered) // 2] * 1000, 1),
+            'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+        }
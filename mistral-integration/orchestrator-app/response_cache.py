@@ -0,0 +1,276 @@
+"""
+Response Cache - Reuse generated responses for repeated prompts
+
+Exact tier: responses keyed by a hash of the query text, its scope (for
+chat, the prompt before the user message: system context and history),
+the sampling parameters and the model version, with a TTL and LRU
+eviction. Optional semantic tier: entries also keep an embedding of their
+query, and an exact miss returns the most similar entry with the same
+scope, parameters and model version if the cosine similarity reaches the
+threshold, so paraphrased questions hit too.
+
+Cached responses are replayed samples; callers that need a fresh one send
+"Cache-Control: no-cache" (the lookup is skipped, the new response stored).
+"""
+
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+
+
+# Same sentence embedding model as continuity_rag.py
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+
+# Lookup outcomes (also sent to clients in the X-Cache header)
+HIT = 'hit'
+SEMANTIC_HIT = 'semantic-hit'
+MISS = 'miss'
+BYPASS = 'bypass'
+
+
+def wants_fresh(cache_control: Optional[str]) -> bool:
+    """Whether a request's Cache-Control header asks to skip the cache."""
+    directives = (cache_control or '').lower()
+    return 'no-cache' in directives or 'no-store' in directives
+
+
+@functools.lru_cache(maxsize=None)
+def model_version(model_path: str) -> str:
+    """
+    Identify a model by its path and the sizes and modification times of
+    its files, so responses of a replaced model are not served.
+    """
+    path = os.path.abspath(model_path)
+    parts = [path]
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(('.json', '.safetensors', '.bin', '.gguf', '.model')):
+                stat = os.stat(os.path.join(path, name))
+                parts.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+    elif os.path.isfile(path):
+        stat = os.stat(path)  # Single-file model (GGUF)
+        parts.append(f"{stat.st_size}:{stat.st_mtime_ns}")
+    else:
+        parts = [model_path]  # Hub model name
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()[:16]
+
+
+def load_embedder(model_name: str = EMBEDDING_MODEL) -> Optional[Callable[[str], np.ndarray]]:
+    """
+    Sentence embedding function for the semantic tier (None if
+    sentence-transformers is not installed).
+    
+    The model runs on the CPU: it is small, and it stays off a GPU the
+    language model needs (and out of CUDA before a server forks).
+    """
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:
+        print("⚠ Install 'sentence-transformers' for the semantic response cache; using exact matches only")
+        return None
+    
+    model = None
+    lock = threading.Lock()
+    
+    def embed(text: str) -> np.ndarray:
+        nonlocal model
+        with lock:
+            if model is None:
+                model = SentenceTransformer(model_name, device='cpu')
+        return model.encode([text], normalize_embeddings=True, show_progress_bar=False)[0]
+    
+    return embed
+
+
+class CacheLookup:
+    """Result of a lookup, passed back to store() after a miss."""
+    
+    __slots__ = ('key', 'partition', 'query', 'embedding', 'response', 'status', 'similarity')
+    
+    def __init__(self, key: str, partition: str, query: str):
+        self.key = key
+        self.partition = partition
+        self.query = query
+        self.embedding: Optional[np.ndarray] = None
+        self.response: Optional[str] = None
+        self.status = MISS
+        self.similarity: Optional[float] = None
+
+
+class CacheEntry:
+    """A cached response and the embedding of its query."""
+    
+    __slots__ = ('response', 'partition', 'embedding', 'created_at')
+    
+    def __init__(self, response: str, partition: str, embedding: Optional[np.ndarray]):
+        self.response = response
+        self.partition = partition
+        self.embedding = embedding
+        self.created_at = time.monotonic()
+
+
+class ResponseCache:
+    """LRU of generated responses with a TTL and an optional semantic tier."""
+    
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 3600.0,
+        embed: Optional[Callable[[str], np.ndarray]] = None,
+        similarity_threshold: float = 0.92,
+    ):
+        """
+        Initialize the cache.
+        
+        Args:
+            max_entries: Responses kept (least recently used dropped first)
+            ttl: Seconds a response may be served after it was generated
+            embed: Normalized embedding of a query (e.g. load_embedder());
+                None for exact matches only
+            similarity_threshold: Least cosine similarity for a semantic hit
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'semantic_hits': 0,
+            'misses': 0,
+            'bypassed': 0,
+            'stored': 0,
+            'evicted': 0,
+            'expired': 0,
+        }
+    
+    @staticmethod
+    def _hash(*parts: Any) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+    
+    def lookup(
+        self,
+        query: str,
+        params: Dict[str, Any],
+        model_version: str,
+        scope: str = "",
+        fresh: bool = False,
+    ) -> CacheLookup:
+        """
+        Find a cached response.
+        
+        Args:
+            query: Text that varies between requests (prompt or user message)
+            params: Sampling parameters (max_new_tokens, temperature, ...)
+            model_version: Version of the model generating (see model_version)
+            scope: Text the response also depends on but that is matched
+                exactly even by the semantic tier (e.g. chat history)
+            fresh: Skip the lookup (the caller wants a new sample)
+            
+        Returns:
+            CacheLookup whose response is set on a hit
+        """
+        partition = self._hash(scope, params, model_version)
+        lookup = CacheLookup(self._hash(partition, query), partition, query)
+        if fresh:
+            lookup.status = BYPASS
+            self.stats['bypassed'] += 1
+            return lookup
+        
+        with self._lock:
+            entry = self._get(lookup.key)
+            if entry is not None:
+                lookup.response = entry.response
+                lookup.status = HIT
+                self.stats['hits'] += 1
+                return lookup
+        
+        if self.embed is not None:
+            lookup.embedding = self.embed(query)
+            with self._lock:
+                key, similarity = self._nearest(partition, lookup.embedding)
+                if key is not None and similarity >= self.similarity_threshold:
+                    self._entries.move_to_end(key)
+                    lookup.response = self._entries[key].response
+                    lookup.status = SEMANTIC_HIT
+                    lookup.similarity = similarity
+                    self.stats['semantic_hits'] += 1
+                    return lookup
+        
+        self.stats['misses'] += 1
+        return lookup
+    
+    def store(self, lookup: CacheLookup, response: str):
+        """Cache the response generated after a miss (or bypass)."""
+        if lookup.status in (HIT, SEMANTIC_HIT) or not response:
+            return
+        if self.embed is not None and lookup.embedding is None:
+            lookup.embedding = self.embed(lookup.query)
+        
+        with self._lock:
+            self._entries[lookup.key] = CacheEntry(response, lookup.partition, lookup.embedding)
+            self._entries.move_to_end(lookup.key)
+            self.stats['stored'] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evicted'] += 1
+    
+    def clear(self):
+        """Drop every cached response."""
+        with self._lock:
+            self._entries.clear()
+    
+    def metrics(self) -> Dict[str, Any]:
+        """Entry count, counters and hit rate (bypassed requests excluded)."""
+        with self._lock:
+            entries = len(self._entries)
+        hits = self.stats['hits'] + self.stats['semantic_hits']
+        lookups = hits + self.stats['misses']
+        return {
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'semantic': self.embed is not None,
+            **self.stats,
+            'hit_rate': round(hits / lookups, 3) if lookups else 0.0,
+        }
+    
+    def _get(self, key: str) -> Optional[CacheEntry]:
+        # Called with self._lock held
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created_at > self.ttl:
+            del self._entries[key]
+            self.stats['expired'] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+    
+    def _nearest(self, partition: str, embedding: np.ndarray):
+        """(key, cosine similarity) of the closest live entry in a partition."""
+        # Called with self._lock held
+        now = time.monotonic()
+        keys = []
+        vectors = []
+        for key, entry in list(self._entries.items()):
+            if now - entry.created_at > self.ttl:
+                del self._entries[key]
+                self.stats['expired'] += 1
+            elif entry.partition == partition and entry.embedding is not None:
+                keys.append(key)
+                vectors.append(entry.embedding)
+        if not keys:
+            return None, 0.0
+        similarities = np.stack(vectors) @ embedding
+        best = int(similarities.argmax())
+        return keys[best], float(similarities[best])
@@ -0,0 +1,226 @@
+"""
+Session Store - Per-client conversations for the orchestrator API
+
+Keeps ConversationSessions in an in-memory LRU. Sessions pushed out of
+memory are spilled to disk as JSON (history and summary; their KV cache is
+rebuilt from the shared prefix cache on the next turn) and loaded back on
+demand, so many clients can share one loaded model.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from ai_orchestrator import ConversationSession
+
+
+# Session ids double as file names in the spill directory
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+
+class SessionStore:
+    """LRU of conversation sessions with on-disk spill."""
+    
+    def __init__(
+        self,
+        spill_dir: str = "sessions",
+        max_sessions: int = 32,
+        max_kv_sessions: int = 2,
+    ):
+        """
+        Initialize the session store.
+        
+        Args:
+            spill_dir: Directory for sessions evicted from memory
+            max_sessions: Sessions kept in memory
+            max_kv_sessions: Most recently used sessions allowed to keep a KV
+                cache (each can hold hundreds of MB of GPU memory)
+        """
+        self.spill_dir = spill_dir
+        self.max_sessions = max_sessions
+        self.max_kv_sessions = max_kv_sessions
+        self._sessions: "OrderedDict[str, ConversationSession]" = OrderedDict()
+        self._pins: Dict[str, int] = {}  # Sessions in use by a request are never spilled
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'loaded': 0, 'created': 0, 'spilled': 0}
+    
+    @staticmethod
+    def validate_id(session_id: str) -> str:
+        """Return session_id, or raise ValueError if it isn't usable."""
+        if not isinstance(session_id, str) or not SESSION_ID_PATTERN.match(session_id):
+            raise ValueError("session_id must be 1-64 characters of A-Z, a-z, 0-9, '_', '-' or '.'")
+        return session_id
+    
+    def _spill_path(self, session_id: str) -> str:
+        return os.path.join(self.spill_dir, f"{session_id}.json")
+    
+    def _write(self, session: ConversationSession):
+        """Write a session to the spill directory (atomically)."""
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = self._spill_path(session.session_id)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(session.to_dict(), f)
+        os.replace(tmp_path, path)
+    
+    def _read(self, session_id: str) -> Optional[ConversationSession]:
+        try:
+            with open(self._spill_path(session_id), 'r', encoding='utf-8') as f:
+                return ConversationSession.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠ Could not load session {session_id}: {e}")
+            return None
+    
+    def _evict(self):
+        """Spill idle sessions past max_sessions and drop stale KV caches."""
+        # Only the most recently used sessions keep a KV cache
+        for index, session in enumerate(reversed(self._sessions.values())):
+            if index >= self.max_kv_sessions and session.kv_cache is not None:
+                if session.lock.acquire(blocking=False):
+                    session.kv_cache = None
+                    session.lock.release()
+        
+        # Sessions in use are skipped; they'll be spilled once idle
+        for session_id in list(self._sessions):
+            if len(self._sessions) <= self.max_sessions:
+                break
+            if self._pins.get(session_id):
+                continue
+            session = self._sessions[session_id]
+            if not session.lock.acquire(blocking=False):
+                continue
+            try:
+                self._write(session)
+                del self._sessions[session_id]
+                self.stats['spilled'] += 1
+            except OSError as e:
+                print(f"⚠ Could not spill session {session_id}: {e}")
+                break
+            finally:
+                session.lock.release()
+    
+    @contextmanager
+    def use(self, session_id: str, create: bool = True) -> Iterator[Optional[ConversationSession]]:
+        """
+        Get a session and keep it in memory until the block exits.
+        
+        Changes made inside the block are never lost to a concurrent spill.
+        
+        Args:
+            session_id: Session identifier (see validate_id)
+            create: Create the session if it doesn't exist
+            
+        Yields:
+            The session, or None if it doesn't exist and create is False
+        """
+        session = self.get(session_id, create, pin=True)
+        try:
+            yield session
+        finally:
+            if session is not None:
+                with self._lock:
+                    self._pins[session_id] -= 1
+                    if not self._pins[session_id]:
+                        del self._pins[session_id]
+                    self._evict()
+    
+    def get(self, session_id: str, create: bool = True, pin: bool = False) -> Optional[ConversationSession]:
+        """
+        Get a session, loading it from disk or creating it as needed.
+        
+        Use use() instead when modifying the session.
+        
+        Args:
+            session_id: Session identifier (see validate_id)
+            create: Create the session if it doesn't exist
+            pin: Keep the session in memory until unpinned (see use)
+            
+        Returns:
+            The session, or None if it doesn't exist and create is False
+        """
+        self.validate_id(session_id)
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                self.stats['hits'] += 1
+            else:
+                session = self._read(session_id)
+                if session is not None:
+                    self.stats['loaded'] += 1
+                elif create:
+                    session = ConversationSession(session_id)
+                    self.stats['created'] += 1
+                else:
+                    return None
+                self._sessions[session_id] = session
+            
+            session.last_used = time.time()
+            if pin:
+                self._pins[session_id] = self._pins.get(session_id, 0) + 1
+            self._evict()
+            return session
+    
+    def pin_count(self, session_id: str) -> int:
+        """Number of requests currently using a session (see use)."""
+        with self._lock:
+            return self._pins.get(session_id, 0)
+    
+    def delete(self, session_id: str) -> bool:
+        """Delete a session from memory and disk. Returns whether it existed."""
+        self.validate_id(session_id)
+        with self._lock:
+            # A request still using the session keeps its own reference
+            existed = self._sessions.pop(session_id, None) is not None
+            try:
+                os.remove(self._spill_path(session_id))
+                existed = True
+            except FileNotFoundError:
+                pass
+            return existed
+    
+    def list_sessions(self) -> List[Dict]:
+        """Summaries of all sessions, in memory and spilled."""
+        with self._lock:
+            sessions = {
+                session_id: {
+                    'session_id': session_id,
+                    'turn_count': len(session.history),
+                    'last_used': session.last_used,
+                    'in_memory': True,
+                    'kv_cached': session.kv_cache is not None,
+                }
+                for session_id, session in self._sessions.items()
+            }
+        
+        if os.path.isdir(self.spill_dir):
+            for name in os.listdir(self.spill_dir):
+                session_id, ext = os.path.splitext(name)
+                if ext != '.json' or session_id in sessions:
+                    continue
+                session = self._read(session_id)
+                if session is not None:
+                    sessions[session_id] = {
+                        'session_id': session_id,
+                        'turn_count': len(session.history),
+                        'last_used': session.last_used,
+                        'in_memory': False,
+                        'kv_cached': False,
+                    }
+        return sorted(sessions.values(), key=lambda info: info['last_used'], reverse=True)
+    
+    def flush(self):
+        """Write every in-memory session to disk (e.g. at shutdown)."""
+        with self._lock:
+            for session in self._sessions.values():
+                try:
+                    self._write(session)
+                except OSError as e:
+                    print(f"⚠ Could not save session {session.session_id}: {e}")
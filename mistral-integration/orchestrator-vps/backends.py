@@ -0,0 +1,467 @@
+"""
+Inference Backends - Interchangeable model runtimes for the VPS orchestrator
+
+A backend loads a model and turns a formatted prompt into a response:
+
+    backend.generate(prompt, max_new_tokens, should_stop) -> str
+    backend.warmup(max_new_tokens)
+    backend.info() / backend.metrics() -> dict for /info and /metrics
+
+TransformersBackend serves the fine-tuned checkpoint with transformers
+(GPU with 4-bit quantization or CPU with int8/int4, continuous batching,
+speculative decoding).
+LlamaCppBackend serves a GGUF file from deployment/convert_to_gguf.py with
+llama-cpp-python: quantized (Q4_K_M: ~4.4GB for 7B instead of ~28GB of
+float32), memory-mapped and multi-threaded, which makes it the better
+choice without a GPU. select_backend() picks one.
+"""
+
+import glob
+import importlib.util
+import os
+import threading
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, Optional
+
+import torch
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    BitsAndBytesConfig,
+    StoppingCriteriaList,
+    pipeline,
+)
+
+from batch_scheduler import BatchScheduler
+from checkpoint_cache import OFF, CheckpointCache, cpu_quantization_config, load_quantized_model
+from cpu_quantization import INT8, NONE, quantize_for_cpu, weights_size_mb
+from generation_utils import SpeculationStats, StopWhen
+from request_queue import DeadlineExceeded
+
+TRANSFORMERS = 'transformers'
+LLAMA_CPP = 'llama.cpp'
+BACKENDS = ('auto', TRANSFORMERS, LLAMA_CPP)
+
+WARMUP_PROMPT = "[INST] Hello [/INST]"
+
+# How long a batched request may outlive its deadline: should_stop() makes
+# the scheduler retire it at its next step
+SCHEDULER_GRACE_S = 5.0
+
+
+def find_gguf(model_path: str) -> Optional[str]:
+    """
+    GGUF file for a model: model_path itself if it is one, else a .gguf
+    file inside the model directory or next to it with the same name (as
+    convert_to_gguf.py writes them, e.g. mistral-7b-continuity-q4_k_m.gguf).
+    The smallest, i.e. most quantized, candidate wins.
+    """
+    if model_path.endswith('.gguf'):
+        return model_path if os.path.isfile(model_path) else None
+    base = model_path.rstrip('/')
+    candidates = glob.glob(os.path.join(glob.escape(base), '*.gguf')) + glob.glob(glob.escape(base) + '*.gguf')
+    return min(candidates, key=os.path.getsize) if candidates else None
+
+
+def select_backend(backend: str, use_gpu: bool, gguf_path: Optional[str]) -> str:
+    """
+    Resolve a backend setting to TRANSFORMERS or LLAMA_CPP.
+    
+    "auto" uses llama.cpp when there is no GPU to use and a GGUF file
+    and llama-cpp-python are available, transformers otherwise.
+    
+    Raises:
+        ValueError: If the setting is unknown, or llama.cpp is asked for
+            without a GGUF file
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}' (expected one of {', '.join(BACKENDS)})")
+    if backend == LLAMA_CPP and not gguf_path:
+        raise ValueError("The llama.cpp backend needs a GGUF file (set GGUF_PATH)")
+    if backend != 'auto':
+        return backend
+    
+    if use_gpu or not gguf_path:
+        return TRANSFORMERS
+    if importlib.util.find_spec('llama_cpp') is None:
+        print(f"⚠ Install 'llama-cpp-python' to serve {gguf_path} on CPU; using float32 transformers")
+        return TRANSFORMERS
+    return LLAMA_CPP
+
+
+class InferenceBackend:
+    """Interface of the VPS orchestrator's backends."""
+    
+    name = None
+    
+    def generate(
+        self,
+        prompt: str,
+        max_new_tokens: int = 512,
+        should_stop: Optional[Callable[[], bool]] = None,
+        timeout: Optional[float] = None,
+    ) -> str:
+        """
+        Generate response to prompt.
+        
+        Args:
+            prompt: Formatted prompt
+            max_new_tokens: Maximum tokens to generate
+            should_stop: Checked every token; generation ends early
+                once it returns True
+            timeout: Seconds left until the request's deadline (None: no
+                limit); a backend that hands the prompt to another thread
+                stops waiting for it soon after
+                
+        Raises:
+            DeadlineExceeded: If the result did not arrive in time
+        """
+        raise NotImplementedError
+    
+    def warmup(self, max_new_tokens: int = 8):
+        """Run one short greedy generation without starting any thread."""
+        raise NotImplementedError
+    
+    def info(self) -> Dict[str, Any]:
+        """Configuration reported by /info."""
+        return {'backend': self.name}
+    
+    def metrics(self) -> Dict[str, Any]:
+        """Counters reported by /info and /metrics."""
+        return {}
+
+
+class TransformersBackend(InferenceBackend):
+    """Hugging Face checkpoint through transformers (GPU, or CPU with int8/int4 Linear layers)."""
+    
+    name = TRANSFORMERS
+    
+    def __init__(
+        self,
+        model_path: str,
+        use_gpu: bool,
+        quantize: bool,
+        temperature: float,
+        top_p: float,
+        max_batch_size: int = 8,
+        draft_model_path: Optional[str] = None,
+        prompt_lookup_tokens: Optional[int] = None,
+        cpu_quantization: str = INT8,
+        checkpoint_cache: Optional[CheckpointCache] = None,
+    ):
+        """
+        Load the model.
+        
+        Args:
+            model_path: Path to fine-tuned model
+            use_gpu: Whether to use the GPU (checked by the caller)
+            quantize: Whether to quantize (4-bit on the GPU,
+                cpu_quantization on the CPU)
+            temperature: Sampling temperature
+            top_p: Nucleus sampling threshold
+            max_batch_size: Requests decoded together by the batch
+                scheduler (1 generates one request at a time)
+            draft_model_path: Small model for speculative decoding, which
+                lowers the latency of one request at a time (used only
+                with max_batch_size 1)
+            prompt_lookup_tokens: Draft up to this many tokens per pass by
+                copying them from the prompt instead of running a draft
+                model (also only with max_batch_size 1)
+            cpu_quantization: "int8", "int4" or "none" (see
+                orchestrator-app/cpu_quantization.py)
+            checkpoint_cache: Where the quantized model is saved once and
+                loaded from afterwards (None: quantize on every start)
+        """
+        self.model_path = model_path
+        self.use_gpu = use_gpu
+        self.quantize = quantize
+        self.cpu_quantization = None if use_gpu or not quantize else cpu_quantization
+        self.checkpoint_cache = checkpoint_cache
+        self.checkpoint_status = OFF
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_batch_size = max_batch_size
+        self.scheduler = None
+        self.draft_model = None
+        
+        self._load_model()
+        
+        if (draft_model_path or prompt_lookup_tokens) and max_batch_size > 1:
+            print("⚠ Speculative decoding works on one request at a time; "
+                  "set MAX_BATCH_SIZE=1 to use a draft model or prompt lookup")
+            draft_model_path = prompt_lookup_tokens = None
+        if draft_model_path and prompt_lookup_tokens:
+            print("⚠ Both a draft model and prompt lookup set; using the draft model")
+            prompt_lookup_tokens = None
+        self.draft_model_path = draft_model_path
+        self.prompt_lookup_tokens = prompt_lookup_tokens or None
+        if draft_model_path:
+            print(f"Loading draft model from {draft_model_path}...")
+            self.draft_model = AutoModelForCausalLM.from_pretrained(
+                draft_model_path,
+                device_map="auto" if self.use_gpu else "cpu",
+                torch_dtype=torch.float16 if self.use_gpu else torch.float32,
+                trust_remote_code=True,
+            )
+        # Acceptance counters (None without speculative decoding)
+        self.speculation = (
+            SpeculationStats(self.model) if self.draft_model_path or self.prompt_lookup_tokens else None
+        )
+        
+        if max_batch_size > 1:
+            # Its thread starts with the first request, i.e. after any fork
+            self.scheduler = BatchScheduler(
+                self.model,
+                self.tokenizer,
+                max_batch_size=max_batch_size,
+                temperature=self.temperature,
+                top_p=self.top_p,
+            )
+    
+    def _load_model(self):
+        """Load model with appropriate configuration for VPS."""
+        print(f"Loading model from {self.model_path}...")
+        print(f"Using GPU: {self.use_gpu}, Quantization: {self.cpu_quantization or self.quantize}")
+        
+        if self.use_gpu and self.quantize:
+            # Use 4-bit quantization on GPU
+            bnb_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            )
+            
+            self.model, self.checkpoint_status = load_quantized_model(
+                self.checkpoint_cache,
+                self.model_path,
+                bnb_config.to_dict(),
+                lambda: AutoModelForCausalLM.from_pretrained(
+                    self.model_path,
+                    quantization_config=bnb_config,
+                    device_map="auto",
+                    trust_remote_code=True,
+                ),
+                device_map="auto",
+            )
+        elif self.use_gpu:
+            # Use full precision on GPU
+            self.model = AutoModelForCausalLM.from_pretrained(
+                self.model_path,
+                device_map="auto",
+                torch_dtype=torch.float16,
+                trust_remote_code=True,
+            )
+        else:
+            # CPU inference
+            def create():
+                model = AutoModelForCausalLM.from_pretrained(
+                    self.model_path,
+                    device_map="cpu",
+                    torch_dtype=torch.float32,
+                    trust_remote_code=True,
+                )
+                if self.cpu_quantization and self.cpu_quantization != NONE:
+                    quantize_for_cpu(model, self.cpu_quantization)
+                return model
+            
+            self.model, self.checkpoint_status = load_quantized_model(
+                self.checkpoint_cache,
+                self.model_path,
+                cpu_quantization_config(self.cpu_quantization or NONE),
+                create,
+            )
+        
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            self.model_path,
+            trust_remote_code=True,
+        )
+        
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        
+        self.pipe = pipeline(
+            "text-generation",
+            model=self.model,
+            tokenizer=self.tokenizer,
+            max_new_tokens=512,
+            do_sample=True,
+            temperature=self.temperature,
+            top_p=self.top_p,
+        )
+        
+        print("Model loaded successfully!")
+    
+    def generate(
+        self,
+        prompt: str,
+        max_new_tokens: int = 512,
+        should_stop: Optional[Callable[[], bool]] = None,
+        timeout: Optional[float] = None,
+    ) -> str:
+        if self.scheduler is not None:
+            future = self.scheduler.submit(prompt, max_new_tokens, should_stop=should_stop)
+            try:
+                return future.result(timeout=None if timeout is None else timeout + SCHEDULER_GRACE_S)
+            except FutureTimeout:
+                # Don't hold the queue worker; the scheduler drops the row
+                raise DeadlineExceeded("Batched generation did not finish within its deadline")
+        
+        generate_kwargs = {}
+        if should_stop is not None:
+            generate_kwargs['stopping_criteria'] = StoppingCriteriaList([StopWhen(should_stop)])
+        if self.draft_model is not None:
+            generate_kwargs['assistant_model'] = self.draft_model
+        elif self.prompt_lookup_tokens:
+            generate_kwargs['prompt_lookup_num_tokens'] = self.prompt_lookup_tokens
+        
+        if self.speculation is None:
+            outputs = self.pipe(
+                prompt,
+                max_new_tokens=max_new_tokens,
+                return_full_text=False,
+                **generate_kwargs,
+            )
+        else:
+            prompt_length = len(self.tokenizer(prompt).input_ids)
+            with self.speculation.track(prompt_length) as counter:
+                stopping_criteria = generate_kwargs.get('stopping_criteria', StoppingCriteriaList())
+                stopping_criteria.append(counter)
+                generate_kwargs['stopping_criteria'] = stopping_criteria
+                outputs = self.pipe(
+                    prompt,
+                    max_new_tokens=max_new_tokens,
+                    return_full_text=False,
+                    **generate_kwargs,
+                )
+        return outputs[0]['generated_text'].strip()
+    
+    def warmup(self, max_new_tokens: int = 8):
+        # Calls the model directly rather than through the batch scheduler
+        inputs = self.tokenizer(WARMUP_PROMPT, return_tensors="pt").to(self.model.device)
+        with torch.no_grad():
+            self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=self.tokenizer.pad_token_id,
+                assistant_model=self.draft_model,  # Warms the draft model too
+            )
+    
+    def info(self) -> Dict[str, Any]:
+        return {
+            'backend': self.name,
+            'quantize': self.quantize,
+            'cpu_quantization': self.cpu_quantization,
+            'weights_mb': round(weights_size_mb(self.model), 1),
+            'checkpoint_cache': self.checkpoint_status,
+            'max_batch_size': self.max_batch_size,
+            'draft_model': self.draft_model_path,
+            'prompt_lookup_tokens': self.prompt_lookup_tokens,
+        }
+    
+    def metrics(self) -> Dict[str, Any]:
+        metrics_dict = {}
+        if self.scheduler is not None:
+            metrics_dict['scheduler'] = self.scheduler.stats()
+        if self.speculation is not None:
+            metrics_dict['speculation'] = self.speculation.metrics()
+        return metrics_dict
+
+
+class LlamaCppBackend(InferenceBackend):
+    """
+    GGUF model through llama-cpp-python on the CPU.
+    
+    The file is memory-mapped, so its pages live in the page cache and are
+    shared by every process that maps it. One generation runs at a time
+    (a llama.cpp context is not thread-safe) on all of its threads.
+    """
+    
+    name = LLAMA_CPP
+    
+    def __init__(
+        self,
+        model_path: str,
+        temperature: float,
+        top_p: float,
+        context_length: int = 4096,
+        threads: Optional[int] = None,
+    ):
+        """
+        Load the model.
+        
+        Args:
+            model_path: Path to the .gguf file
+            temperature: Sampling temperature
+            top_p: Nucleus sampling threshold
+            context_length: Prompt + response tokens (sizes the KV cache)
+            threads: CPU threads per generation (default: torch's thread
+                count, which gunicorn.conf.py splits between workers)
+        """
+        try:
+            from llama_cpp import Llama
+        except ImportError:
+            raise ImportError("Install 'llama-cpp-python' to serve GGUF models")
+        
+        self.model_path = model_path
+        self.temperature = temperature
+        self.top_p = top_p
+        self.context_length = context_length
+        self.threads = threads or torch.get_num_threads()
+        self._lock = threading.Lock()
+        
+        print(f"Loading GGUF model from {model_path} (llama.cpp, {self.threads} threads)...")
+        self.llm = Llama(
+            model_path=model_path,
+            n_ctx=context_length,
+            n_threads=self.threads,
+            n_gpu_layers=0,
+            use_mmap=True,
+            verbose=False,
+        )
+        print("Model loaded successfully!")
+    
+    def generate(
+        self,
+        prompt: str,
+        max_new_tokens: int = 512,
+        should_stop: Optional[Callable[[], bool]] = None,
+        timeout: Optional[float] = None,
+    ) -> str:
+        pieces = []
+        with self._lock:
+            if should_stop is not None and should_stop():
+                return ""
+            # Sampling as in the transformers pipeline (llama.cpp defaults
+            # add a repetition penalty and min-p)
+            stream = self.llm(
+                prompt,
+                max_tokens=max_new_tokens,
+                temperature=self.temperature,
+                top_p=self.top_p,
+                top_k=50,
+                min_p=0.0,
+                repeat_penalty=1.0,
+                stream=True,
+            )
+            try:
+                for chunk in stream:
+                    pieces.append(chunk['choices'][0]['text'])
+                    if should_stop is not None and should_stop():
+                        break
+            finally:
+                stream.close()
+        return "".join(pieces).strip()
+    
+    def warmup(self, max_new_tokens: int = 8):
+        with self._lock:
+            self.llm(WARMUP_PROMPT, max_tokens=max_new_tokens, temperature=0.0)
+    
+    def info(self) -> Dict[str, Any]:
+        return {
+            'backend': self.name,
+            'model_file': self.model_path,
+            'threads': self.threads,
+            'context_length': self.context_length,
+        }
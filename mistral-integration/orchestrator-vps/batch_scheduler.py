@@ -0,0 +1,379 @@
+"""
+Batch Scheduler - Continuous batching for VPSOrchestrator
+
+One scheduler thread owns the model. HTTP threads queue prompts and wait
+on futures; between decode steps the scheduler prefills newly arrived
+prompts and joins them to the running batch, and sequences that finish
+leave it immediately. A long generation never holds up short ones, and
+every forward pass works on up to max_batch_size sequences.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+
+class GenerationRequest:
+    """A queued prompt, and its generation state once in the batch."""
+    
+    __slots__ = (
+        'prompt', 'max_new_tokens', 'temperature', 'top_p', 'should_stop', 'future',
+        'tokens', 'submitted_at', 'started_at',
+    )
+    
+    def __init__(
+        self,
+        prompt: str,
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.should_stop = should_stop
+        self.future: Future = Future()
+        self.tokens: List[int] = []
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+
+
+class BatchScheduler:
+    """Continuous (iteration-level) batching over a causal LM."""
+    
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = 8,
+        temperature: float = 0.7,
+        top_p: float = 0.95,
+    ):
+        """
+        Initialize the scheduler (submit() starts it on first use).
+        
+        Args:
+            model: Loaded causal LM
+            tokenizer: Its tokenizer
+            max_batch_size: Most sequences decoded together
+            temperature: Default sampling temperature (0 for greedy)
+            top_p: Default nucleus sampling threshold
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.temperature = temperature
+        self.top_p = top_p
+        self.eos_token_id = tokenizer.eos_token_id
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else self.eos_token_id
+        
+        self._queue: "queue.Queue[GenerationRequest]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self._running = False
+        
+        # Running batch: one row per active request
+        self._active: List[GenerationRequest] = []
+        self._cache: Optional[DynamicCache] = None
+        self._mask: Optional[torch.Tensor] = None       # [batch, cached tokens], 0 = left padding
+        self._positions: Optional[torch.Tensor] = None  # [batch] position of the next input token
+        self._next_tokens: Optional[torch.Tensor] = None  # [batch] sampled, not yet fed to the model
+        
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'steps': 0,
+            'generated_tokens': 0,
+            'batch_rows': 0,       # Sum of batch sizes over steps
+            'queue_wait_s': 0.0,   # Sum over started requests
+        }
+    
+    def start(self):
+        """
+        Start the scheduler thread.
+        
+        submit() does this on first use, so a scheduler created before a
+        server forks (gunicorn --preload) gets its thread in each worker.
+        """
+        with self._thread_lock:
+            if self._thread is not None:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+            self._thread.start()
+    
+    def stop(self):
+        """Stop the scheduler thread; unfinished requests fail."""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        
+        # Requests still queued never reached the batch
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request.future.set_running_or_notify_cancel():
+                request.future.set_exception(RuntimeError("Scheduler stopped"))
+                self._stats['failed'] += 1
+    
+    def submit(
+        self,
+        prompt: str,
+        max_new_tokens: int = 512,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ) -> Future:
+        """
+        Queue a prompt for generation.
+        
+        Args:
+            prompt: Prompt text
+            max_new_tokens: Maximum tokens to generate
+            temperature: Sampling temperature (default: scheduler's)
+            top_p: Nucleus sampling threshold (default: scheduler's)
+            should_stop: Checked every step; once it returns True the
+                request leaves the batch with the text generated so far
+                
+        Returns:
+            Future resolving to the generated text
+        """
+        request = GenerationRequest(
+            prompt,
+            max_new_tokens,
+            self.temperature if temperature is None else temperature,
+            self.top_p if top_p is None else top_p,
+            should_stop,
+        )
+        self.start()
+        self._stats['submitted'] += 1
+        self._queue.put(request)
+        return request.future
+    
+    def stats(self) -> Dict:
+        """Counters plus derived averages."""
+        stats = dict(self._stats)
+        stats['active'] = len(self._active)
+        stats['queued'] = self._queue.qsize()
+        stats['avg_batch_size'] = stats['batch_rows'] / stats['steps'] if stats['steps'] else 0.0
+        started = stats['completed'] + stats['failed'] + stats['active']
+        stats['avg_queue_wait_ms'] = stats['queue_wait_s'] * 1000 / started if started else 0.0
+        return stats
+    
+    def _run(self):
+        """Scheduler loop: admit, decode one step, retire."""
+        while self._running:
+            try:
+                admitted = self._take_requests()
+                if admitted:
+                    self._admit(admitted)
+                if self._active:
+                    self._step()
+            except Exception as e:
+                self._fail_active(e)
+        self._fail_active(RuntimeError("Scheduler stopped"))
+    
+    def _take_requests(self) -> List[GenerationRequest]:
+        """Pull queued requests into free batch slots (blocking while idle)."""
+        requests = []
+        free = self.max_batch_size - len(self._active)
+        while len(requests) < free:
+            try:
+                if self._active or requests:
+                    request = self._queue.get_nowait()
+                else:
+                    request = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                break
+            if request.should_stop is not None and request.should_stop():
+                request.future.cancel()
+                continue
+            if request.future.set_running_or_notify_cancel():
+                request.started_at = time.perf_counter()
+                self._stats['queue_wait_s'] += request.started_at - request.submitted_at
+                requests.append(request)
+        return requests
+    
+    def _admit(self, requests: List[GenerationRequest]):
+        """
+        Prefill new prompts together and join them to the running batch.
+        
+        If the prefill fails (out of memory, a prompt the tokenizer
+        rejects), only the new requests fail; the running batch goes on.
+        """
+        try:
+            layers, mask, positions, next_tokens = self._prefill(requests)
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+                self._stats['failed'] += 1
+            return
+        
+        self._active.extend(requests)
+        self._set_batch(layers, mask, positions, next_tokens)
+        self._record(next_tokens, rows=range(len(self._active) - len(requests), len(self._active)))
+    
+    def _prefill(self, requests: List[GenerationRequest]):
+        """
+        Run new prompts through the model and merge their KV caches with the
+        running batch's, without changing the batch.
+        
+        Returns:
+            (layers, mask, positions, next_tokens) for _set_batch
+        """
+        device = self.model.device
+        encoded = [self.tokenizer(r.prompt).input_ids for r in requests]
+        length = max(len(ids) for ids in encoded)
+        
+        # Left-pad so every row's last prompt token is in the final column
+        input_ids = torch.full((len(requests), length), self.pad_token_id, dtype=torch.long)
+        mask = torch.zeros((len(requests), length), dtype=torch.long)
+        for row, ids in enumerate(encoded):
+            input_ids[row, length - len(ids):] = torch.tensor(ids)
+            mask[row, length - len(ids):] = 1
+        input_ids, mask = input_ids.to(device), mask.to(device)
+        positions = (mask.cumsum(-1) - 1).clamp(min=0)
+        
+        with torch.no_grad():
+            output = self.model(
+                input_ids=input_ids,
+                attention_mask=mask,
+                position_ids=positions,
+                past_key_values=DynamicCache(),
+                use_cache=True,
+            )
+        
+        layers = [(layer[0], layer[1]) for layer in output.past_key_values]
+        next_tokens = self._sample(output.logits[:, -1, :], requests)
+        positions = mask.sum(-1)
+        
+        if self._active:
+            # Pad the shorter of the two batches on the left, then stack
+            old_layers = [(layer[0], layer[1]) for layer in self._cache]
+            width = max(self._mask.shape[1], mask.shape[1])
+            layers = [
+                (
+                    torch.cat([self._left_pad(ok, width), self._left_pad(nk, width)]),
+                    torch.cat([self._left_pad(ov, width), self._left_pad(nv, width)]),
+                )
+                for (ok, ov), (nk, nv) in zip(old_layers, layers)
+            ]
+            mask = torch.cat([F.pad(self._mask, (width - self._mask.shape[1], 0)), F.pad(mask, (width - mask.shape[1], 0))])
+            positions = torch.cat([self._positions, positions])
+            next_tokens = torch.cat([self._next_tokens, next_tokens])
+        return layers, mask, positions, next_tokens
+    
+    def _step(self):
+        """Feed every row its last sampled token and sample the next."""
+        mask = F.pad(self._mask, (0, 1), value=1)
+        with torch.no_grad():
+            output = self.model(
+                input_ids=self._next_tokens[:, None],
+                attention_mask=mask,
+                position_ids=self._positions[:, None],
+                past_key_values=self._cache,
+                use_cache=True,
+            )
+        self._cache = output.past_key_values
+        self._mask = mask
+        self._positions = self._positions + 1
+        self._next_tokens = self._sample(output.logits[:, -1, :], self._active)
+        
+        self._stats['steps'] += 1
+        self._stats['batch_rows'] += len(self._active)
+        self._record(self._next_tokens, rows=range(len(self._active)))
+    
+    def _record(self, tokens: torch.Tensor, rows):
+        """Append sampled tokens to their requests and retire finished rows."""
+        finished = []
+        for row, token in zip(rows, tokens[list(rows)].tolist()):
+            request = self._active[row]
+            if token == self.eos_token_id or (request.should_stop is not None and request.should_stop()):
+                finished.append(row)
+                continue
+            request.tokens.append(token)
+            self._stats['generated_tokens'] += 1
+            if len(request.tokens) >= request.max_new_tokens:
+                finished.append(row)
+        
+        if finished:
+            for row in finished:
+                request = self._active[row]
+                text = self.tokenizer.decode(request.tokens, skip_special_tokens=True).strip()
+                request.future.set_result(text)
+                self._stats['completed'] += 1
+            self._retire(finished)
+    
+    def _retire(self, finished: List[int]):
+        """Drop finished rows from the batch."""
+        done = set(finished)
+        keep = [row for row in range(len(self._active)) if row not in done]
+        self._active = [self._active[row] for row in keep]
+        if not keep:
+            self._reset()
+            return
+        
+        index = torch.tensor(keep, device=self._mask.device)
+        mask = self._mask[index]
+        # Columns that are padding for every remaining row can go
+        first = int((mask.sum(0) > 0).nonzero()[0])
+        layers = [
+            (layer[0][index][:, :, first:], layer[1][index][:, :, first:])
+            for layer in self._cache
+        ]
+        self._set_batch(layers, mask[:, first:], self._positions[index], self._next_tokens[index])
+    
+    def _set_batch(self, layers, mask, positions, next_tokens):
+        # Filled through update(): DynamicCache(layers) needs transformers 4.47+
+        self._cache = DynamicCache()
+        for index, (key, value) in enumerate(layers):
+            self._cache.update(key, value, index)
+        self._mask = mask
+        self._positions = positions
+        self._next_tokens = next_tokens
+    
+    def _reset(self):
+        self._active = []
+        self._cache = self._mask = self._positions = self._next_tokens = None
+    
+    def _fail_active(self, error: Exception):
+        """Fail every request in the batch and start over with an empty one."""
+        for request in self._active:
+            if not request.future.done():
+                request.future.set_exception(error)
+                self._stats['failed'] += 1
+        self._reset()
+    
+    @staticmethod
+    def _left_pad(tensor: torch.Tensor, width: int) -> torch.Tensor:
+        """Left-pad a [batch, heads, tokens, dim] cache tensor to width tokens."""
+        return F.pad(tensor, (0, 0, width - tensor.shape[2], 0))
+    
+    def _sample(self, logits: torch.Tensor, requests: List[GenerationRequest]) -> torch.Tensor:
+        """Sample one token per row with each request's temperature and top_p."""
+        logits = logits.float()
+        temperature = torch.tensor([r.temperature for r in requests], device=logits.device)
+        top_p = torch.tensor([r.top_p for r in requests], device=logits.device)
+        greedy = logits.argmax(-1)
+        
+        probs = torch.softmax(logits / temperature.clamp(min=1e-5)[:, None], dim=-1)
+        sorted_probs, sorted_ids = probs.sort(dim=-1, descending=True)
+        # Keep the smallest prefix whose mass reaches top_p (always at least one token)
+        outside = sorted_probs.cumsum(-1) - sorted_probs > top_p[:, None]
+        sorted_probs = sorted_probs.masked_fill(outside, 0.0)
+        choice = torch.multinomial(sorted_probs, 1)
+        sampled = sorted_ids.gather(-1, choice).squeeze(-1)
+        
+        return torch.where(temperature > 0, sampled, greedy)
@@ -0,0 +1,201 @@
+"""
+Benchmark continuous batching against one-at-a-time generation.
+
+Runs N concurrent clients against (a) model.generate behind a lock, which
+is what a single worker without the scheduler does, and (b) BatchScheduler,
+and reports throughput and latency percentiles for each.
+
+    python benchmark_batching.py                      # tiny random model
+    python benchmark_batching.py --model ./models/mistral-7b-continuity
+
+Without --model a small random Mistral is built, with a tokenizer trained
+on the continuity dataset, so the benchmark runs offline on a CPU. Its
+numbers show scheduling overhead and batching gains, not model quality.
+"""
+
+import argparse
+import json
+import statistics
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from batch_scheduler import BatchScheduler
+
+
+DATASET = Path(__file__).parent.parent / "training-data" / "continuity_dataset.json"
+
+
+def load_prompts() -> List[str]:
+    """Instruction prompts from the training dataset."""
+    with open(DATASET, encoding='utf-8') as f:
+        examples = json.load(f)
+    return [f"[INST] {e['instruction']} [/INST]" for e in examples]
+
+
+def build_tiny_model(hidden_size: int, layers: int):
+    """Random Mistral-architecture model with a locally trained BPE tokenizer."""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import MistralConfig, MistralForCausalLM, PreTrainedTokenizerFast
+    
+    with open(DATASET, encoding='utf-8') as f:
+        texts = [e['instruction'] + " " + e['response'] for e in json.load(f)]
+    
+    bpe = Tokenizer(models.BPE(unk_token="<unk>"))
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    bpe.train_from_iterator(texts, trainers.BpeTrainer(
+        vocab_size=2000,
+        special_tokens=["<unk>", "<s>", "</s>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    ))
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=bpe,
+        unk_token="<unk>",
+        bos_token="<s>",
+        eos_token="</s>",
+        pad_token="</s>",
+    )
+    
+    torch.manual_seed(0)
+    config = MistralConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=layers,
+        num_attention_heads=8,
+        num_key_value_heads=4,
+        max_position_embeddings=4096,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    return MistralForCausalLM(config).eval(), tokenizer
+
+
+def load_model(model_path: str):
+    """Load a real model the way VPSOrchestrator does on CPU/GPU (no quantization)."""
+    use_gpu = torch.cuda.is_available()
+    model = AutoModelForCausalLM.from_pretrained(
+        model_path,
+        device_map="auto" if use_gpu else "cpu",
+        torch_dtype=torch.float16 if use_gpu else torch.float32,
+        trust_remote_code=True,
+    ).eval()
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return model, tokenizer
+
+
+def run_clients(generate, prompts: List[str], clients: int, requests_per_client: int) -> Dict:
+    """
+    Run clients in parallel, each sending requests back to back.
+    
+    Args:
+        generate: Callable(prompt) -> number of generated tokens
+        prompts: Prompts, used round-robin
+        clients: Concurrent clients
+        requests_per_client: Requests each client sends
+        
+    Returns:
+        Dictionary with throughput and latency figures
+    """
+    latencies = []
+    tokens = []
+    lock = threading.Lock()
+    
+    def client(index: int):
+        for i in range(requests_per_client):
+            prompt = prompts[(index * requests_per_client + i) % len(prompts)]
+            start = time.perf_counter()
+            count = generate(prompt)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                tokens.append(count)
+    
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'wall_s': wall,
+        'req_per_s': len(latencies) / wall,
+        'tok_per_s': sum(tokens) / wall,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark continuous batching")
+    parser.add_argument('--model', help='Model path (default: tiny random Mistral)')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32],
+                        help='Concurrent client counts to test')
+    parser.add_argument('--requests-per-client', type=int, default=4)
+    parser.add_argument('--max-new-tokens', type=int, default=64)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--hidden-size', type=int, default=256, help='Tiny model width')
+    parser.add_argument('--layers', type=int, default=4, help='Tiny model depth')
+    args = parser.parse_args()
+    
+    if args.model:
+        model, tokenizer = load_model(args.model)
+        print(f"Model: {args.model}")
+    else:
+        model, tokenizer = build_tiny_model(args.hidden_size, args.layers)
+        print(f"Model: tiny random Mistral (hidden {args.hidden_size}, {args.layers} layers)")
+    
+    prompts = load_prompts()
+    device_lock = threading.Lock()
+    
+    def serial(prompt: str) -> int:
+        inputs = tokenizer(prompt, return_tensors='pt').to(model.device)
+        with device_lock, torch.no_grad():
+            output = model.generate(
+                **inputs,
+                max_new_tokens=args.max_new_tokens,
+                do_sample=True,
+                temperature=0.7,
+                top_p=0.95,
+                pad_token_id=tokenizer.pad_token_id,
+            )
+        return output.shape[1] - inputs.input_ids.shape[1]
+    
+    scheduler = BatchScheduler(model, tokenizer, max_batch_size=args.max_batch_size)
+    scheduler.start()
+    
+    def batched(prompt: str) -> int:
+        text = scheduler.submit(prompt, args.max_new_tokens).result()
+        return len(tokenizer(text, add_special_tokens=False).input_ids)
+    
+    # Warm up both paths once
+    serial(prompts[0])
+    batched(prompts[0])
+    
+    print(f"\n{'clients':>7}  {'mode':<9} {'req/s':>7} {'tok/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for clients in args.clients:
+        for mode, generate in (('serial', serial), ('batched', batched)):
+            result = run_clients(generate, prompts, clients, args.requests_per_client)
+            print(f"{clients:>7}  {mode:<9} {result['req_per_s']:>7.2f} {result['tok_per_s']:>8.1f} "
+                  f"{result['p50_ms']:>8.0f} {result['p95_ms']:>8.0f}")
+    
+    stats = scheduler.stats()
+    print(f"\nScheduler: {stats['steps']} decode steps, average batch {stats['avg_batch_size']:.1f}, "
+          f"average queue wait {stats['avg_queue_wait_ms']:.0f} ms")
+    scheduler.stop()
+
+
+if __name__ == "__main__":
+    main()
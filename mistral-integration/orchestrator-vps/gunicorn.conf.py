@@ -0,0 +1,76 @@
+"""
+Gunicorn settings for the VPS orchestrator.
+
+    gunicorn -c gunicorn.conf.py orchestrator_api:app
+
+With PRELOAD=true (the default) the master loads the model before
+forking, so every worker shares one copy of the weights: forked pages stay
+shared until written, and inference only reads them. The master does this
+on one torch thread and runs no generation, since an OpenMP (libgomp)
+thread pool started before fork() can hang the workers. Each worker runs
+the warmup generation itself before it serves. Worker threads (request
+queue, batch scheduler) are started lazily, after the fork.
+
+CUDA does not survive fork(), so on a GPU the master loads nothing and each
+worker loads and warms up its own model before serving (keep WORKERS=1
+there; the batch scheduler already shares one model between requests).
+The llama.cpp backend also loads in each worker: its GGUF file is
+memory-mapped, so workers share its pages through the page cache without
+the master holding llama.cpp threads across fork().
+"""
+
+import gc
+import os
+
+# Ask NVML, not the CUDA runtime, whether a GPU is there, so the master
+# can check without initializing CUDA before it forks
+os.environ.setdefault('PYTORCH_NVML_BASED_CUDA_CHECK', '1')
+
+bind = f"127.0.0.1:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WORKERS', '1'))
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', '32'))
+preload_app = os.environ.get('PRELOAD', 'true').lower() == 'true'
+# Loading a model in a worker can take minutes
+timeout = int(os.environ.get('WORKER_TIMEOUT', '300'))
+
+
+def uses_cuda() -> bool:
+    import torch
+    return os.environ.get('USE_GPU', 'true').lower() == 'true' and torch.cuda.is_available()
+
+
+def when_ready(server):
+    """Master, after the app is imported and before workers are forked."""
+    if not preload_app:
+        return
+    
+    import orchestrator_api
+    if orchestrator_api.serving_backend() == 'llama.cpp':
+        server.log.info("llama.cpp maps the GGUF file in each worker; skipping preload")
+        return
+    if uses_cuda():
+        server.log.warning("⚠ CUDA cannot be shared across fork(); each worker loads its own model")
+        return
+    
+    # A single thread keeps libgomp from starting its pool in the master;
+    # post_fork() gives each worker its share of the cores
+    import torch
+    torch.set_num_threads(1)
+    orchestrator_api.preload(warmup=False)
+    # Move everything allocated so far out of the collector's reach, so
+    # collections in the workers do not write to (and copy) shared pages
+    gc.freeze()
+    server.log.info("Model preloaded; forking %d worker(s)", workers)
+
+
+def post_fork(server, worker):
+    """Worker, straight after fork: split the CPU cores between workers (torch and llama.cpp)."""
+    import torch
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+
+
+def post_worker_init(worker):
+    """Worker, before it serves: warm up (and load, if the master did not)."""
+    import orchestrator_api
+    orchestrator_api.preload()
@@ -3,37 +3,111 @@ VPS Orchestrator API - Remote server for orchestrator ecosystem
 
 Provides remote AI capabilities and backup processing for the orchestrator system.
 Optimized for CPU or cloud GPU instances.
+
+Requests go through a bounded queue shared with the desktop app
+(orchestrator-app/request_queue.py): 429 when it is full, 504 when a
+request misses its deadline ("timeout" in seconds), and "priority":
+"batch" (or an X-Priority header) to yield to interactive requests.
+
+The model runs on an inference backend (backends.py): transformers, or
+without a GPU a GGUF file through llama.cpp (BACKEND, GGUF_PATH).
+
+Under gunicorn (gunicorn.conf.py) the model is loaded in the master before
+workers fork, so they share its weights, and each worker warms it up
+before it serves.
+
+/generate responses are cached (orchestrator-app/response_cache.py) by
+prompt, sampling parameters and model; the X-Cache response header says
+whether one was served, and "Cache-Control: no-cache" asks for a fresh one.
+
+The modules shared with the desktop app (request_queue, response_cache,
+generation_utils, checkpoint_cache, cpu_quantization) live in
+orchestrator-app: deploy_vps.sh copies them here, and running from a
+checkout needs PYTHONPATH=../orchestrator-app.
 """
 
 from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import torch
-from transformers import (
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    BitsAndBytesConfig,
-    pipeline,
-)
+import functools
 import json
 import time
 import os
-from typing import List, Dict, Optional
+import threading
+from typing import Callable, List, Dict, Optional, Tuple
+
+from backends import LLAMA_CPP, LlamaCppBackend, TransformersBackend, find_gguf, select_backend
+from checkpoint_cache import DEFAULT_CACHE_DIR, CheckpointCache
+from request_queue import (
+    DeadlineExceeded,
+    QueueFull,
+    RequestQueue,
+    parse_options,
+)
+from response_cache import CacheLookup, ResponseCache, load_embedder, model_version, wants_fresh
 
 app = Flask(__name__)
 CORS(app)
 
 # Global orchestrator instance
 orchestrator = None
+orchestrator_lock = threading.Lock()
+
+MODEL_PATH = os.environ.get('MODEL_PATH', './models/mistral-7b-continuity')
+# Inference backend (backends.py): with BACKEND=auto, a GGUF file (GGUF_PATH,
+# default: found next to MODEL_PATH) is served by llama.cpp when there is no GPU
+BACKEND = os.environ.get('BACKEND', 'auto')
+GGUF_PATH = os.environ.get('GGUF_PATH') or find_gguf(MODEL_PATH)
+
+
+@functools.lru_cache(maxsize=None)
+def serving_backend() -> str:
+    """Backend this process serves with, resolved from the environment without loading a model."""
+    use_gpu = os.environ.get('USE_GPU', 'true').lower() == 'true' and torch.cuda.is_available()
+    return select_backend(BACKEND, use_gpu, GGUF_PATH)
+
+
+# One queue worker per batch slot, so the scheduler can fill its batch
+# (llama.cpp runs one generation at a time)
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '8'))
+request_queue = RequestQueue(
+    max_queue=int(os.environ.get('MAX_QUEUE', '32')),
+    workers=1 if serving_backend() == LLAMA_CPP else max(1, MAX_BATCH_SIZE),
+    default_timeout=float(os.environ.get('REQUEST_TIMEOUT', '120')),
+)
+
+# Responses to repeated prompts (RESPONSE_CACHE_SIZE=0 disables the cache,
+# SEMANTIC_CACHE=true also serves them to paraphrases)
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '1024'))
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_SIZE,
+    ttl=float(os.environ.get('RESPONSE_CACHE_TTL', '3600')),
+    embed=load_embedder() if os.environ.get('SEMANTIC_CACHE', 'false').lower() == 'true' else None,
+    similarity_threshold=float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', '0.92')),
+) if RESPONSE_CACHE_SIZE > 0 else None
 
 
 class VPSOrchestrator:
     """VPS orchestrator optimized for server deployment."""
     
+    # Sampling settings (part of the response cache key)
+    temperature = 0.7
+    top_p = 0.95
+    
     def __init__(
         self,
         model_path: str,
         use_gpu: bool = True,
         quantize: bool = True,
+        max_batch_size: int = 8,
+        draft_model_path: Optional[str] = None,
+        prompt_lookup_tokens: Optional[int] = None,
+        backend: str = 'auto',
+        gguf_path: Optional[str] = None,
+        context_length: int = 4096,
+        threads: Optional[int] = None,
+        cpu_quantization: str = 'int8',
+        checkpoint_cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
     ):
         """
         Initialize VPS orchestrator.
@@ -41,104 +115,188 @@ class VPSOrchestrator:
         Args:
             model_path: Path to fine-tuned model
             use_gpu: Whether to use GPU (if available)
-            quantize: Whether to use quantization
+            quantize: Whether to use quantization (4-bit on the GPU,
+                cpu_quantization on the CPU)
+            max_batch_size: Requests decoded together by the batch
+                scheduler (1 generates one request at a time)
+            draft_model_path: Small model for speculative decoding, which
+                lowers the latency of one request at a time (used only
+                with max_batch_size 1)
+            prompt_lookup_tokens: Draft up to this many tokens per pass by
+                copying them from the prompt instead of running a draft
+                model (also only with max_batch_size 1)
+            backend: "transformers", "llama.cpp" or "auto" (llama.cpp
+                on CPU when a GGUF file is available; see backends.py)
+            gguf_path: GGUF file for llama.cpp (default: found next to
+                model_path)
+            context_length: llama.cpp context size in tokens
+            threads: llama.cpp CPU threads (default: torch's thread count)
+            cpu_quantization: Linear layers on the CPU: "int8" (dynamic
+                quantization), "int4" (weight-only) or "none" (float32)
+            checkpoint_cache_dir: Where the quantized model is saved on
+                the first start and loaded from afterwards; None to
+                quantize on every start
+            
+        Batching, quantization and speculative decoding settings apply to
+        the transformers backend only.
         """
         self.model_path = model_path
         self.use_gpu = use_gpu and torch.cuda.is_available()
-        self.quantize = quantize
-        
-        self._load_model()
+        self.warmup_time = None
+        start = time.perf_counter()
         
-    def _load_model(self):
-        """Load model with appropriate configuration for VPS."""
-        print(f"Loading model from {self.model_path}...")
-        print(f"Using GPU: {self.use_gpu}, Quantization: {self.quantize}")
-        
-        if self.use_gpu and self.quantize:
-            # Use 4-bit quantization on GPU
-            bnb_config = BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_use_double_quant=True,
-                bnb_4bit_quant_type="nf4",
-                bnb_4bit_compute_dtype=torch.bfloat16,
-            )
-            
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_path,
-                quantization_config=bnb_config,
-                device_map="auto",
-                trust_remote_code=True,
-            )
-        elif self.use_gpu:
-            # Use full precision on GPU
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_path,
-                device_map="auto",
-                torch_dtype=torch.float16,
-                trust_remote_code=True,
+        if gguf_path is None:
+            gguf_path = find_gguf(model_path)
+        if select_backend(backend, self.use_gpu, gguf_path) == LLAMA_CPP:
+            if draft_model_path or prompt_lookup_tokens:
+                print("⚠ Speculative decoding is not available with llama.cpp; ignoring it")
+            self.backend = LlamaCppBackend(
+                gguf_path,
+                temperature=self.temperature,
+                top_p=self.top_p,
+                context_length=context_length,
+                threads=threads,
             )
         else:
-            # CPU inference
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_path,
-                device_map="cpu",
-                torch_dtype=torch.float32,
-                trust_remote_code=True,
+            self.backend = TransformersBackend(
+                model_path,
+                use_gpu=self.use_gpu,
+                quantize=quantize,
+                temperature=self.temperature,
+                top_p=self.top_p,
+                max_batch_size=max_batch_size,
+                draft_model_path=draft_model_path,
+                prompt_lookup_tokens=prompt_lookup_tokens,
+                cpu_quantization=cpu_quantization,
+                checkpoint_cache=CheckpointCache(checkpoint_cache_dir) if checkpoint_cache_dir else None,
             )
-        
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            self.model_path,
-            trust_remote_code=True,
-        )
-        
-        if self.tokenizer.pad_token is None:
-            self.tokenizer.pad_token = self.tokenizer.eos_token
-        
-        self.pipe = pipeline(
-            "text-generation",
-            model=self.model,
-            tokenizer=self.tokenizer,
-            max_new_tokens=512,
-            do_sample=True,
-            temperature=0.7,
-            top_p=0.95,
-        )
-        
-        print("Model loaded successfully!")
+        self.load_time = time.perf_counter() - start
     
     def generate(
         self,
         prompt: str,
         max_new_tokens: int = 512,
+        should_stop: Optional[Callable[[], bool]] = None,
+        timeout: Optional[float] = None,
     ) -> str:
-        """Generate response to prompt."""
-        outputs = self.pipe(
-            prompt,
-            max_new_tokens=max_new_tokens,
-            return_full_text=False,
-        )
-        return outputs[0]['generated_text'].strip()
+        """
+        Generate response to prompt.
+        
+        Args:
+            prompt: Formatted prompt
+            max_new_tokens: Maximum tokens to generate
+            should_stop: Checked every token; generation ends early
+                once it returns True
+            timeout: Seconds left until the request's deadline
+        """
+        return self.backend.generate(prompt, max_new_tokens, should_stop=should_stop, timeout=timeout)
+    
+    def warmup(self, max_new_tokens: int = 8) -> float:
+        """
+        Run one short generation so the first real request does not pay
+        for first-touch page faults and lazy kernel/allocator setup.
+        
+        Calls the model directly rather than through the batch scheduler,
+        so no thread is started (this may run in a process that forks).
+        
+        Args:
+            max_new_tokens: Tokens to generate
+            
+        Returns:
+            Seconds the warmup took
+        """
+        start = time.perf_counter()
+        self.backend.warmup(max_new_tokens)
+        self.warmup_time = time.perf_counter() - start
+        print(f"Warmup generation took {self.warmup_time:.2f}s")
+        return self.warmup_time
 
 
 def get_orchestrator() -> VPSOrchestrator:
     """Get or create orchestrator instance."""
     global orchestrator
     if orchestrator is None:
-        model_path = os.environ.get(
-            'MODEL_PATH',
-            './models/mistral-7b-continuity'
-        )
-        use_gpu = os.environ.get('USE_GPU', 'true').lower() == 'true'
-        quantize = os.environ.get('QUANTIZE', 'true').lower() == 'true'
-        
-        orchestrator = VPSOrchestrator(
-            model_path=model_path,
-            use_gpu=use_gpu,
-            quantize=quantize,
-        )
+        with orchestrator_lock:
+            if orchestrator is None:
+                use_gpu = os.environ.get('USE_GPU', 'true').lower() == 'true'
+                quantize = os.environ.get('QUANTIZE', 'true').lower() == 'true'
+                
+                orchestrator = VPSOrchestrator(
+                    model_path=MODEL_PATH,
+                    use_gpu=use_gpu,
+                    quantize=quantize,
+                    max_batch_size=MAX_BATCH_SIZE,
+                    draft_model_path=os.environ.get('DRAFT_MODEL_PATH') or None,
+                    prompt_lookup_tokens=int(os.environ.get('PROMPT_LOOKUP_TOKENS', '0')),
+                    backend=serving_backend(),
+                    gguf_path=GGUF_PATH,
+                    context_length=int(os.environ.get('CONTEXT_LENGTH', '4096')),
+                    threads=int(os.environ.get('LLAMA_THREADS', '0')) or None,
+                    cpu_quantization=os.environ.get('CPU_QUANTIZATION', 'int8'),
+                    checkpoint_cache_dir=os.environ.get('CHECKPOINT_CACHE_DIR', DEFAULT_CACHE_DIR) or None,
+                )
     return orchestrator
 
 
+def preload(warmup: bool = True) -> VPSOrchestrator:
+    """
+    Load and warm up the orchestrator ahead of the first request.
+    
+    gunicorn.conf.py loads the model in the master before forking, so
+    workers share one copy of the weights, and warms it up in each worker
+    before it serves. Later calls return the loaded orchestrator.
+    
+    Args:
+        warmup: Also run the warmup generation (if not run yet)
+    """
+    orch = get_orchestrator()
+    if warmup and orch.warmup_time is None:
+        orch.warmup()
+    return orch
+
+
+def get_request_options(data: dict) -> Tuple[str, Optional[float]]:
+    """
+    Get a generation request's priority class and timeout.
+    
+    Raises:
+        ValueError: If the timeout is not a number
+    """
+    return parse_options(data.get('priority') or request.headers.get('X-Priority'), data.get('timeout'))
+
+
+def lookup_response(prompt: str, max_tokens: int, cache_control: Optional[str]) -> Optional[CacheLookup]:
+    """
+    Look a prompt up in the response cache (None when the cache is off).
+    
+    Args:
+        prompt: Formatted prompt
+        max_tokens: Requested max_tokens
+        cache_control: The request's Cache-Control header
+    """
+    if response_cache is None:
+        return None
+    return response_cache.lookup(
+        prompt,
+        {
+            'max_new_tokens': max_tokens,
+            'temperature': VPSOrchestrator.temperature,
+            'top_p': VPSOrchestrator.top_p,
+        },
+        model_version(GGUF_PATH if serving_backend() == LLAMA_CPP else MODEL_PATH),
+        fresh=wants_fresh(cache_control),
+    )
+
+
+def queue_error_response(error: Exception):
+    """HTTP response for a request the queue rejected or timed out."""
+    if isinstance(error, QueueFull):
+        response = jsonify({'error': str(error)})
+        response.headers['Retry-After'] = str(request_queue.retry_after())
+        return response, 429
+    return jsonify({'error': str(error)}), 504
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint."""
@@ -157,7 +315,9 @@ def generate():
     Request body:
     {
         "prompt": "Formatted prompt",
-        "max_tokens": 512
+        "max_tokens": 512,
+        "priority": "interactive",
+        "timeout": 120
     }
     """
     data = request.json
@@ -167,30 +327,64 @@ def generate():
     if not prompt:
         return jsonify({'error': 'Prompt is required'}), 400
     
-    try:
+    lookup = lookup_response(prompt, max_tokens, request.headers.get('Cache-Control'))
+    if lookup is not None and lookup.response is not None:
+        result = jsonify({
+            'response': lookup.response,
+            'timestamp': time.time(),
+        })
+        result.headers['X-Cache'] = lookup.status
+        return result
+    
+    def run(item) -> str:
         orch = get_orchestrator()
-        response = orch.generate(prompt, max_tokens)
+        response = orch.generate(prompt, max_tokens, should_stop=item.should_stop, timeout=item.remaining())
+        if lookup is not None and not item.should_stop():
+            response_cache.store(lookup, response)
+        return response
+    
+    try:
+        priority, timeout = get_request_options(data)
+        item = request_queue.submit(run, priority, timeout)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except QueueFull as e:
+        return queue_error_response(e)
+    
+    try:
+        response = request_queue.wait(item)
         
-        return jsonify({
+        result = jsonify({
             'response': response,
             'timestamp': time.time(),
         })
+        if lookup is not None:
+            result.headers['X-Cache'] = lookup.status
+        return result
+    except DeadlineExceeded as e:
+        return queue_error_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/info', methods=['GET'])
-def info():
-    """Get server and model information."""
+def get_info() -> Dict:
+    """Server, model, backend and queue information (also used by the ASGI app)."""
     orch = get_orchestrator()
     
     info_dict = {
         'model_path': orch.model_path,
         'use_gpu': orch.use_gpu,
-        'quantize': orch.quantize,
         'cuda_available': torch.cuda.is_available(),
+        **orch.backend.info(),
+        'load_time': orch.load_time,
+        'warmup_time': orch.warmup_time,
+        'pid': os.getpid(),
     }
     
+    info_dict.update(orch.backend.metrics())
+    info_dict['queue'] = request_queue.metrics()
+    info_dict['response_cache'] = response_cache.metrics() if response_cache is not None else None
+    
     if torch.cuda.is_available():
         info_dict.update({
             'cuda_device_count': torch.cuda.device_count(),
@@ -199,7 +393,30 @@ def info():
             'cuda_memory_reserved': torch.cuda.memory_reserved() / 1e9,
         })
     
-    return jsonify(info_dict)
+    return info_dict
+
+
+def get_metrics() -> Dict:
+    """Request queue, response cache and backend metrics (also used by the ASGI app)."""
+    metrics_dict = {
+        'queue': request_queue.metrics(),
+        'response_cache': response_cache.metrics() if response_cache is not None else None,
+    }
+    if orchestrator is not None:
+        metrics_dict.update(orchestrator.backend.metrics())
+    return metrics_dict
+
+
+@app.route('/info', methods=['GET'])
+def info():
+    """Get server and model information."""
+    return jsonify(get_info())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Request queue depth, outcomes and wait/run times."""
+    return jsonify(get_metrics())
 
 
 @app.route('/cache/clear', methods=['POST'])
@@ -222,11 +439,22 @@ if __name__ == '__main__':
     
     print(f"Starting VPS Orchestrator API on {args.host}:{args.port}")
     print("Environment variables:")
-    print(f"  MODEL_PATH: {os.environ.get('MODEL_PATH', './models/mistral-7b-continuity')}")
+    print(f"  MODEL_PATH: {MODEL_PATH}")
+    print(f"  BACKEND: {BACKEND} ({serving_backend()})")
+    print(f"  GGUF_PATH: {GGUF_PATH or ''}")
     print(f"  USE_GPU: {os.environ.get('USE_GPU', 'true')}")
     print(f"  QUANTIZE: {os.environ.get('QUANTIZE', 'true')}")
+    print(f"  CPU_QUANTIZATION: {os.environ.get('CPU_QUANTIZATION', 'int8')}")
+    print(f"  CHECKPOINT_CACHE_DIR: {os.environ.get('CHECKPOINT_CACHE_DIR', DEFAULT_CACHE_DIR)}")
+    print(f"  MAX_BATCH_SIZE: {MAX_BATCH_SIZE}")
+    print(f"  DRAFT_MODEL_PATH: {os.environ.get('DRAFT_MODEL_PATH', '')}")
+    print(f"  PROMPT_LOOKUP_TOKENS: {os.environ.get('PROMPT_LOOKUP_TOKENS', '0')}")
+    print(f"  MAX_QUEUE: {request_queue.max_queue}")
+    print(f"  REQUEST_TIMEOUT: {request_queue.default_timeout}")
+    print(f"  RESPONSE_CACHE_SIZE: {RESPONSE_CACHE_SIZE}")
     
-    # For production, use gunicorn:
-    # gunicorn -w 4 -b 0.0.0.0:5000 orchestrator_api:app
+    # For production, use gunicorn (settings in gunicorn.conf.py: one
+    # threaded worker by default, model preloaded before fork, warmed up in each worker):
+    # gunicorn -c gunicorn.conf.py orchestrator_api:app
     
-    app.run(host=args.host, port=args.port, debug=False)
+    app.run(host=args.host, port=args.port, debug=False, threaded=True)
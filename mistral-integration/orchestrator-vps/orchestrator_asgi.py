@@ -0,0 +1,166 @@
+"""
+VPS Orchestrator ASGI API - Async variant of orchestrator_api.py
+
+Serves the same endpoints and shares that module's orchestrator and
+request queue (configured from the same environment variables).
+Generation runs on the queue's worker threads and the batch scheduler;
+handlers only await it, so waiting requests hold no thread, and a request
+is cancelled as soon as its client disconnects. With PRELOAD=true (the
+default) the model is loaded and warmed up before the server accepts
+requests.
+
+Run with:
+    uvicorn orchestrator_asgi:app --host 0.0.0.0 --port 5000
+"""
+
+import contextlib
+import json
+import os
+import time
+
+import torch
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+import orchestrator_api as api
+from request_queue import (
+    DeadlineExceeded,
+    QueueFull,
+    RequestCancelled,
+    parse_options,
+)
+
+
+def error_response(error, status: int) -> JSONResponse:
+    return JSONResponse({'error': str(error)}, status_code=status)
+
+
+async def health(request: Request) -> JSONResponse:
+    """Health check endpoint."""
+    return JSONResponse({
+        'status': 'healthy',
+        'model_loaded': api.orchestrator is not None,
+        'gpu_available': torch.cuda.is_available(),
+    })
+
+
+async def generate(request: Request) -> JSONResponse:
+    """Generate response to prompt (body and response as orchestrator_api /generate)."""
+    body = await request.body()
+    data = json.loads(body) if body else {}
+    prompt = data.get('prompt', '')
+    max_tokens = data.get('max_tokens', 512)
+    
+    if not prompt:
+        return error_response('Prompt is required', 400)
+    
+    # May embed the prompt, so off the event loop
+    lookup = await run_in_threadpool(
+        api.lookup_response, prompt, max_tokens, request.headers.get('Cache-Control'),
+    )
+    cache_headers = {'X-Cache': lookup.status} if lookup is not None else None
+    if lookup is not None and lookup.response is not None:
+        return JSONResponse(
+            {'response': lookup.response, 'timestamp': time.time()},
+            headers=cache_headers,
+        )
+    
+    def run(item) -> str:
+        orch = api.get_orchestrator()
+        response = orch.generate(prompt, max_tokens, should_stop=item.should_stop, timeout=item.remaining())
+        if lookup is not None and not item.should_stop():
+            api.response_cache.store(lookup, response)
+        return response
+    
+    try:
+        priority, timeout = parse_options(
+            data.get('priority') or request.headers.get('X-Priority'),
+            data.get('timeout'),
+        )
+        item = api.request_queue.submit(run, priority, timeout)
+    except ValueError as e:
+        return error_response(e, 400)
+    except QueueFull as e:
+        return JSONResponse(
+            {'error': str(e)},
+            status_code=429,
+            headers={'Retry-After': str(api.request_queue.retry_after())},
+        )
+    
+    try:
+        response = await api.request_queue.wait_async(item, request.is_disconnected)
+        
+        return JSONResponse(
+            {
+                'response': response,
+                'timestamp': time.time(),
+            },
+            headers=cache_headers,
+        )
+    except DeadlineExceeded as e:
+        return error_response(e, 504)
+    except RequestCancelled as e:
+        return error_response(e, 499)  # Nobody is listening any more
+    except Exception as e:
+        return error_response(e, 500)
+
+
+async def info(request: Request) -> JSONResponse:
+    """Get server and model information."""
+    return JSONResponse(await run_in_threadpool(api.get_info))
+
+
+async def metrics(request: Request) -> JSONResponse:
+    """Request queue depth, outcomes and wait/run times."""
+    return JSONResponse(api.get_metrics())
+
+
+async def clear_cache(request: Request) -> JSONResponse:
+    """Clear GPU cache."""
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+        return JSONResponse({'status': 'cleared'})
+    return JSONResponse({'status': 'no_gpu'})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette):
+    if os.environ.get('PRELOAD', 'true').lower() == 'true':
+        await run_in_threadpool(api.preload)
+    yield
+
+
+async def bad_json(request: Request, exc: json.JSONDecodeError) -> JSONResponse:
+    return error_response(f"Invalid JSON body: {exc}", 400)
+
+
+app = Starlette(
+    routes=[
+        Route('/health', health, methods=['GET']),
+        Route('/generate', generate, methods=['POST']),
+        Route('/info', info, methods=['GET']),
+        Route('/metrics', metrics, methods=['GET']),
+        Route('/cache/clear', clear_cache, methods=['POST']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    exception_handlers={json.JSONDecodeError: bad_json},
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import argparse
+    import uvicorn
+    
+    parser = argparse.ArgumentParser(description='VPS Orchestrator API (ASGI)')
+    parser.add_argument('--host', default='0.0.0.0', help='Host to bind to')
+    parser.add_argument('--port', type=int, default=5000, help='Port to bind to')
+    args = parser.parse_args()
+    
+    print(f"Starting VPS Orchestrator ASGI API on {args.host}:{args.port}")
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,134 @@
+"""
+Tests for BatchScheduler failure handling.
+
+A tiny random Mistral stands in for the model, so nothing is downloaded:
+
+    python -m unittest test_batch_scheduler
+"""
+
+import threading
+import time
+import unittest
+
+import torch
+from transformers import MistralConfig, MistralForCausalLM
+
+from batch_scheduler import BatchScheduler
+
+RESULT_TIMEOUT = 30
+
+
+class CharTokenizer:
+    """One token per character; just what the scheduler uses."""
+
+    eos_token_id = 0
+    pad_token_id = 0
+
+    class Encoding:
+        def __init__(self, input_ids):
+            self.input_ids = input_ids
+
+    def __call__(self, text: str) -> "CharTokenizer.Encoding":
+        return self.Encoding([1 + ord(char) % 60 for char in text])
+
+    def decode(self, ids, skip_special_tokens: bool = True) -> str:
+        return " ".join(str(i) for i in ids)
+
+
+class FaultyModel(torch.nn.Module):
+    """Wraps a model; prefills (more than one input column) of poisoned prompts raise."""
+
+    def __init__(self, model, poison_length: int):
+        super().__init__()
+        self.model = model
+        self.poison_length = poison_length
+        self.entered = threading.Event()  # Set on every forward pass
+        self.gate = threading.Event()     # Forward passes wait for it
+        self.gate.set()
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def forward(self, input_ids, **kwargs):
+        self.entered.set()
+        self.gate.wait()
+        if input_ids.shape[1] == self.poison_length:
+            raise RuntimeError("prefill failed")
+        return self.model(input_ids=input_ids, **kwargs)
+
+
+def tiny_model():
+    torch.manual_seed(0)
+    config = MistralConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        num_key_value_heads=1,
+        max_position_embeddings=256,
+    )
+    return MistralForCausalLM(config).eval()
+
+
+def wait_until(condition, timeout: float = RESULT_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for the scheduler")
+        time.sleep(0.01)
+
+
+class BatchSchedulerFailureTest(unittest.TestCase):
+
+    POISON = "x" * 13  # Prefilled alone, so its input has exactly 13 columns
+
+    def setUp(self):
+        self.model = FaultyModel(tiny_model(), poison_length=len(self.POISON))
+        self.scheduler = BatchScheduler(self.model, CharTokenizer(), max_batch_size=4, temperature=0)
+        # Never stop early on EOS, so requests run for max_new_tokens
+        self.scheduler.eos_token_id = -1
+
+    def tearDown(self):
+        self.model.gate.set()
+        self.scheduler.stop()
+
+    def test_failed_prefill_fails_only_new_requests(self):
+        healthy = self.scheduler.submit("hello", max_new_tokens=100)
+        # Wait for the healthy request to be decoding, then admit the poisoned one
+        wait_until(lambda: self.scheduler.stats()['steps'] > 0)
+        poisoned = self.scheduler.submit(self.POISON, max_new_tokens=8)
+
+        with self.assertRaisesRegex(RuntimeError, "prefill failed"):
+            poisoned.result(timeout=RESULT_TIMEOUT)
+        self.assertEqual(len(healthy.result(timeout=RESULT_TIMEOUT).split()), 100)
+
+        stats = self.scheduler.stats()
+        self.assertEqual((stats['completed'], stats['failed']), (1, 1))
+
+        # The scheduler keeps serving
+        self.assertEqual(len(self.scheduler.submit("again", max_new_tokens=3).result(timeout=RESULT_TIMEOUT).split()), 3)
+
+    def test_stop_fails_active_and_queued_requests(self):
+        self.model.gate.clear()
+        active = self.scheduler.submit("hello", max_new_tokens=40)
+        self.assertTrue(self.model.entered.wait(RESULT_TIMEOUT))
+        # The scheduler is stuck in the first prefill: these stay queued
+        queued = [self.scheduler.submit(f"queued {i}", max_new_tokens=4) for i in range(6)]
+
+        stopper = threading.Thread(target=self.scheduler.stop)
+        stopper.start()
+        wait_until(lambda: not self.scheduler._running)
+        self.model.gate.set()
+        stopper.join(RESULT_TIMEOUT)
+        self.assertFalse(stopper.is_alive())
+
+        for future in [active] + queued:
+            self.assertTrue(future.done())
+            self.assertIsInstance(future.exception(), RuntimeError)
+        self.assertEqual(self.scheduler.stats()['failed'], 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
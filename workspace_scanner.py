@@ -0,0 +1,145 @@
+"""
+Workspace Scanner - Single-pass discovery of continuity documents
+Walks the workspace once, prunes excluded directories, and classifies every
+file that the Copilot context generator or the RAG indexer cares about.
+"""
+
+import os
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+
+# Directories never descended into
+EXCLUDED_DIRS = {'.git', 'node_modules', '__pycache__', 'venv', '.venv'}
+
+# File kinds, matched on the file name
+PORTFOLIO = 'portfolio'              # PORTFOLIO_CONTEXT.md
+PROJECT_CONTEXT = 'project_context'  # PROJECT_CONTEXT.md
+SESSION_BRIEFING = 'session_briefing'  # SESSION_BRIEFING*.md
+CONTINUITY = 'continuity'            # CONTINUITY*.md
+CONTEXT = 'context'                  # *_CONTEXT.md
+README = 'readme'                    # README.md
+
+
+def classify_name(name: str) -> Tuple[str, ...]:
+    """Return every kind a file name matches (empty if it is not relevant)."""
+    if not name.endswith('.md'):
+        return ()
+
+    kinds = []
+    if name == 'PORTFOLIO_CONTEXT.md':
+        kinds.append(PORTFOLIO)
+    if name == 'PROJECT_CONTEXT.md':
+        kinds.append(PROJECT_CONTEXT)
+    if name.startswith('SESSION_BRIEFING'):
+        kinds.append(SESSION_BRIEFING)
+    if name.startswith('CONTINUITY'):
+        kinds.append(CONTINUITY)
+    if name.endswith('_CONTEXT.md'):
+        kinds.append(CONTEXT)
+    if name == 'README.md':
+        kinds.append(README)
+    return tuple(kinds)
+
+
+class ScannedFile:
+    """A relevant file found by the scanner, with the stat taken during the walk."""
+
+    __slots__ = ('path', 'rel_path', 'kinds', 'mtime', 'mtime_ns', 'size')
+
+    def __init__(self, path: Path, rel_path: str, kinds: Tuple[str, ...], stat: os.stat_result):
+        self.path = path
+        self.rel_path = rel_path
+        self.kinds = kinds
+        self.mtime = stat.st_mtime
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+
+    @property
+    def name(self) -> str:
+        return self.path.name
+
+    def __repr__(self) -> str:
+        return f"ScannedFile({self.rel_path!r}, kinds={self.kinds})"
+
+
+class WorkspaceScan:
+    """Result of one workspace walk, shared by the prompt builder and the indexer."""
+
+    def __init__(self, root: Path, files: List[ScannedFile]):
+        self.root = root
+        self.files = files
+        self._by_rel_path = {f.rel_path: f for f in files}
+        self._by_path = {str(f.path): f for f in files}
+
+    def by_kind(self, kind: str) -> List[ScannedFile]:
+        """All files of one kind, in path order."""
+        return [f for f in self.files if kind in f.kinds]
+
+    def get(self, rel_path: str) -> Optional[ScannedFile]:
+        """Look up a file by its path relative to the root."""
+        return self._by_rel_path.get(rel_path)
+
+    def stat_of(self, path: Path) -> Optional[ScannedFile]:
+        """Look up a file by absolute path (None if it was not scanned)."""
+        return self._by_path.get(str(path))
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+
+def scan_workspace(root: Path, excluded_dirs=EXCLUDED_DIRS) -> WorkspaceScan:
+    """
+    Walk root once with os.scandir and collect every relevant file.
+
+    Excluded directories are pruned rather than filtered afterwards, and
+    only files whose names match a kind are stat'ed.
+    """
+    root = Path(root)
+    files = []
+    stack = [(str(root), "")]
+
+    while stack:
+        dir_path, rel_dir = stack.pop()
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in excluded_dirs:
+                                stack.append((entry.path, rel_dir + entry.name + os.sep))
+                            continue
+                        kinds = classify_name(entry.name)
+                        if kinds and entry.is_file():
+                            files.append(ScannedFile(
+                                Path(entry.path),
+                                rel_dir + entry.name,
+                                kinds,
+                                entry.stat(),
+                            ))
+                    except OSError:
+                        continue
+        except OSError as e:
+            print(f"Warning: cannot scan {dir_path}: {e}")
+
+    files.sort(key=lambda f: f.rel_path)
+    return WorkspaceScan(root, files)
+
+
+def main():
+    """Print what a scan of a workspace finds."""
+    import sys
+    import time
+
+    root = Path(sys.argv[1] if len(sys.argv) > 1 else ".")
+    start = time.perf_counter()
+    scan = scan_workspace(root)
+    elapsed = time.perf_counter() - start
+
+    for f in scan.files:
+        print(f"{f.rel_path}  {', '.join(f.kinds)}")
+    print(f"\n{len(scan)} relevant files in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()